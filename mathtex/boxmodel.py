@@ -1,5 +1,9 @@
 from __future__ import division
-from numpy import inf, isinf
+from math import isinf
+from operator import attrgetter
+import threading
+
+inf = float('inf')
 
 from mathtex.fonts import *
 
@@ -41,10 +45,57 @@ SUB1            = 0.0
 # Percentage of x-height that superscripts are offset relative to the subscript
 DELTA           = 0.18
 
+class Diagnostics(object):
+    """
+    Collects the overfull and underfull lists met while laying out an
+    expression.  Recording one only keeps the list, which is formatted
+    when :meth:`messages` is called, as the full repr of a list can be
+    long.
+
+    While a :class:`Diagnostics` is set for a thread with
+    :func:`set_diagnostics`, packing lists records to it rather than
+    issuing warnings.
+    """
+    def __init__(self):
+        self.events = []
+
+    def __len__(self):
+        return len(self.events)
+
+    def record(self, error_type, node):
+        self.events.append((error_type, node))
+
+    def messages(self):
+        """
+        Returns a message for each event, as the warnings used to be.
+        The lists are shown as they are now, which may be after they
+        have been shrunk or packed into others.
+        """
+        return ["%s %s: %r" % (error_type, node.__class__.__name__, node)
+                for error_type, node in self.events]
+
+_diagnostics = threading.local()
+
+def set_diagnostics(diagnostics):
+    """
+    Sets the :class:`Diagnostics` to record to in the calling thread,
+    or None to issue warnings, and returns the one set before.
+    """
+    previous = getattr(_diagnostics, 'current', None)
+    _diagnostics.current = diagnostics
+    return previous
+
+# The names of the slots of each node class, for Node.copy()
+_class_slots = {}
+
 class Node(object):
     """
-    A node in the TeX box model
+    A node in the TeX box model.  Nodes are created in large numbers,
+    and cached box models hold on to them, so they have no
+    ``__dict__``: each subclass lists its attributes in ``__slots__``.
     """
+    __slots__ = ('size',)
+
     def __init__(self):
         self.size = 0
 
@@ -54,15 +105,48 @@ class Node(object):
     def __internal_repr__(self):
         return self.__class__.__name__
 
+    def copy(self):
+        """
+        Returns a copy of the node.  The copy of a list holds copies of
+        its children, so it may be shrunk or packed on its own.
+
+        The common nodes copy their attributes one by one, which is
+        quicker than this, which copies every slot.
+        """
+        cls = self.__class__
+        names = _class_slots.get(cls)
+        if names is None:
+            names = _class_slots[cls] = [
+                name for klass in cls.__mro__
+                for name in getattr(klass, '__slots__', ())]
+        new = object.__new__(cls)
+        for name in names:
+            try:
+                setattr(new, name, getattr(self, name))
+            except AttributeError:
+                # Not every slot is set, e.g. Hlist.function_name
+                pass
+        return new
+
     def get_kerning(self, next):
         return 0.0
 
-    def shrink(self):
+    def shrink(self, levels=1):
         """
-        Shrinks one level smaller.  There are only three levels of
-        sizes, after which things will no longer get smaller.
+        Shrinks *levels* levels smaller.  There are only
+        ``NUM_SIZE_LEVELS`` levels of sizes, after which things will no
+        longer get smaller.
         """
-        self.size += 1
+        self.size += levels
+
+    def _shrink_steps(self, levels):
+        """
+        Returns how many of the next *levels* levels still make this
+        node smaller.  Each is applied as a separate multiplication by
+        ``SHRINK_FACTOR``, so a node ends up the same size however its
+        levels are grouped.
+        """
+        return max(0, min(self.size + levels, NUM_SIZE_LEVELS - 1) - self.size)
 
     def grow(self):
         """
@@ -78,15 +162,26 @@ class Box(Node):
     """
     Represents any node with a physical location.
     """
+    __slots__ = ('width', 'height', 'depth')
+
     def __init__(self, width, height, depth):
         Node.__init__(self)
         self.width  = width
         self.height = height
         self.depth  = depth
 
-    def shrink(self):
-        Node.shrink(self)
-        if self.size < NUM_SIZE_LEVELS:
+    def copy(self):
+        new = object.__new__(self.__class__)
+        new.size   = self.size
+        new.width  = self.width
+        new.height = self.height
+        new.depth  = self.depth
+        return new
+
+    def shrink(self, levels=1):
+        steps = self._shrink_steps(levels)
+        Node.shrink(self, levels)
+        for i in range(steps):
             self.width  *= SHRINK_FACTOR
             self.height *= SHRINK_FACTOR
             self.depth  *= SHRINK_FACTOR
@@ -104,6 +199,8 @@ class Vbox(Box):
     """
     A box with only height (zero width).
     """
+    __slots__ = ()
+
     def __init__(self, height, depth):
         Box.__init__(self, 0., height, depth)
 
@@ -111,6 +208,8 @@ class Hbox(Box):
     """
     A box with only width (zero height and depth).
     """
+    __slots__ = ()
+
     def __init__(self, width):
         Box.__init__(self, width, 0., 0.)
 
@@ -125,25 +224,30 @@ class Char(Node):
     from width) must be converted into a :class:`Kern` node when the
     :class:`Char` is added to its parent :class:`Hlist`.
     """
+    __slots__ = ('c', 'state', '_metrics', 'width', 'height', 'depth')
+
     def __init__(self, c, state):
         Node.__init__(self)
         self.c = c
-        self.font_output = state.font_output
-        assert isinstance(state.font, (str, unicode, int))
-        self.font = state.font
-        self.font_class = state.font_class
-        self.fontsize = state.fontsize
-        self.dpi = state.dpi
+        # States are immutable and shared, so this is simply kept
+        self.state = state
         # The real width, height and depth will be set during the
         # pack phase, after we know the real fontsize
         self._update_metrics()
 
+    font_output = property(attrgetter('state.font_output'))
+    font        = property(attrgetter('state.font'))
+    font_class  = property(attrgetter('state.font_class'))
+    fontsize    = property(attrgetter('state.fontsize'))
+    dpi         = property(attrgetter('state.dpi'))
+
     def __internal_repr__(self):
         return '`%s`' % self.c
 
     def _update_metrics(self):
-        metrics = self._metrics = self.font_output.get_metrics(
-            self.font, self.font_class, self.c, self.fontsize, self.dpi)
+        state = self.state
+        metrics = self._metrics = state.font_output.get_metrics(
+            state.font, state.font_class, self.c, state.fontsize, state.dpi)
         if self.c == ' ':
             self.width = metrics.advance
         else:
@@ -154,6 +258,18 @@ class Char(Node):
     def is_slanted(self):
         return self._metrics.slanted
 
+    def copy(self):
+        # Spelled out, as characters are the most common nodes by far
+        new = object.__new__(self.__class__)
+        new.size        = self.size
+        new.c           = self.c
+        new.state       = self.state
+        new._metrics    = self._metrics
+        new.width       = self.width
+        new.height      = self.height
+        new.depth       = self.depth
+        return new
+
     def get_kerning(self, next):
         """
         Return the amount of kerning between this and the given
@@ -163,42 +279,46 @@ class Char(Node):
         advance = self._metrics.advance - self.width
         kern = 0.
         if isinstance(next, Char):
-            kern = self.font_output.get_kern(
-                self.font, self.font_class, self.c, self.fontsize,
-                next.font, next.font_class, next.c, next.fontsize,
-                self.dpi)
+            state, next_state = self.state, next.state
+            kern = state.font_output.get_kern(
+                state.font, state.font_class, self.c, state.fontsize,
+                next_state.font, next_state.font_class, next.c,
+                next_state.fontsize, state.dpi)
         return advance + kern
 
     def render(self, x, y):
         """
         Render the character to the canvas
         """
-        info = self.font_output._get_info(self.font, self.font_class,
-                                          self.c, self.fontsize, self.dpi)
+        state = self.state
+        info = state.font_output._get_info(state.font, state.font_class,
+                                           self.c, state.fontsize, state.dpi)
         return (x, y, info)
 
     def bbox(self):
-        info = self.font_output._get_info(self.font, self.font_class,
-        self.c, self.fontsize, self.dpi)
+        state = self.state
+        info = state.font_output._get_info(state.font, state.font_class,
+                                           self.c, state.fontsize, state.dpi)
         return [info.metrics.xmin,
                 info.metrics.ymin,
                 info.metrics.xmax,
                 info.metrics.ymax]
 
-    def shrink(self):
-        Node.shrink(self)
-        if self.size < NUM_SIZE_LEVELS:
-            self.fontsize *= SHRINK_FACTOR
-            self.width    *= SHRINK_FACTOR
-            self.height   *= SHRINK_FACTOR
-            self.depth    *= SHRINK_FACTOR
+    def shrink(self, levels=1):
+        steps = self._shrink_steps(levels)
+        Node.shrink(self, levels)
+        for i in range(steps):
+            self.state   = self.state.shrunk()
+            self.width  *= SHRINK_FACTOR
+            self.height *= SHRINK_FACTOR
+            self.depth  *= SHRINK_FACTOR
 
     def grow(self):
         Node.grow(self)
-        self.fontsize *= GROW_FACTOR
-        self.width    *= GROW_FACTOR
-        self.height   *= GROW_FACTOR
-        self.depth    *= GROW_FACTOR
+        self.state   = self.state.grown()
+        self.width  *= GROW_FACTOR
+        self.height *= GROW_FACTOR
+        self.depth  *= GROW_FACTOR
 
 class Accent(Char):
     """
@@ -206,15 +326,18 @@ class Accent(Char):
     since they are already offset correctly from the baseline in
     TrueType fonts.
     """
+    __slots__ = ()
+
     def _update_metrics(self):
-        metrics = self._metrics = self.font_output.get_metrics(
-            self.font, self.font_class, self.c, self.fontsize, self.dpi)
+        state = self.state
+        metrics = self._metrics = state.font_output.get_metrics(
+            state.font, state.font_class, self.c, state.fontsize, state.dpi)
         self.width = metrics.xmax - metrics.xmin
         self.height = metrics.ymax - metrics.ymin
         self.depth = 0
 
-    def shrink(self):
-        Char.shrink(self)
+    def shrink(self, levels=1):
+        Char.shrink(self, levels)
         self._update_metrics()
 
     def grow(self):
@@ -225,8 +348,9 @@ class Accent(Char):
         """
         Render the character to the canvas.
         """
-        info = self.font_output._get_info(self.font, self.font_class,
-                                          self.c, self.fontsize, self.dpi)
+        state = self.state
+        info = state.font_output._get_info(state.font, state.font_class,
+                                           self.c, state.fontsize, state.dpi)
         return (x - self._metrics.xmin,
                 y + self._metrics.ymin,
                 info)
@@ -235,9 +359,13 @@ class List(Box):
     """
     A list of nodes (either horizontal or vertical).
     """
+    __slots__ = ('shift_amount', '_children', '_child_shrinks', 'glue_set',
+                 'glue_sign', 'glue_order', 'glue_ratio')
+
     def __init__(self, elements):
         Box.__init__(self, 0., 0., 0.)
         self.shift_amount = 0.   # An arbitrary offset
+        self._child_shrinks = 0  # Levels not yet passed on to the children
         self.children     = elements # The child nodes of this list
         # The following parameters are set in the vpack and hpack functions
         self.glue_set     = 0.   # The glue setting of this list
@@ -274,27 +402,82 @@ class List(Box):
             self.glue_ratio = 0.
         if o == 0:
             if len(self.children):
-                warn("%s %s: %r" % (error_type, self.__class__.__name__, self))
+                diagnostics = getattr(_diagnostics, 'current', None)
+                if diagnostics is None:
+                    warn("%s %s: %r" % (error_type, self.__class__.__name__,
+                                        self))
+                else:
+                    diagnostics.record(error_type, self)
+
+    def _get_children(self):
+        shrinks = self._child_shrinks
+        if shrinks:
+            self._child_shrinks = 0
+            for child in self._children:
+                child.shrink(shrinks)
+        return self._children
+
+    def _set_children(self, children):
+        self._children = children
+
+    children = property(_get_children, _set_children, doc="""
+        The child nodes of this list.  Shrinking a list only scales its
+        own dimensions, and the children are shrunk as well when next
+        asked for, so that shrinking nested lists, as nested scripts
+        and fractions do, visits each node once rather than once per
+        enclosing list.""")
 
-    def shrink(self):
-        for child in self.children:
-            child.shrink()
-        Box.shrink(self)
-        if self.size < NUM_SIZE_LEVELS:
+    def copy(self):
+        new = object.__new__(self.__class__)
+        new.size           = self.size
+        new.width          = self.width
+        new.height         = self.height
+        new.depth          = self.depth
+        new.shift_amount   = self.shift_amount
+        new.glue_set       = self.glue_set
+        new.glue_sign      = self.glue_sign
+        new.glue_order     = self.glue_order
+        new.glue_ratio     = self.glue_ratio
+        # Without asking for the children, which the copy shrinks alike
+        new._child_shrinks = self._child_shrinks
+        new._children      = [child.copy() for child in self._children]
+        return new
+
+    def shrink(self, levels=1):
+        steps = self._shrink_steps(levels)
+        self._child_shrinks += levels
+        Box.shrink(self, levels)
+        for i in range(steps):
             self.shift_amount *= SHRINK_FACTOR
             self.glue_set     *= SHRINK_FACTOR
 
     def grow(self):
-        for child in self.children:
-            child.grow()
-        Box.grow(self)
-        self.shift_amount *= GROW_FACTOR
-        self.glue_set     *= GROW_FACTOR
+        # Without recursion, as lists may be nested deeply
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, List):
+                stack.extend(node.children)
+                Box.grow(node)
+                node.shift_amount *= GROW_FACTOR
+                node.glue_set     *= GROW_FACTOR
+            else:
+                node.grow()
 
 class Hlist(List):
     """
     A horizontal list of boxes.
     """
+    # The parser marks the lists of function names, such as \sin
+    __slots__ = ('function_name',)
+
+    def copy(self):
+        new = List.copy(self)
+        function_name = getattr(self, 'function_name', None)
+        if function_name is not None:
+            new.function_name = function_name
+        return new
+
     def __init__(self, elements, w=0., m='additional', do_kern=True):
         List.__init__(self, elements)
         if do_kern:
@@ -310,12 +493,13 @@ class Hlist(List):
         way.
         """
         new_children = []
-        num_children = len(self.children)
+        children = self.children
+        num_children = len(children)
         if num_children:
             for i in range(num_children):
-                elem = self.children[i]
+                elem = children[i]
                 if i < num_children - 1:
-                    next = self.children[i + 1]
+                    next = children[i + 1]
                 else:
                     next = None
 
@@ -406,6 +590,8 @@ class Vlist(List):
     """
     A vertical list of boxes.
     """
+    __slots__ = ()
+
     def __init__(self, elements, h=0., m='additional'):
         List.__init__(self, elements)
         self.vpack()
@@ -486,6 +672,8 @@ class Rule(Box):
     dimension." The width is never running in an :class:`Hlist`; the
     height and depth are never running in a :class:`Vlist`.
     """
+    __slots__ = ()
+
     def __init__(self, width, height, depth, state):
         Box.__init__(self, width, height, depth)
 
@@ -499,6 +687,8 @@ class Hrule(Rule):
     """
     Convenience class to create a horizontal rule.
     """
+    __slots__ = ()
+
     def __init__(self, state, thickness=None):
         if thickness is None:
             thickness = state.font_output.get_underline_thickness(
@@ -510,6 +700,8 @@ class Vrule(Rule):
     """
     Convenience class to create a vertical rule.
     """
+    __slots__ = ()
+
     def __init__(self, state):
         thickness = state.font_output.get_underline_thickness(
             state.font, state.fontsize, state.dpi)
@@ -522,6 +714,8 @@ class Glue(Node):
     is a memory optimization which probably doesn't matter anymore, but it's
     easier to stick to what TeX does.)
     """
+    __slots__ = ('glue_subtype', 'glue_spec')
+
     def __init__(self, glue_type, copy=False):
         Node.__init__(self)
         self.glue_subtype   = 'normal'
@@ -535,11 +729,20 @@ class Glue(Node):
             glue_spec = glue_spec.copy()
         self.glue_spec      = glue_spec
 
-    def shrink(self):
-        Node.shrink(self)
-        if self.size < NUM_SIZE_LEVELS:
-            if self.glue_spec.width != 0.:
-                self.glue_spec = self.glue_spec.copy()
+    def copy(self):
+        # The spec is shared, as the glue copies it before changing it
+        new = object.__new__(self.__class__)
+        new.size         = self.size
+        new.glue_subtype = self.glue_subtype
+        new.glue_spec    = self.glue_spec
+        return new
+
+    def shrink(self, levels=1):
+        steps = self._shrink_steps(levels)
+        Node.shrink(self, levels)
+        if steps and self.glue_spec.width != 0.:
+            self.glue_spec = self.glue_spec.copy()
+            for i in range(steps):
                 self.glue_spec.width *= SHRINK_FACTOR
 
     def grow(self):
@@ -552,6 +755,8 @@ class GlueSpec(object):
     """
     See :class:`Glue`.
     """
+    __slots__ = ('width', 'stretch', 'stretch_order', 'shrink', 'shrink_order')
+
     def __init__(self, width=0., stretch=0., stretch_order=0, shrink=0., shrink_order=0):
         self.width         = width
         self.stretch       = stretch
@@ -585,30 +790,44 @@ GlueSpec._types = {
 # Some convenient ways to get common kinds of glue
 
 class Fil(Glue):
+    __slots__ = ()
+
     def __init__(self):
         Glue.__init__(self, 'fil')
 
 class Fill(Glue):
+    __slots__ = ()
+
     def __init__(self):
         Glue.__init__(self, 'fill')
 
 class Filll(Glue):
+    __slots__ = ()
+
     def __init__(self):
         Glue.__init__(self, 'filll')
 
 class NegFil(Glue):
+    __slots__ = ()
+
     def __init__(self):
         Glue.__init__(self, 'neg_fil')
 
 class NegFill(Glue):
+    __slots__ = ()
+
     def __init__(self):
         Glue.__init__(self, 'neg_fill')
 
 class NegFilll(Glue):
+    __slots__ = ()
+
     def __init__(self):
         Glue.__init__(self, 'neg_filll')
 
 class SsGlue(Glue):
+    __slots__ = ()
+
     def __init__(self):
         Glue.__init__(self, 'ss')
 
@@ -617,6 +836,8 @@ class HCentered(Hlist):
     A convenience class to create an :class:`Hlist` whose contents are
     centered within its enclosing box.
     """
+    __slots__ = ()
+
     def __init__(self, elements):
         Hlist.__init__(self, [SsGlue()] + elements + [SsGlue()],
                        do_kern=False)
@@ -626,6 +847,8 @@ class VCentered(Hlist):
     A convenience class to create a :class:`Vlist` whose contents are
     centered within its enclosing box.
     """
+    __slots__ = ()
+
     def __init__(self, elements):
         Vlist.__init__(self, [SsGlue()] + elements + [SsGlue()])
 
@@ -639,6 +862,8 @@ class Kern(Node):
     when its *width* denotes additional spacing in the vertical
     direction.
     """
+    __slots__ = ('width',)
+
     def __init__(self, width):
         Node.__init__(self)
         self.width = width
@@ -646,9 +871,16 @@ class Kern(Node):
     def __repr__(self):
         return "k%.02f" % self.width
 
-    def shrink(self):
-        Node.shrink(self)
-        if self.size < NUM_SIZE_LEVELS:
+    def copy(self):
+        new = object.__new__(self.__class__)
+        new.size  = self.size
+        new.width = self.width
+        return new
+
+    def shrink(self, levels=1):
+        steps = self._shrink_steps(levels)
+        Node.shrink(self, levels)
+        for i in range(steps):
             self.width *= SHRINK_FACTOR
 
     def grow(self):
@@ -663,12 +895,21 @@ class SubSuperCluster(Hlist):
     and super-script, such that if another script follows that needs
     to be attached, it can be reconfigured on the fly.
     """
+    __slots__ = ('nucleus', 'sub', 'super')
+
     def __init__(self):
         self.nucleus = None
         self.sub = None
         self.super = None
         Hlist.__init__(self, [])
 
+    def copy(self):
+        new = Hlist.copy(self)
+        new.nucleus = self.nucleus
+        new.sub = self.sub
+        new.super = self.super
+        return new
+
 class AutoHeightChar(Hlist):
     """
     :class:`AutoHeightChar` will create a character as close to the
@@ -677,20 +918,21 @@ class AutoHeightChar(Hlist):
     fonts), the correct glyph will be selected, otherwise this will
     always just return a scaled version of the glyph.
     """
+    __slots__ = ()
+
     def __init__(self, c, height, depth, state, always=False):
         alternatives = state.font_output.get_sized_alternatives_for_symbol(
             state.font, c)
 
-        state = state.copy()
         target_total = height + depth
         for fontname, sym in alternatives:
-            state.font = fontname
+            state = state.with_font(fontname)
             char = Char(sym, state)
             if char.height + char.depth >= target_total:
                 break
 
         factor = target_total / (char.height + char.depth)
-        state.fontsize *= factor
+        state = state.with_fontsize(state.fontsize * factor)
         char = Char(sym, state)
 
         shift = (depth - char.depth)
@@ -705,19 +947,20 @@ class AutoWidthChar(Hlist):
     correct glyph will be selected, otherwise this will always just
     return a scaled version of the glyph.
     """
+    __slots__ = ()
+
     def __init__(self, c, width, state, always=False, char_class=Char):
         alternatives = state.font_output.get_sized_alternatives_for_symbol(
             state.font, c)
 
-        state = state.copy()
         for fontname, sym in alternatives:
-            state.font = fontname
+            state = state.with_font(fontname)
             char = char_class(sym, state)
             if char.width >= width:
                 break
 
         factor = width / char.width
-        state.fontsize *= factor
+        state = state.with_fontsize(state.fontsize * factor)
         char = char_class(sym, state)
 
         Hlist.__init__(self, [char])
@@ -727,27 +970,112 @@ class Ship(object):
     """
     Once the boxes have been set up, this sends them to output.  Since
     boxes can be inside of boxes inside of boxes, the main work of
-    :class:`Ship` is done by two mutually recursive routines,
-    :meth:`hlist_out` and :meth:`vlist_out`, which traverse the
-    :class:`Hlist` nodes and :class:`Vlist` nodes inside of horizontal
-    and vertical boxes.  The global variables used in TeX to store
-    state as it processes have become member variables here.
+    :class:`Ship` is done by two routines, :meth:`hlist_out` and
+    :meth:`vlist_out`, which traverse the :class:`Hlist` nodes and
+    :class:`Vlist` nodes inside of horizontal and vertical boxes.  In
+    TeX they are mutually recursive; here they are generators which
+    yield the lists inside the box to be traversed in turn, and
+    :meth:`traverse` keeps them on a stack of its own, so that boxes
+    may be nested deeper than Python's recursion limit.  The global
+    variables used in TeX to store state as it processes have become
+    member variables here.
+
+    Shipping a box traverses it once, recording where each glyph and
+    rule goes and the bounding box *bbox* of the output at the origin.
+    :meth:`output` then gives the glyphs and rules at any offset, such
+    as one that puts the left edge of the bounding box at zero.  Each
+    box is shipped by its own :class:`Ship`, so boxes may be shipped
+    from several threads at once.
     """
-    def __call__(self, ox, oy, box):
+    def __init__(self, box):
+        self.box         = box
         self.max_push    = 0 # Deepest nesting of push commands so far
         self.cur_s       = 0
         self.cur_v       = 0.
         self.cur_h       = 0.
-        self.off_h       = ox
-        self.off_v       = oy + box.height
 
-        self.rects = []
+        # The glyphs as (h, v, char, bbox of the glyph) and the rules
+        # as (h, v, rule, width, height), relative to the offset
         self.glyphs = []
-        self.bbox = [0, 0, 0, 0]
+        self.rects = []
 
-        self.hlist_out(box)
+        self.traverse(box)
+        self.bbox = self._get_bbox(0, box.height)
 
-        return (self.rects, self.glyphs, self.bbox)
+    def traverse(self, box):
+        stack = [self.hlist_out(box)]
+        while stack:
+            for p in stack[-1]:
+                if isinstance(p, Hlist):
+                    stack.append(self.hlist_out(p))
+                else:
+                    stack.append(self.vlist_out(p))
+                break
+            else:
+                stack.pop()
+
+    def output(self, ox, oy):
+        """
+        Returns the rectangles and glyphs, and their bounding box, with
+        the box shipped at (*ox*, *oy*).
+        """
+        off_h = ox
+        off_v = oy + self.box.height
+        rects = [p.render(h + off_h, v + off_v, width, height)
+                 for h, v, p, width, height in self.rects]
+        glyphs = [p.render(h + off_h, v + off_v)
+                  for h, v, p, bbox in self.glyphs]
+        return (rects, glyphs, self._get_bbox(off_h, off_v))
+
+    def display_list(self, ox, oy):
+        """
+        Returns the output, with the box shipped at (*ox*, *oy*), as a
+        :class:`DisplayList`.  Requires numpy.
+        """
+        import numpy as np
+
+        off_h = ox
+        off_v = oy + self.box.height
+        fonts = []
+        font_ids = {}
+        records = []
+        dpi = None
+        for h, v, p, bbox in self.glyphs:
+            x, y, info = p.render(h + off_h, v + off_v)
+            font_id = font_ids.get(info.font.fname)
+            if font_id is None:
+                font_id = font_ids[info.font.fname] = len(fonts)
+                fonts.append((info.font.fname, info.postscript_name))
+            records.append((info.num, font_id, info.fontsize, x, y,
+                            info.offset, info.metrics.iceberg))
+            dpi = p.dpi
+        glyphs = np.array(records, dtype=DisplayList.glyph_dtype)
+        rects = np.array([p.render(h + off_h, v + off_v, width, height)
+                          for h, v, p, width, height in self.rects],
+                         dtype=float).reshape((-1, 4))
+        return DisplayList(fonts, glyphs, rects,
+                           self._get_bbox(off_h, off_v), dpi)
+
+    def _get_bbox(self, off_h, off_v):
+        x1, y1, x2, y2 = 0, 0, 0, 0
+        for h, v, p, bbox in self.glyphs:
+            ox, oy = h + off_h, v + off_v
+            x1 = min(x1, ox + bbox[0])
+            y1 = min(y1, oy - bbox[1])
+            x2 = max(x2, ox + bbox[2])
+            y2 = max(y2, oy - bbox[3])
+        for h, v, p, width, height in self.rects:
+            ox, oy = h + off_h, v + off_v
+            x1 = min(x1, ox)
+            y1 = min(y1, oy)
+            x2 = max(x2, ox + width)
+            y2 = max(y2, oy + height)
+        return [x1, y1, x2, y2]
+
+    def _add_rect(self, p, width, height):
+        # Boxes other than rules draw nothing
+        if p.render(self.cur_h, self.cur_v, width, height) is not None:
+            self.rects.append((self.cur_h, self.cur_v, p, width, height))
 
     @staticmethod
     def clamp(value):
@@ -757,12 +1085,6 @@ class Ship(object):
             return 1000000000.
         return value
 
-    def _update_bbox(self, x1, y1, x2, y2):
-        self.bbox = [min(self.bbox[0], x1),
-                     min(self.bbox[1], y1),
-                     max(self.bbox[2], x2),
-                     max(self.bbox[3], y2)]
-
     def hlist_out(self, box):
         cur_g         = 0
         cur_glue      = 0.
@@ -776,11 +1098,7 @@ class Ship(object):
 
         for p in box.children:
             if isinstance(p, Char):
-                ox, oy = self.cur_h + self.off_h, self.cur_v + self.off_v
-                bbox = p.bbox()
-                self.glyphs.append(p.render(ox, oy))
-                self._update_bbox(ox + bbox[0], oy - bbox[1],
-                                  ox + bbox[2], oy - bbox[3])
+                self.glyphs.append((self.cur_h, self.cur_v, p, p.bbox()))
                 self.cur_h += p.width
             elif isinstance(p, Kern):
                 self.cur_h += p.width
@@ -791,11 +1109,8 @@ class Ship(object):
                 else:
                     edge = self.cur_h
                     self.cur_v = base_line + p.shift_amount
-                    if isinstance(p, Hlist):
-                        self.hlist_out(p)
-                    else:
-                        # p.vpack(box.height + box.depth, 'exactly')
-                        self.vlist_out(p)
+                    # p.vpack(box.height + box.depth, 'exactly')
+                    yield p
                     self.cur_h = edge + p.width
                     self.cur_v = base_line
             elif isinstance(p, Box):
@@ -808,11 +1123,9 @@ class Ship(object):
                 if isinf(rule_depth):
                     rule_depth = box.depth
                 if rule_height > 0 and rule_width > 0:
-                    self.cur_v = baseline + rule_depth
-                    ox, oy = self.cur_h + self.off_h, self.cur_v + self.off_v
-                    self.rects.append(p.render(ox, oy, rule_width, rule_height))
-                    self._update_bbox(p.bbox(ox, oy, rule_width, rule_height))
-                    self.cur_v = baseline
+                    self.cur_v = base_line + rule_depth
+                    self._add_rect(p, rule_width, rule_height)
+                    self.cur_v = base_line
                 self.cur_h += rule_width
             elif isinstance(p, Glue):
                 # node625
@@ -853,10 +1166,7 @@ class Ship(object):
                     self.cur_h = left_edge + p.shift_amount
                     save_v = self.cur_v
                     p.width = box.width
-                    if isinstance(p, Hlist):
-                        self.hlist_out(p)
-                    else:
-                        self.vlist_out(p)
+                    yield p
                     self.cur_v = save_v + p.depth
                     self.cur_h = left_edge
             elif isinstance(p, Box):
@@ -868,11 +1178,7 @@ class Ship(object):
                 rule_height += rule_depth
                 if rule_height > 0 and rule_depth > 0:
                     self.cur_v += rule_height
-                    ox, oy = self.cur_h + self.off_h, self.cur_v + self.off_v
-                    rect = p.render(ox, oy, rule_width, rule_height)
-                    if rect is not None:
-                        self.rects.append(rect)
-                        self._update_bbox(ox, oy, ox + rule_width, oy + rule_height)
+                    self._add_rect(p, rule_width, rule_height)
             elif isinstance(p, Glue):
                 glue_spec = p.glue_spec
                 rule_height = glue_spec.width - cur_g
@@ -890,4 +1196,40 @@ class Ship(object):
                 raise RuntimeError("Internal mathtext error: Char node found in vlist")
         self.cur_s -= 1
 
-ship = Ship()
+class DisplayList(object):
+    """
+    The output of shipping a box, held in arrays rather than in a
+    tuple per glyph and rule, to be processed with numpy, kept in
+    caches or sent to other processes.  It refers to fonts by their
+    files, so may be pickled.
+
+    *glyphs* is a structured array of the fields of
+    :attr:`glyph_dtype`: the character code of each glyph, the index of
+    its font in *fonts*, its size in points, its position, as in the
+    glyph tuples of :meth:`Ship.output`, and the *offset* and *iceberg*
+    of its metrics.  *fonts* holds a (file name, postscript name) pair
+    for each font.  *rects* is an array of the (x1, y1, x2, y2) of each
+    rule.  *bbox* is the bounding box of the output, and *dpi* that of
+    the glyphs, or None if there are none.
+    """
+    glyph_dtype = [('num',     'u4'),
+                   ('font',    'u2'),
+                   ('size',    'f8'),
+                   ('x',       'f8'),
+                   ('y',       'f8'),
+                   ('offset',  'f8'),
+                   ('iceberg', 'f8')]
+
+    def __init__(self, fonts, glyphs, rects, bbox, dpi):
+        self.fonts  = fonts
+        self.glyphs = glyphs
+        self.rects  = rects
+        self.bbox   = bbox
+        self.dpi    = dpi
+
+def ship(ox, oy, box):
+    """
+    Ships *box* at (*ox*, *oy*), returning the rectangles and glyphs
+    to draw and their bounding box.
+    """
+    return Ship(box).output(ox, oy)
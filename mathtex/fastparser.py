@@ -0,0 +1,1142 @@
+import re
+import weakref
+
+from mathtex.pyparsing import ParseFatalException
+from mathtex.parser import MathtexParser, SingleSymbol
+from mathtex.fonts import tex2uni
+from mathtex.util import maxdict
+
+##############################################################################
+# FAST PARSER
+
+# Results of the recognisers, other than the end of a successful match
+FAIL = -1       # The construct does not match, alternatives may be tried
+FATAL = -2      # The construct can not match, as after an ErrorStop
+
+def _one_of(strs):
+    """
+    Compiles a regular expression matching the longest of *strs*, as
+    pyparsing's :func:`oneOf` does.
+    """
+    strs = sorted(strs, key=len, reverse=True)
+    return re.compile('|'.join([re.escape(x) for x in strs]))
+
+class _Group(list):
+    """
+    A list of tokens standing in for a pyparsing :class:`Group`, for
+    the benefit of parse actions which call ``asList()``.
+    """
+    def asList(self):
+        return list(self)
+
+class MathtexSyntaxError(ValueError):
+    """
+    Raised by :meth:`FastMathtexParser.validate` for an error *msg* at
+    index *loc* of the expression.
+    """
+    def __init__(self, msg, loc):
+        ValueError.__init__(self, "%s (at char %d)" % (msg, loc))
+        self.msg = msg
+        self.loc = loc
+
+class FastMathtexParser(MathtexParser):
+    """
+    A hand-written recursive descent parser for math expressions.
+
+    It accepts exactly the language of :class:`MathtexParser`, reports
+    the same errors and calls the very same parse actions, so the box
+    model it produces is identical; it merely does without pyparsing.
+
+    Parsing is split into two phases.  :meth:`parse_ast` turns the
+    expression into a font independent syntax tree, which is cached,
+    and :meth:`layout` turns the tree into a box model for a given
+    fontset, size and dpi.  Rendering an expression at several sizes
+    therefore only parses it once.
+
+    To build the tree the recognisers (``_r_*``) work out, without any
+    side effects, where each construct ends.  This stands in for
+    pyparsing's look-ahead when picking the longest of a set of
+    alternatives (``^``).  Recognisers return the end of the match,
+    :const:`FAIL` or :const:`FATAL` and are memoised for the duration
+    of the parse.  The constructors (``_a_*``) then build the nodes of
+    the chosen alternatives.  The layout (``_l_*``) calls the parse
+    actions in the same order as pyparsing would.
+    """
+    _whitespace = ' \t\n\r'
+
+    _single_symbol_re = re.compile(SingleSymbol.pattern)
+    _command_re = re.compile(r"[a-zA-Z]+")
+    _float_re = re.compile(r"[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)")
+    _digits_re = re.compile(r"[0-9]+")
+    _rule_re = re.compile(r"[0-9]*(\.?[0-9]*)?")
+    _operatorname_re = re.compile(r"[A-Za-z]+")
+    _non_math_re = re.compile(r"(?:(?:\\[$])|[^$])*")
+
+    _accent_re = _one_of(MathtexParser._accent_map.keys() +
+                         list(MathtexParser._wide_accents))
+    _function_re = _one_of(MathtexParser._function_names)
+    _font_re = _one_of(MathtexParser._fontnames)
+    _latexfont_re = _one_of(['math' + x for x in MathtexParser._fontnames])
+    _space_re = _one_of(MathtexParser._space_widths.keys())
+    _char_over_chars_re = _one_of(MathtexParser._char_over_chars.keys())
+    _ambi_delim_re = _one_of(MathtexParser._ambiDelim)
+    _left_delim_re = _one_of(MathtexParser._leftDelim)
+    _right_delim_re = _one_of(MathtexParser._rightDelim)
+    _genfrac_ldelim_re = _one_of(MathtexParser._ambiDelim |
+                                 MathtexParser._leftDelim | set(['']))
+    _genfrac_rdelim_re = _one_of(MathtexParser._ambiDelim |
+                                 (MathtexParser._rightDelim - set(['}'])) |
+                                 set(['', r'\}']))
+
+    # The number of expressions whose syntax tree is kept around
+    _ast_cache_size = 100
+
+    # The number of laid out fractions, roots, scripts, groups and
+    # accents kept around, for each fonts object, font, size and dpi,
+    # to be copied when they come up again rather than laid out anew.
+    # None turns this off; it may be changed on a parser or a subclass.
+    # Copying only pays off where the same pieces recur: formulas made
+    # of them lay out about twice as fast, while the varied expressions
+    # of the test corpus, of which a third of the subtrees are found,
+    # lay out at only 0.7-0.85 times the speed without it.
+    subtree_cache_size = None
+
+    # The kinds of syntax tree nodes which are kept, none of which
+    # changes the state of the parser
+    _subtree_kinds = frozenset(['accent', 'group', 'frac', 'stackrel',
+                                'binom', 'genfrac', 'sqrt', 'subsuper'])
+
+    def __init__(self):
+        # There is no grammar to build
+        self._ast_cache = maxdict(self._ast_cache_size)
+        self._subtree_cache = None
+        self._subtree_ids = None
+        self._node_ids = None
+        self._subtrees_seen = None
+        self._next_subtree_id = 0
+        # The fonts objects with boxes in the cache
+        self._subtree_fonts = weakref.WeakKeyDictionary()
+        # How often a subtree was found in, and missing from, the cache
+        self.subtree_hits = 0
+        self.subtree_misses = 0
+        self.clear()
+
+    def clear(self):
+        MathtexParser.clear(self)
+        self._s = None
+        self._n = 0
+        self._placeable_memo = {}
+        self._simple_memo = {}
+        self._item_memo = {}
+        self._group_memo = {}
+        self._autodelim_memo = {}
+
+    def parse(self, s, fonts_object, fontsize, dpi):
+        return self.layout(self.parse_ast(s), fonts_object, fontsize, dpi)
+
+    def parse_ast(self, s):
+        """
+        Parse expression *s* into an abstract syntax tree of nested
+        tuples.
+
+        The tree depends on *s* alone, not on the fonts it is later
+        laid out with, and can be pickled.  Trees are cached by
+        expression.  Syntax errors are only raised by :meth:`layout`,
+        while :class:`MathtexLimitError` is raised here.
+        """
+        ast = self._ast_cache.get(s)
+        if ast is None:
+            self.check_limits(s)
+            self.clear()
+            # As pyparsing does
+            self._s = s.expandtabs()
+            self._n = len(self._s)
+            try:
+                ast = self._a_expression()
+            finally:
+                self.clear()
+            self._ast_cache[s] = ast
+        return ast
+
+    def layout(self, ast, fonts_object, fontsize, dpi):
+        """
+        Lay out *ast*, as returned by :meth:`parse_ast`, using the
+        given *fonts_object* for output, at the given *fontsize* and
+        *dpi*.
+
+        Returns the parse tree of :class:`Node` instances.
+        """
+        self.clear()
+        if self._subtree_cache is not None:
+            self._drop_destroyed([self._subtree_cache, self._subtrees_seen],
+                                 self._subtree_fonts, 1)
+        self._default_style = fonts_object.default_style
+        self._state_stack = [self.State(fonts_object, 'default', 'rm', fontsize, dpi)]
+        self._s = ast[1]
+        try:
+            self._collect_diagnostics(self._l_expression, ast)
+        except ParseFatalException, err:
+            raise ValueError(str(err))
+
+        expr = self._expr
+        self.clear()
+        return expr
+
+    def validate(self, s):
+        """
+        Check expression *s* without laying it out, so no fonts are
+        needed or loaded.
+
+        Raises :class:`MathtexSyntaxError`, with the location of the
+        problem, for the first error :meth:`parse` would report.  The
+        only errors not detected are symbols missing from a fontset.
+        """
+        self._validate(self.parse_ast(s))
+
+    def _validate(self, node):
+        kind = node[0]
+        if kind == 'error':
+            raise MathtexSyntaxError(node[1], node[2])
+        elif kind in ('expression', 'group'):
+            children = node[2]
+        elif kind in ('math', 'subsuper'):
+            children = node[1]
+        elif kind in ('accent', 'sqrt'):
+            children = node[2:]
+        elif kind in ('frac', 'stackrel', 'binom'):
+            children = node[1:]
+        elif kind == 'genfrac':
+            children = node[4:]
+        elif kind == 'autodelim':
+            # The right delimiter may be an error
+            children = node[2] + node[3:]
+        else:
+            children = ()
+        for child in children:
+            if isinstance(child, tuple):
+                self._validate(child)
+
+        # The checks made by subsuperscript()
+        if kind == 'subsuper':
+            toks = node[1]
+            if len(toks) == 5 and toks[1] == toks[3]:
+                if toks[1] == '_':
+                    raise MathtexSyntaxError("Double subscript", node[2])
+                else:
+                    raise MathtexSyntaxError("Double superscript", node[2])
+            elif len(toks) == 4 or len(toks) > 5:
+                raise MathtexSyntaxError(
+                    "Subscript/superscript sequence is too long. "
+                    "Use braces { } to remove ambiguity.", node[2])
+
+    def _skip(self, loc):
+        """
+        Returns the location of the first non-whitespace character at
+        or after *loc*.
+        """
+        s = self._s
+        n = self._n
+        whitespace = self._whitespace
+        while loc < n and s[loc] in whitespace:
+            loc += 1
+        return loc
+
+    def _literal(self, loc, literal):
+        loc = self._skip(loc)
+        if self._s.startswith(literal, loc):
+            return loc + len(literal)
+        return FAIL
+
+    def _command(self, loc, regex):
+        """
+        Matches a backslash followed by one of the names in *regex*,
+        returning the match object or None.
+        """
+        loc = self._skip(loc)
+        if not self._s.startswith('\\', loc):
+            return None
+        return regex.match(self._s, self._skip(loc + 1))
+
+    def _longest(self, loc, rules):
+        """
+        Tries each of the (recogniser, builder) pairs in *rules* at
+        *loc* and returns the end of the longest match and its rule.
+        The first rule wins a tie.
+        """
+        best_end = FAIL
+        best = None
+        for rule in rules:
+            end = rule[0](self, loc)
+            if end > best_end:
+                best_end = end
+                best = rule
+        return best_end, best
+
+    #########################################################################
+    # Recognisers
+
+    def _r_function(self, loc):
+        m = self._command(loc, self._function_re)
+        if m is None:
+            return FAIL
+        return m.end()
+
+    def _single_symbol(self, loc):
+        m = self._single_symbol_re.match(self._s, loc)
+        if m is not None and m.end() == loc + 1 and \
+                ord(self._s[loc]) > SingleSymbol.max_code:
+            return None
+        return m
+
+    def _r_symbol(self, loc):
+        s = self._s
+        loc = self._skip(loc)
+        m = self._command(loc, self._char_over_chars_re)
+        if m is not None:
+            return m.end()
+        m = self._single_symbol(loc)
+        if m is not None:
+            return m.end()
+        if s.startswith('\\', loc):
+            # The longest name in tex2uni would only be followed by a
+            # non-letter if it is the whole of the command
+            m = self._command_re.match(s, loc + 1)
+            if m is not None and m.group() in tex2uni and m.end() < self._n:
+                return m.end()
+        return FAIL
+
+    def _r_accent(self, loc):
+        m = self._command(loc, self._accent_re)
+        if m is None:
+            return FAIL
+        end = self._r_placeable(m.end())
+        if end < 0:
+            return FATAL
+        return end
+
+    def _r_latexfont(self, loc):
+        m = self._command(loc, self._latexfont_re)
+        if m is None:
+            return FAIL
+        return m.end()
+
+    def _r_start_group(self, loc):
+        end = self._r_latexfont(loc)
+        if end < 0:
+            end = loc
+        end = self._literal(end, '{')
+        if end < 0:
+            return FATAL
+        return end
+
+    def _r_group(self, loc):
+        memo = self._group_memo
+        result = memo.get(loc)
+        if result is None:
+            result = self._r_start_group(loc)
+            if result >= 0:
+                end = self._r_item(result)
+                while end >= 0:
+                    result = end
+                    end = self._r_item(result)
+                result = self._literal(result, '}')
+                if result < 0:
+                    result = FATAL
+            memo[loc] = result
+        return result
+
+    def _r_two_groups(self, loc, command):
+        start = self._literal(loc, command)
+        if start < 0:
+            return FAIL
+        end = self._r_group(start)
+        if end >= 0:
+            end = self._r_group(end)
+        if end == FAIL:
+            return self._skip(start)
+        return end
+
+    def _r_frac(self, loc):
+        return self._r_two_groups(loc, r'\frac')
+
+    def _r_stackrel(self, loc):
+        return self._r_two_groups(loc, r'\stackrel')
+
+    def _r_binom(self, loc):
+        return self._r_two_groups(loc, r'\binom')
+
+    def _r_genfrac_args(self, loc):
+        s = self._s
+        for regex in (self._genfrac_ldelim_re, self._genfrac_rdelim_re,
+                      self._rule_re):
+            loc = self._literal(loc, '{')
+            if loc < 0:
+                return FAIL
+            # These all match the empty string
+            loc = self._literal(regex.match(s, self._skip(loc)).end(), '}')
+            if loc < 0:
+                return FAIL
+        for i in range(3):
+            loc = self._r_group(loc)
+            if loc < 0:
+                return loc
+        return loc
+
+    def _r_genfrac(self, loc):
+        start = self._literal(loc, r'\genfrac')
+        if start < 0:
+            return FAIL
+        end = self._r_genfrac_args(start)
+        if end == FAIL:
+            return self._skip(start)
+        return end
+
+    def _r_root(self, loc):
+        loc = self._literal(loc, '[')
+        if loc < 0:
+            return FAIL
+        m = self._digits_re.match(self._s, self._skip(loc))
+        if m is None:
+            return FATAL
+        loc = self._literal(m.end(), ']')
+        if loc < 0:
+            return FATAL
+        return loc
+
+    def _r_sqrt(self, loc):
+        start = self._literal(loc, r'\sqrt')
+        if start < 0:
+            return FAIL
+        root = self._r_root(start)
+        if root == FATAL:
+            return FATAL
+        if root >= 0:
+            start = root
+        end = self._r_group(start)
+        if end == FAIL:
+            return self._skip(start)
+        return end
+
+    def _r_operatorname(self, loc):
+        start = self._literal(loc, r'\operatorname')
+        if start < 0:
+            return FAIL
+        loc = self._r_start_group(start)
+        if loc < 0:
+            return loc
+        m = self._operatorname_re.match(self._s, self._skip(loc))
+        if m is not None:
+            end = self._literal(m.end(), '}')
+            if end >= 0:
+                return end
+        return self._skip(start)
+
+    def _r_placeable(self, loc):
+        memo = self._placeable_memo
+        result = memo.get(loc)
+        if result is None:
+            # Only symbols start with something other than a backslash
+            # and only groups start with a brace
+            s = self._s
+            start = self._skip(loc)
+            if s.startswith('\\', start):
+                rules = self._placeable_rules
+            elif s.startswith('{', start):
+                rules = self._group_rules
+            else:
+                rules = self._symbol_rules
+            result = memo[loc] = self._longest(loc, rules)
+        return result[0]
+
+    def _r_space(self, loc):
+        loc = self._skip(loc)
+        if not self._s.startswith('\\', loc):
+            return FAIL
+        m = self._space_re.match(self._s, loc)
+        if m is None:
+            return FAIL
+        return m.end()
+
+    def _r_customspace(self, loc):
+        start = self._literal(loc, r'\hspace')
+        if start < 0:
+            return FAIL
+        loc = self._literal(start, '{')
+        if loc < 0:
+            return self._skip(start)
+        m = self._float_re.match(self._s, self._skip(loc))
+        if m is None:
+            return FATAL
+        end = self._literal(m.end(), '}')
+        if end < 0:
+            return FATAL
+        return end
+
+    def _r_font(self, loc):
+        m = self._command(loc, self._font_re)
+        if m is None:
+            return FAIL
+        return m.end()
+
+    def _is_subsuperop(self, loc):
+        return loc < self._n and self._s[loc] in '_^'
+
+    def _r_subsuper(self, loc):
+        nucleus = self._r_placeable(loc)
+        if nucleus >= 0:
+            op = self._skip(nucleus)
+        else:
+            op = self._skip(loc)
+        if not self._is_subsuperop(op):
+            return nucleus
+        while True:
+            end = self._r_placeable(op + 1)
+            if end < 0:
+                return FATAL
+            op = self._skip(end)
+            if not self._is_subsuperop(op):
+                return end
+
+    def _r_simple(self, loc):
+        memo = self._simple_memo
+        result = memo.get(loc)
+        if result is None:
+            result = (FAIL, None)
+            for rule in self._simple_rules:
+                end = rule[0](self, loc)
+                if end != FAIL:
+                    result = (end, rule)
+                    break
+            memo[loc] = result
+        return result[0]
+
+    def _r_simples(self, loc):
+        end = self._r_simple(loc)
+        if end < 0:
+            return end
+        while True:
+            next = self._r_simple(end)
+            if next == FATAL:
+                return FATAL
+            if next == FAIL:
+                return end
+            end = next
+
+    def _r_delim(self, loc, regex):
+        s = self._s
+        loc = self._skip(loc)
+        m = regex.match(s, loc) or self._ambi_delim_re.match(s, loc)
+        if m is None:
+            return FAIL
+        return m.end()
+
+    def _r_autodelim(self, loc):
+        memo = self._autodelim_memo
+        result = memo.get(loc)
+        if result is None:
+            result = self._literal(loc, r'\left')
+            if result >= 0:
+                end = self._r_delim(result, self._left_delim_re)
+                if end < 0:
+                    end = self._skip(result)
+                end = self._longest(end, self._middle_rules)[0]
+                if end >= 0:
+                    end = self._literal(end, r'\right')
+                if end < 0:
+                    result = FAIL
+                else:
+                    result = self._r_delim(end, self._right_delim_re)
+                    if result < 0:
+                        result = self._skip(end)
+            memo[loc] = result
+        return result
+
+    def _r_item(self, loc):
+        memo = self._item_memo
+        result = memo.get(loc)
+        if result is None:
+            if self._s.startswith(r'\left', self._skip(loc)):
+                rules = self._item_rules
+            else:
+                rules = self._simple_only_rules
+            result = memo[loc] = self._longest(loc, rules)
+        return result[0]
+
+    #########################################################################
+    # AST construction
+    #
+    # Each construct becomes a tuple whose first element names it.  The
+    # Error elements of the grammar become ('error', message, location)
+    # nodes in place of the construct, so that they are raised during
+    # the layout at the point pyparsing would have raised them.
+
+    def _a_error(self, msg, loc):
+        return ('error', msg, self._skip(loc))
+
+    def _a_function(self, loc):
+        return ('function', self._command(loc, self._function_re).group())
+
+    def _a_symbol(self, loc):
+        s = self._s
+        loc = self._skip(loc)
+        m = self._command(loc, self._char_over_chars_re)
+        if m is not None:
+            return ('char_over_chars', m.group())
+        m = self._single_symbol(loc)
+        if m is not None:
+            return ('symbol', m.group())
+        return ('symbol', '\\' + self._command_re.match(s, loc + 1).group())
+
+    def _a_accent(self, loc):
+        m = self._command(loc, self._accent_re)
+        return ('accent', m.group(), self._a_placeable(m.end()))
+
+    def _latexfont_name(self, loc):
+        if self._r_latexfont(loc) < 0:
+            return None
+        return self._command(loc, self._latexfont_re).group()
+
+    def _a_group(self, loc):
+        items = []
+        start = self._r_start_group(loc)
+        end = self._r_item(start)
+        while end >= 0:
+            items.append(self._a_item(start))
+            start = end
+            end = self._r_item(start)
+        return ('group', self._latexfont_name(loc), tuple(items))
+
+    def _a_two_groups(self, loc, kind, command, msg):
+        start = self._literal(loc, command)
+        end = self._r_group(start)
+        if end < 0 or self._r_group(end) < 0:
+            return self._a_error(msg, start)
+        return (kind, self._a_group(start), self._a_group(end))
+
+    def _a_frac(self, loc):
+        return self._a_two_groups(
+            loc, 'frac', r'\frac', r"Expected \frac{num}{den}")
+
+    def _a_stackrel(self, loc):
+        return self._a_two_groups(
+            loc, 'stackrel', r'\stackrel', r"Expected \stackrel{num}{den}")
+
+    def _a_binom(self, loc):
+        return self._a_two_groups(
+            loc, 'binom', r'\binom', r"Expected \binom{num}{den}")
+
+    def _a_genfrac(self, loc):
+        s = self._s
+        start = self._literal(loc, r'\genfrac')
+        if self._r_genfrac_args(start) == FAIL:
+            return self._a_error(
+                r"Expected \genfrac{ldelim}{rdelim}{rulesize}{style}{num}{den}",
+                start)
+        node = ['genfrac']
+        for regex in (self._genfrac_ldelim_re, self._genfrac_rdelim_re,
+                      self._rule_re):
+            m = regex.match(s, self._skip(self._literal(start, '{')))
+            node.append(m.group())
+            start = self._literal(m.end(), '}')
+        for i in range(3):
+            node.append(self._a_group(start))
+            start = self._r_group(start)
+        return tuple(node)
+
+    def _a_sqrt(self, loc):
+        start = self._literal(loc, r'\sqrt')
+        root = None
+        end = self._r_root(start)
+        if end >= 0:
+            root = self._digits_re.match(
+                self._s, self._skip(self._literal(start, '['))).group()
+            start = end
+        if self._r_group(start) == FAIL:
+            return self._a_error("Expected \sqrt{value}", start)
+        return ('sqrt', root, self._a_group(start))
+
+    def _a_operatorname(self, loc):
+        start = self._literal(loc, r'\operatorname')
+        m = self._operatorname_re.match(
+            self._s, self._skip(self._r_start_group(start)))
+        if m is None or self._literal(m.end(), '}') < 0:
+            return self._a_error("Expected \operatorname{value}", start)
+        return ('operatorname', self._latexfont_name(start), m.group())
+
+    def _a_placeable(self, loc):
+        self._r_placeable(loc)
+        return self._placeable_memo[loc][1][1](self, loc)
+
+    def _a_space(self, loc):
+        return ('space', self._space_re.match(self._s, self._skip(loc)).group())
+
+    def _a_customspace(self, loc):
+        command = self._literal(loc, r'\hspace')
+        start = self._literal(command, '{')
+        if start < 0:
+            return self._a_error(r"Expected \hspace{n}", command)
+        m = self._float_re.match(self._s, self._skip(start))
+        return ('customspace', m.group())
+
+    def _a_font(self, loc):
+        return ('font', self._command(loc, self._font_re).group())
+
+    def _a_subsuper(self, loc):
+        # A sequence of the optional nucleus and (operator, placeable) pairs
+        toks = []
+        nucleus = self._r_placeable(loc)
+        if nucleus >= 0:
+            toks.append(self._a_placeable(loc))
+            op = self._skip(nucleus)
+        else:
+            op = self._skip(loc)
+        while self._is_subsuperop(op):
+            toks.append(self._s[op])
+            toks.append(self._a_placeable(op + 1))
+            op = self._skip(self._r_placeable(op + 1))
+        return ('subsuper', tuple(toks), self._skip(loc))
+
+    def _a_simple(self, loc):
+        self._r_simple(loc)
+        return self._simple_memo[loc][1][1](self, loc)
+
+    def _a_simples(self, loc):
+        items = []
+        end = self._r_simple(loc)
+        while end >= 0:
+            items.append(self._a_simple(loc))
+            loc = end
+            end = self._r_simple(loc)
+        return items
+
+    def _a_delim(self, loc, regex):
+        s = self._s
+        loc = self._skip(loc)
+        m = regex.match(s, loc) or self._ambi_delim_re.match(s, loc)
+        if m is None:
+            return self._a_error("Expected a delimiter", loc)
+        return m.group()
+
+    def _a_autodelim(self, loc):
+        start = self._literal(loc, r'\left')
+        front = self._a_delim(start, self._left_delim_re)
+        if isinstance(front, tuple):
+            return front
+        start = self._r_delim(start, self._left_delim_re)
+        end, rule = self._longest(start, self._middle_rules)
+        if rule is self._middle_rules[0]:
+            middle = (self._a_autodelim(start),)
+        else:
+            middle = tuple(self._a_simples(start))
+        # A missing right delimiter is only reported after the middle
+        # has been laid out, so it is kept in place of the delimiter
+        back = self._a_delim(self._literal(end, r'\right'),
+                             self._right_delim_re)
+        return ('autodelim', front, middle, back)
+
+    def _a_item(self, loc):
+        self._r_item(loc)
+        return self._item_memo[loc][1][1](self, loc)
+
+    def _a_expression(self):
+        s = self._s
+        items = []
+        loc = self._non_math_re.match(s).end()
+        items.append(('non_math', s[:loc]))
+        while True:
+            start = self._skip(loc)
+            if not s.startswith('$', start):
+                break
+            loc = start + 1
+            math = []
+            end = self._r_item(loc)
+            while end >= 0:
+                math.append(self._a_item(loc))
+                loc = end
+                end = self._r_item(loc)
+            if math:
+                items.append(('math', tuple(math)))
+            start = self._literal(loc, '$')
+            if start < 0:
+                items.append(self._a_error("Expected end of math '$'", loc))
+                break
+            loc = self._non_math_re.match(s, start).end()
+            items.append(('non_math', s[start:loc]))
+        # non_math only stops at a '$', so the whole string is consumed
+        return ('expression', s, tuple(items))
+
+    #########################################################################
+    # Layout
+    #
+    # The layout of each node calls the parse actions in the order
+    # pyparsing would and returns the resulting tokens.
+
+    def _act(self, action, toks):
+        """
+        Calls the parse action *action*, normalising its result to a
+        list of tokens.
+        """
+        result = action(self._s, 0, toks)
+        if isinstance(result, list):
+            return result
+        return [result]
+
+    def _layout(self, node):
+        if self.subtree_cache_size and node[0] in self._subtree_kinds:
+            return self._layout_cached(node)
+        return self._layout_rules[node[0]](self, node)
+
+    def _layout_cached(self, node):
+        """
+        Lays out *node* as :meth:`_layout` does, through the subtree
+        cache.  The boxes are kept by fonts object, as in
+        :class:`IncrementalMathtexParser`.
+        """
+        cache = self._subtree_cache
+        if cache is None or cache.maxsize != self.subtree_cache_size:
+            cache = self._subtree_cache = maxdict(self.subtree_cache_size)
+            # Each subtree has ids for its nodes
+            self._subtree_ids = maxdict(8 * self.subtree_cache_size)
+            self._node_ids = maxdict(8 * self.subtree_cache_size)
+            self._subtrees_seen = maxdict(self.subtree_cache_size)
+        state = self.get_state()
+        key = (self._subtree_id(node), state.font_output,
+               self._default_style, state.font, state.font_class,
+               state.fontsize, state.dpi)
+        toks = cache.get(key)
+        if toks is None:
+            self.subtree_misses += 1
+            toks = self._layout_rules[node[0]](self, node)
+            # Only subtrees which come up again are worth copying.  The
+            # boxes given out are shrunk and packed into others, so the
+            # cache keeps copies of its own
+            if key in self._subtrees_seen:
+                cache[key] = [tok.copy() for tok in toks]
+            else:
+                self._subtrees_seen[key] = True
+            self._subtree_fonts[state.font_output] = True
+            return toks
+        self.subtree_hits += 1
+        return [tok.copy() for tok in toks]
+
+    def _drop_destroyed(self, caches, fonts, index):
+        """
+        Drops the entries of each of *caches* for the fonts objects of
+        *fonts*, a weak mapping of those in their keys, which have been
+        destroyed since.  *index* is that of the fonts object in each
+        key.
+        """
+        for fonts_object in fonts.keys():
+            if fonts_object.destroyed:
+                for cache in caches:
+                    cache.drop([key for key in cache
+                                if key[index] is fonts_object])
+                del fonts[fonts_object]
+
+    def _subtree_id(self, node):
+        """
+        Returns a number which stands for the structure of *node*, a
+        node of the syntax tree or a tuple of them, leaving out where
+        it is in the expression.
+
+        Nodes are numbered in terms of the numbers of their children,
+        and the number of each node is kept with the node, so that
+        each node of a syntax tree is only looked at once however many
+        of the nodes enclosing it are looked up in the cache and however
+        often the tree is laid out.
+        """
+        entry = self._node_ids.get(id(node))
+        if entry is not None and entry[0] is node:
+            ident = entry[1]
+        else:
+            elements = node
+            if node and node[0] in ('subsuper', 'error'):
+                # Their last element is a location
+                elements = node[:-1]
+            parts = []
+            for x in elements:
+                if isinstance(x, tuple):
+                    x = self._subtree_id(x)
+                parts.append(x)
+            parts = tuple(parts)
+            ident = self._subtree_ids.get(parts)
+            if ident is None:
+                # Never reused, so the keys of forgotten ids do not match
+                # anything else
+                ident = self._subtree_ids[parts] = self._next_subtree_id
+                self._next_subtree_id += 1
+            self._node_ids[id(node)] = (node, ident)
+        return ident
+
+    def _l_error(self, node):
+        raise ParseFatalException(node[1] + "\n" + self._s)
+
+    def _l_symbol(self, node):
+        return self._act(self.symbol, [node[1]])
+
+    def _l_char_over_chars(self, node):
+        return self._act(self.char_over_chars, [node[1]])
+
+    def _l_function(self, node):
+        return self._act(self.function, [node[1]])
+
+    def _l_accent(self, node):
+        sym = self._layout(node[2])
+        return self._act(self.accent, [_Group([node[1]] + sym)])
+
+    def _l_start_group(self, latexfont):
+        if latexfont is None:
+            self._act(self.start_group, [])
+        else:
+            self._act(self.start_group, [latexfont])
+
+    def _l_group(self, node):
+        self._l_start_group(node[1])
+        toks = []
+        for item in node[2]:
+            toks.extend(self._layout(item))
+        self._act(self.end_group, [])
+        return self._act(self.group, [_Group(toks)])
+
+    def _l_frac(self, node):
+        num = self._layout(node[1])
+        den = self._layout(node[2])
+        return self._act(self.frac, [_Group(num + den)])
+
+    def _l_stackrel(self, node):
+        num = self._layout(node[1])
+        den = self._layout(node[2])
+        return self._act(self.stackrel, [_Group(num + den)])
+
+    def _l_binom(self, node):
+        num = self._layout(node[1])
+        den = self._layout(node[2])
+        return self._act(self.binom, [_Group(num + den)])
+
+    def _l_genfrac(self, node):
+        toks = list(node[1:4])
+        for group in node[4:]:
+            toks.extend(self._layout(group))
+        return self._act(self.genfrac, [_Group(toks)])
+
+    def _l_sqrt(self, node):
+        body = self._layout(node[2])
+        return self._act(self.sqrt, [_Group([node[1]] + body)])
+
+    def _l_operatorname(self, node):
+        self._l_start_group(node[1])
+        self._act(self.end_group, [])
+        return self._act(self.operatorname, [_Group([node[2]])])
+
+    def _l_space(self, node):
+        return self._act(self.space, [node[1]])
+
+    def _l_customspace(self, node):
+        return self._act(self.customspace, [r'\hspace', node[1]])
+
+    def _l_font(self, node):
+        return self._act(self.font, [node[1]])
+
+    def _l_subsuper(self, node):
+        toks = []
+        for tok in node[1]:
+            if isinstance(tok, tuple):
+                toks.extend(self._layout(tok))
+            else:
+                toks.append(tok)
+        return self._act(self.subsuperscript, [_Group(toks)])
+
+    def _l_autodelim(self, node):
+        kind, front, items, back = node
+        middle = []
+        for item in items:
+            middle.extend(self._layout(item))
+        if isinstance(back, tuple):
+            self._l_error(back)
+        return self._act(self.auto_sized_delimiter,
+                         [front, _Group(middle), back])
+
+    def _l_math(self, node):
+        toks = []
+        for item in node[1]:
+            toks.extend(self._layout(item))
+        return self._act(self.math, toks)
+
+    def _l_non_math(self, node):
+        return self._act(self.non_math, [node[1]])
+
+    def _l_expression(self, node):
+        toks = []
+        for item in node[2]:
+            toks.extend(self._layout(item))
+        self._act(self.finish, toks)
+
+    # The alternatives, as (recogniser, AST constructor) pairs, in the
+    # order they are listed in the grammar
+    _symbol_rules = ((_r_symbol, _a_symbol),)
+    _group_rules = ((_r_group, _a_group),)
+    _placeable_rules = ((_r_function, _a_function),
+                        (_r_symbol, _a_symbol),
+                        (_r_accent, _a_accent),
+                        (_r_group, _a_group),
+                        (_r_frac, _a_frac),
+                        (_r_stackrel, _a_stackrel),
+                        (_r_binom, _a_binom),
+                        (_r_genfrac, _a_genfrac),
+                        (_r_sqrt, _a_sqrt),
+                        (_r_operatorname, _a_operatorname))
+    _simple_rules = ((_r_space, _a_space),
+                     (_r_customspace, _a_customspace),
+                     (_r_font, _a_font),
+                     (_r_subsuper, _a_subsuper))
+    _middle_rules = ((_r_autodelim, _a_autodelim),
+                     (_r_simples, _a_simples))
+    _item_rules = ((_r_autodelim, _a_autodelim),
+                   (_r_simple, _a_simple))
+    _simple_only_rules = ((_r_simple, _a_simple),)
+
+    _layout_rules = {
+        'error'           : _l_error,
+        'symbol'          : _l_symbol,
+        'char_over_chars' : _l_char_over_chars,
+        'function'        : _l_function,
+        'accent'          : _l_accent,
+        'group'           : _l_group,
+        'frac'            : _l_frac,
+        'stackrel'        : _l_stackrel,
+        'binom'           : _l_binom,
+        'genfrac'         : _l_genfrac,
+        'sqrt'            : _l_sqrt,
+        'operatorname'    : _l_operatorname,
+        'space'           : _l_space,
+        'customspace'     : _l_customspace,
+        'font'            : _l_font,
+        'subsuper'        : _l_subsuper,
+        'autodelim'       : _l_autodelim,
+        'math'            : _l_math,
+        'non_math'        : _l_non_math,
+        'expression'      : _l_expression
+        }
+
+class IncrementalMathtexParser(FastMathtexParser):
+    """
+    A parser for live previews, where the same text is parsed again
+    after every edit.
+
+    The box of each ``$``-delimited segment of the text is kept and
+    only the segments whose text changed are parsed and laid out
+    again, so the cost of a parse grows with the size of the edit
+    rather than that of the text.  The boxes are kept by fonts object,
+    and dropped once it is destroyed.
+    """
+    # The number of segment boxes, and their number of nodes, kept around
+    _segment_cache_size = 500
+
+    def __init__(self):
+        FastMathtexParser.__init__(self)
+        self._segment_cache = maxdict(self._segment_cache_size)
+        # The fonts objects with boxes in the cache
+        self._segment_fonts = weakref.WeakKeyDictionary()
+
+    def parse(self, s, fonts_object, fontsize, dpi):
+        # The other limits are checked segment by segment
+        if self.max_length is not None and len(s) > self.max_length:
+            self._limit_exceeded('max_length')
+        # As pyparsing does
+        s = s.expandtabs()
+        segments = self._split(s)
+        if segments is None:
+            # Leave reporting the error to a full parse
+            return FastMathtexParser.parse(self, s, fonts_object, fontsize, dpi)
+        return self._collect_diagnostics(self._parse_segments, s, segments,
+                                         fonts_object, fontsize, dpi)
+
+    def _parse_segments(self, s, segments, fonts_object, fontsize, dpi):
+        """
+        Lays out *s*, split into *segments*, reusing the boxes of the
+        segments laid out before.
+        """
+        self._drop_destroyed([self._segment_cache], self._segment_fonts, 0)
+        key = (fonts_object, fonts_object.default_style, fontsize, dpi)
+        toks = []
+        nodes = 0
+        # An empty math segment does not pop the state pushed by the
+        # preceding text, which then applies to the text that follows
+        after_empty_math = False
+        for is_math, text in segments:
+            if is_math and not text.strip(self._whitespace):
+                after_empty_math = True
+                continue
+            segment = key + (is_math, text, after_empty_math and not is_math)
+            cached = self._segment_cache.get(segment)
+            if cached is not None:
+                box, segment_nodes = cached
+            elif is_math:
+                segment_nodes = self.check_limits('$' + text + '$')
+            else:
+                segment_nodes = len(text)
+            # Before any layout, as check_limits() would
+            nodes += segment_nodes
+            if self.max_nodes is not None and nodes > self.max_nodes:
+                self._limit_exceeded('max_nodes')
+            if cached is None:
+                box = self._layout_segment(segment)
+                if box is None:
+                    # Leave reporting the error to a full parse
+                    return FastMathtexParser.parse(
+                        self, s, fonts_object, fontsize, dpi)
+                self._segment_cache[segment] = (box, segment_nodes)
+                self._segment_fonts[fonts_object] = True
+            toks.append(box)
+
+        expr = self.finish(s, 0, toks)[0]
+        self.clear()
+        return expr
+
+    def _split(self, s):
+        """
+        Splits *s* into a list of (is_math, text) segments, or returns
+        None if the last math segment is not terminated.
+        """
+        segments = []
+        n = len(s)
+        loc = 0
+        is_math = False
+        while True:
+            end = self._non_math_re.match(s, loc).end()
+            segments.append((is_math, s[loc:end]))
+            if end == n:
+                if is_math:
+                    return None
+                return segments
+            loc = end + 1
+            is_math = not is_math
+
+    def _layout_segment(self, segment):
+        """
+        Lays out a segment as :meth:`parse` would within the whole
+        text, returning its box or None if it has errors.
+        """
+        fonts_object, default_style, fontsize, dpi, is_math, text, \
+            after_empty_math = segment
+        if is_math:
+            ast = self.parse_ast('$' + text + '$')
+            if ast[2] != (('non_math', ''), ast[2][1], ('non_math', '')):
+                return None
+            node = ast[2][1]
+        else:
+            node = ('non_math', text)
+
+        self.clear()
+        self._s = text
+        self._default_style = default_style
+        self._state_stack = [self.State(fonts_object, 'default', 'rm', fontsize, dpi)]
+        if is_math or after_empty_math:
+            # The state non_math() leaves behind
+            self.push_state(self.get_state().with_font(self._default_style))
+        try:
+            box = self._layout(node)[0]
+        except ParseFatalException:
+            box = None
+        self.clear()
+        return box
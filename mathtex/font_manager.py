@@ -55,7 +55,7 @@ try:
 except ImportError:
     from matplotlib import ft2font
 
-from mathtex.util import get_configdir, get_datadir, is_string_like
+from mathtex.util import get_configdir, get_datadir, is_string_like, maxdict
 
 # For the fontconfig pattern parser
 import re
@@ -1325,6 +1325,9 @@ family_punc = r'\\\-:,'
 family_unescape = re.compile(r'\\([%s])' % family_punc).sub
 family_escape = re.compile(r'([%s])' % family_punc).sub
 
+# A pattern which is only a family name, needing no parsing
+plain_family = re.compile(r'[^%s\s][^%s\t]*\Z' % (family_punc, family_punc))
+
 value_punc = r'\\=_:,'
 value_unescape = re.compile(r'\\([%s])' % value_punc).sub
 value_escape = re.compile(r'([%s])' % value_punc).sub
@@ -1411,6 +1414,7 @@ class FontconfigPatternParser:
 
         self._parser = pattern
         self.ParseException = ParseException
+        self._cache = maxdict(100)
 
     def parse(self, pattern):
         """
@@ -1418,14 +1422,19 @@ class FontconfigPatternParser:
         of key/value pairs useful for initializing a
         :class:`font_manager.FontProperties` object.
         """
-        props = self._properties = {}
-        try:
-            self._parser.parseString(pattern)
-        except self.ParseException, e:
-            raise ValueError("Could not parse font string: '%s'\n%s" % (pattern, e))
-
-        self._properties = None
-        return props
+        props = self._cache.get(pattern)
+        if props is None:
+            if plain_family.match(pattern):
+                props = {'family': [str(pattern)]}
+            else:
+                props = self._properties = {}
+                try:
+                    self._parser.parseString(pattern)
+                except self.ParseException, e:
+                    raise ValueError("Could not parse font string: '%s'\n%s" % (pattern, e))
+                self._properties = None
+            self._cache[pattern] = props
+        return dict([(key, list(val)) for key, val in props.items()])
 
     def _family(self, s, loc, tokens):
         return [family_unescape(r'\1', str(tokens[0]))]
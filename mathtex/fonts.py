@@ -1,16 +1,25 @@
-from mathtex.util import Bunch
+from mathtex.util import Bunch, get_configdir, maxdict
 from mathtex.data import latex_to_bakoma, \
         latex_to_standard, tex2uni, latex_to_cmex, stix_virtual_fonts
 
 from mathtex.font_manager import findfont, FontProperties
 
 try:
-    from mathtex.ft2font import FT2Font, KERNING_DEFAULT
+    from mathtex.ft2font import FT2Font, KERNING_DEFAULT, LOAD_NO_HINTING
 except ImportError:
-    from matplotlib.ft2font import FT2Font, KERNING_DEFAULT
+    from matplotlib.ft2font import FT2Font, KERNING_DEFAULT, LOAD_NO_HINTING
 
 from warnings import warn
+import atexit
+import os
+import tempfile
+import threading
 import unicodedata
+import weakref
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 def get_unicode_index(symbol):
     """
@@ -41,10 +50,72 @@ TeX/Type1 symbol"""%locals()
 class MathTexWarning(Warning):
     pass
 
+# A FreeType face has a single current size, which loading glyphs and
+# looking up kerning depend on.  As fontsets are shared between threads
+# (see get_fontset), the size is set and used while holding this lock.
+_freetype_lock = threading.Lock()
+
+# The FreeType faces of the font files, with their character maps, by
+# path.  They are shared by all fontsets, each counting as one user of
+# the faces it has opened until it is destroyed or collected.  The lock
+# is reentrant, as a collection, and the release of the faces of the
+# fontsets collected, may happen while it is held.
+_faces = {}
+_faces_lock = threading.RLock()
+
+# Weak references to the fontsets using faces, whose callbacks give up
+# their uses of the faces once they are collected
+_face_users = set()
+
+def _open_face(filename):
+    """
+    Returns the shared :class:`TruetypeFonts.CachedFont` of the font
+    file *filename*, opening it if it is not in use.
+    """
+    _faces_lock.acquire()
+    try:
+        entry = _faces.get(filename)
+        if entry is None:
+            cached_font = TruetypeFonts.CachedFont(FT2Font(filename))
+            cached_font.filename = filename
+            entry = _faces[filename] = [cached_font, 0]
+        entry[1] += 1
+        return entry[0]
+    finally:
+        _faces_lock.release()
+
+def _close_face(filename):
+    """
+    Gives up one use of the face of *filename*, dropping it once it is
+    no longer used.
+    """
+    _faces_lock.acquire()
+    try:
+        entry = _faces[filename]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _faces[filename]
+    finally:
+        _faces_lock.release()
+
+def _face_releaser(face_files):
+    """
+    Returns the callback of the weak reference to a fontset, which
+    gives up the uses of the faces of *face_files* left once the
+    fontset is collected.
+    """
+    def release(ref):
+        _face_users.discard(ref)
+        while face_files:
+            _close_face(face_files.pop())
+    return release
+
 class Fonts(object):
     """
     An abstract base class for a system of fonts used by Mathtex.
     """
+    # Set by destroy()
+    destroyed = False
 
     def __init__(self, default_style = 'it'):
         self.used_characters = {}
@@ -67,39 +138,251 @@ class Fonts(object):
     def get_used_characters(self):
         return self.used_characters
 
+    def destroy(self):
+        """
+        Releases the fonts this fontset holds on to.  It can not be
+        used afterwards.
+        """
+        self.destroyed = True
+
     def get_sized_alternatives_for_symbol(self, fontname, sym):
         return [(fontname, sym)]
 
+class MetricsCache(object):
+    """
+    A persistent store of the metrics of glyphs, as FreeType gives them
+    for each size and dpi, which :meth:`TruetypeFonts._get_info` looks
+    in before loading a glyph, once installed with
+    :func:`set_metrics_cache`.
+
+    The metrics of each font file are kept in a file of *directory*,
+    by default ``metrics`` in the mathtex configuration directory,
+    named by the MD5 digest of the font file, so that those of a font
+    file which has since changed are no longer used.  Metrics looked up
+    since the cache was created are written out by :meth:`save`, which
+    is also called at exit for the installed cache.
+
+    The files hold a line of numbers for each glyph, size and dpi, and
+    are only read as such, so a file of the directory written by
+    anything else does no more than spoil the cache; a file which is not
+    made of such lines is ignored.  At most *max_entries* metrics are
+    kept for each font file, the oldest being dropped first.
+    """
+    # The first line of the files, to be changed with their format
+    _header = 'mathtex glyph metrics 1\n'
+    # The number of numbers on each line: the glyph index, font size and
+    # dpi, followed by the metrics
+    _fields = 11
+
+    def __init__(self, directory=None, max_entries=20000):
+        if directory is None:
+            directory = os.path.join(get_configdir(), 'metrics')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_entries = max_entries
+        # The digest of each font file, the metrics by digest, each by
+        # (glyph index, font size, dpi), and the digests with new ones
+        self._digests = {}
+        self._metrics = {}
+        self._changed = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + '.metrics')
+
+    def _load(self, digest):
+        table = maxdict(self.max_entries)
+        try:
+            fh = open(self._path(digest), 'r')
+        except IOError:
+            return table
+        try:
+            try:
+                if fh.readline() != self._header:
+                    raise ValueError
+                for line in fh:
+                    values = [float(value) for value in line.split()]
+                    if len(values) != self._fields:
+                        raise ValueError
+                    for value in values:
+                        # Neither infinite nor NaN
+                        if value - value != 0:
+                            raise ValueError
+                    num = int(values[0])
+                    if num != values[0] or num < 0:
+                        raise ValueError
+                    table[(num, values[1], values[2])] = tuple(values[3:])
+            except ValueError:
+                # A file cut short by a crash, or written by anything
+                # else, is simply started over
+                return maxdict(self.max_entries)
+        finally:
+            fh.close()
+        return table
+
+    def _table(self, filename):
+        digest = self._digests.get(filename)
+        if digest is None:
+            fh = open(filename, 'rb')
+            try:
+                digest = md5(fh.read()).hexdigest()
+            finally:
+                fh.close()
+            self._digests[filename] = digest
+        table = self._metrics.get(digest)
+        if table is None:
+            self._lock.acquire()
+            try:
+                table = self._metrics.get(digest)
+                if table is None:
+                    table = self._metrics[digest] = self._load(digest)
+            finally:
+                self._lock.release()
+        return digest, table
+
+    def get(self, filename, num, fontsize, dpi):
+        """
+        Returns the metrics of glyph *num* of the font file *filename*
+        at *fontsize* and *dpi*, or None if they are not known.
+        """
+        metrics = self._table(filename)[1].get((num, fontsize, dpi))
+        if metrics is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return metrics
+
+    def set(self, filename, num, fontsize, dpi, metrics):
+        """
+        Stores the *metrics* of glyph *num* of the font file *filename*
+        at *fontsize* and *dpi*.
+        """
+        digest, table = self._table(filename)
+        self._lock.acquire()
+        try:
+            table[(num, fontsize, dpi)] = metrics
+            self._changed.add(digest)
+        finally:
+            self._lock.release()
+
+    def save(self):
+        """
+        Writes out the metrics of the font files which have new ones,
+        along with those other processes have written since.
+        """
+        self._lock.acquire()
+        try:
+            for digest in list(self._changed):
+                # Those of this process last, oldest first, so they
+                # are kept over those of others if there are too many
+                table = self._load(digest)
+                metrics = self._metrics[digest]
+                for key in metrics._killkeys:
+                    table[key] = metrics[key]
+                # Written to a new file and moved into place, so that
+                # readers never see it half written
+                fd, path = tempfile.mkstemp(dir=self.directory)
+                fh = os.fdopen(fd, 'w')
+                try:
+                    fh.write(self._header)
+                    # Oldest first, as they are read back
+                    for key in table._killkeys:
+                        fh.write(' '.join(['%.17g' % value
+                                           for value in key + table[key]]))
+                        fh.write('\n')
+                finally:
+                    fh.close()
+                os.rename(path, self._path(digest))
+            self._changed.clear()
+        finally:
+            self._lock.release()
+
+_metrics_cache = None
+
+def set_metrics_cache(metrics_cache):
+    """
+    Sets the :class:`MetricsCache` glyph metrics are looked up in, or
+    None for none, and returns the one set before.  The one set at
+    exit is saved.
+    """
+    global _metrics_cache
+    previous = _metrics_cache
+    _metrics_cache = metrics_cache
+    return previous
+
+def _save_metrics_cache():
+    if _metrics_cache is not None:
+        _metrics_cache.save()
+atexit.register(_save_metrics_cache)
+
 # Legacy Matplotlib font definitions
 
 class TruetypeFonts(Fonts):
     """
     A generic base class for all font setups that use Truetype fonts
     (through FT2Font).
+
+    With *unscaled_metrics* set, before the fontset is first used, the
+    metrics of each glyph are loaded from FreeType once, unhinted, and
+    worked out for each size and dpi from those, rather than loaded for
+    each one.  Unhinted metrics are not rounded to whole pixels, so the
+    layout differs slightly from the default one.
     """
+    unscaled_metrics = False
+
+    # The number of glyph infos and kerning pairs kept, by font, size
+    # and dpi; each size and dpi of the test corpus takes some 220
+    # glyphs and 140 pairs.  Shared fontsets are used for any number
+    # of sizes, so these are bounded.
+    _glyph_cache_size = 10000
+    _kern_cache_size = 10000
+
     class CachedFont:
         def __init__(self, font):
             self.font     = font
             self.charmap  = font.get_charmap()
             self.glyphmap = dict(
                 [(glyphind, ccode) for ccode, glyphind in self.charmap.iteritems()])
+            # The metrics of each glyph in font units, for unscaled_metrics
+            self.unscaled = {}
 
         def __repr__(self):
             return repr(self.font)
 
     def __init__(self, *args, **kwargs):
         Fonts.__init__(self, *args, **kwargs)
-        self.glyphd = {}
+        self.glyphd = maxdict(self._glyph_cache_size)
+        self.kernd = maxdict(self._kern_cache_size)
+        # Held while adding to them, as maxdict drops the oldest
+        # entries, which is not atomic
+        self._cache_lock = threading.Lock()
         self._fonts = {}
+        # The files of the shared faces in self._fonts, given up by
+        # destroy() or once the fontset is collected
+        self._face_files = []
+        _face_users.add(weakref.ref(self, _face_releaser(self._face_files)))
 
-        filename = findfont('vera')
-        default_font = self.CachedFont(FT2Font(str(filename)))
+        default_font = self._open_face(str(findfont('vera')))
         self._fonts['default'] = self._fonts['regular'] = default_font
 
     def destroy(self):
+        # Emptied rather than replaced, as the weak reference's
+        # callback holds on to the list
+        while self._face_files:
+            _close_face(self._face_files.pop())
+        self._fonts = None
         self.glyphd = None
+        self.kernd = None
         Fonts.destroy(self)
 
+    def _open_face(self, filename):
+        cached_font = _open_face(filename)
+        self._face_files.append(filename)
+        return cached_font
+
     def _get_font(self, font):
         if font in self.fontmap:
             basename = self.fontmap[font]
@@ -108,18 +391,42 @@ class TruetypeFonts(Fonts):
 
         cached_font = self._fonts.get(basename)
         if cached_font is None:
-            font = FT2Font(str(basename))
-            cached_font = self.CachedFont(font)
+            cached_font = self._open_face(str(basename))
+            font = cached_font.font
             self._fonts[basename] = cached_font
             self._fonts[font.postscript_name] = cached_font
             self._fonts[font.postscript_name.lower()] = cached_font
         return cached_font
 
-    def _get_offset(self, cached_font, glyph, fontsize, dpi):
+    def _get_offset(self, cached_font, glyph_height, fontsize, dpi):
         if cached_font.font.postscript_name == 'Cmex10':
-            return glyph.height/64.0/2.0 + 256.0/64.0 * dpi/72.0
+            return glyph_height/64.0/2.0 + 256.0/64.0 * dpi/72.0
         return 0.
 
+    def _get_unscaled_metrics(self, cached_font, num):
+        """
+        Returns the metrics of glyph *num* of *cached_font* in font
+        units, as :meth:`_get_info` takes them, loaded unhinted at the
+        size at which a 26.6 pixel is a font unit.
+        """
+        glyph_metrics = cached_font.unscaled.get(num)
+        if glyph_metrics is None:
+            font = cached_font.font
+            _freetype_lock.acquire()
+            try:
+                font.set_size(font.units_per_EM / 64.0, 72)
+                glyph = font.load_char(num, flags=LOAD_NO_HINTING)
+                # linearHoriAdvance is in 16.16 pixels
+                glyph_metrics = \
+                    (glyph.linearHoriAdvance / 1024.0, glyph.height,
+                     glyph.width, glyph.horiBearingY) + tuple(glyph.bbox)
+                # The face keeps each glyph loaded until cleared
+                font.clear()
+            finally:
+                _freetype_lock.release()
+            cached_font.unscaled[num] = glyph_metrics
+        return glyph_metrics
+
     def _get_info(self, fontname, font_class, sym, fontsize, dpi):
         key = fontname, font_class, sym, fontsize, dpi
         bunch = self.glyphd.get(key)
@@ -130,40 +437,77 @@ class TruetypeFonts(Fonts):
             self._get_glyph(fontname, font_class, sym, fontsize)
 
         font = cached_font.font
-        font.set_size(fontsize, dpi)
-        glyph = font.load_char(num)
-
-        xmin, ymin, xmax, ymax = [val/64.0 for val in glyph.bbox]
-        offset = self._get_offset(cached_font, glyph, fontsize, dpi)
+        # The glyph is only loaded if its metrics are neither worked out
+        # from the unscaled ones nor in the metrics cache
+        glyph_metrics = None
+        metrics_cache = _metrics_cache
+        if self.unscaled_metrics:
+            # From font units to 26.6 pixels, and 16.16 for the advance
+            scale = fontsize * dpi * 64.0 / (72.0 * font.units_per_EM)
+            unscaled = self._get_unscaled_metrics(cached_font, num)
+            glyph_metrics = [unscaled[0] * scale * 1024.0] + \
+                            [val * scale for val in unscaled[1:]]
+        elif metrics_cache is not None:
+            glyph_metrics = metrics_cache.get(
+                cached_font.filename, num, fontsize, dpi)
+        if glyph_metrics is None:
+            _freetype_lock.acquire()
+            try:
+                font.set_size(fontsize, dpi)
+                glyph = font.load_char(num)
+                glyph_metrics = (glyph.linearHoriAdvance, glyph.height,
+                                 glyph.width, glyph.horiBearingY) + \
+                                 tuple(glyph.bbox)
+                # The face keeps each glyph loaded until cleared, and
+                # the backends load the glyphs they draw themselves
+                font.clear()
+            finally:
+                _freetype_lock.release()
+            if metrics_cache is not None:
+                metrics_cache.set(cached_font.filename, num, fontsize, dpi,
+                                  glyph_metrics)
+
+        linear_advance, height, width, bearing = glyph_metrics[:4]
+        xmin, ymin, xmax, ymax = [val/64.0 for val in glyph_metrics[4:]]
+        offset = self._get_offset(cached_font, height, fontsize, dpi)
         metrics = Bunch(
-            advance = glyph.linearHoriAdvance/65536.0,
-            height  = glyph.height/64.0,
-            width   = glyph.width/64.0,
+            advance = linear_advance/65536.0,
+            height  = height/64.0,
+            width   = width/64.0,
             xmin    = xmin,
             xmax    = xmax,
             ymin    = ymin+offset,
             ymax    = ymax+offset,
             # iceberg is the equivalent of TeX's "height"
-            iceberg = glyph.horiBearingY/64.0 + offset,
+            iceberg = bearing/64.0 + offset,
             slanted = slanted
             )
 
-        result = self.glyphd[key] = Bunch(
+        result = Bunch(
             font            = font,
             fontsize        = fontsize,
+            dpi             = dpi,
             postscript_name = font.postscript_name,
             metrics         = metrics,
             symbol_name     = symbol_name,
             num             = num,
-            glyph           = glyph,
             offset          = offset
             )
+        self._cache_lock.acquire()
+        try:
+            self.glyphd[key] = result
+        finally:
+            self._cache_lock.release()
         return result
 
     def get_xheight(self, font, fontsize, dpi):
         cached_font = self._get_font(font)
-        cached_font.font.set_size(fontsize, dpi)
-        pclt = cached_font.font.get_sfnt_table('pclt')
+        _freetype_lock.acquire()
+        try:
+            cached_font.font.set_size(fontsize, dpi)
+            pclt = cached_font.font.get_sfnt_table('pclt')
+        finally:
+            _freetype_lock.release()
         if pclt is None:
             # Some fonts don't store the xHeight, so we do a poor man's xHeight
             metrics = self.get_metrics(font, self.default_style, 'x', fontsize, dpi)
@@ -180,10 +524,26 @@ class TruetypeFonts(Fonts):
     def get_kern(self, font1, fontclass1, sym1, fontsize1,
                  font2, fontclass2, sym2, fontsize2, dpi):
         if font1 == font2 and fontsize1 == fontsize2:
-            info1 = self._get_info(font1, fontclass1, sym1, fontsize1, dpi)
-            info2 = self._get_info(font2, fontclass2, sym2, fontsize2, dpi)
-            font = info1.font
-            return font.get_kerning(info1.num, info2.num, KERNING_DEFAULT) / 64.0
+            # Long runs of text look up the same pairs over and over
+            key = font1, fontclass1, sym1, fontclass2, sym2, fontsize1, dpi
+            kern = self.kernd.get(key)
+            if kern is None:
+                info1 = self._get_info(font1, fontclass1, sym1, fontsize1, dpi)
+                info2 = self._get_info(font2, fontclass2, sym2, fontsize2, dpi)
+                font = info1.font
+                _freetype_lock.acquire()
+                try:
+                    font.set_size(fontsize1, dpi)
+                    kern = font.get_kerning(info1.num, info2.num,
+                                            KERNING_DEFAULT) / 64.0
+                finally:
+                    _freetype_lock.release()
+                self._cache_lock.acquire()
+                try:
+                    self.kernd[key] = kern
+                finally:
+                    self._cache_lock.release()
+            return kern
         return Fonts.get_kern(self, font1, fontclass1, sym1, fontsize1,
                               font2, fontclass2, sym2, fontsize2, dpi)
 
@@ -213,6 +573,9 @@ class BakomaFonts(TruetypeFonts):
             self.fontmap[key] = fullpath
             self.fontmap[val] = fullpath
 
+    def destroy(self):
+        self._stix_fallback.destroy()
+        TruetypeFonts.destroy(self)
 
     _slanted_symbols = set(r"\int \oint".split())
 
@@ -342,6 +705,11 @@ class UnicodeFonts(TruetypeFonts):
         font = findfont(prop)
         self.fontmap['ex'] = font
 
+    def destroy(self):
+        if self.cm_fallback:
+            self.cm_fallback.destroy()
+        TruetypeFonts.destroy(self)
+
     _slanted_symbols = set(r"\int \oint".split())
 
     def _map_virtual_font(self, fontname, font_class, uniindex):
@@ -539,3 +907,30 @@ class StixFonts(UnicodeFonts):
 class StixSansFonts(StixFonts):
     _sans = True
 
+
+# Building a fontset opens its font files and looks each of them up, and
+# it only gets fast once its metrics caches have filled.  Fontsets are
+# therefore kept around and shared, by all threads, as laying out does
+# not change them other than through those caches.
+_fontsets = {}
+_fontsets_lock = threading.Lock()
+
+def get_fontset(fontset_class, default_style='it', **kwargs):
+    """
+    Returns the shared instance of *fontset_class* for *default_style*
+    and the font keyword arguments *kwargs* (those of
+    :class:`UnicodeFonts`), creating it on first use, and again if it
+    has been destroyed.
+    """
+    key = (fontset_class, default_style, tuple(sorted(kwargs.items())))
+    fontset = _fontsets.get(key)
+    if fontset is None or fontset.destroyed:
+        _fontsets_lock.acquire()
+        try:
+            fontset = _fontsets.get(key)
+            if fontset is None or fontset.destroyed:
+                fontset = _fontsets[key] = \
+                    fontset_class(default_style, **kwargs)
+        finally:
+            _fontsets_lock.release()
+    return fontset
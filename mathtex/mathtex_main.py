@@ -1,6 +1,7 @@
 # Main parser
-from mathtex.parser import MathtexParser
-from mathtex.boxmodel import ship
+from mathtex.parser import MathtexParser, get_parser
+from mathtex.fastparser import FastMathtexParser, IncrementalMathtexParser
+from mathtex.boxmodel import Ship
 from mathtex.util import is_string_like, maxdict
 
 # Might not have Py Cairo installed
@@ -15,7 +16,7 @@ from mathtex.backends.backend_image import MathtexBackendImage
 
 # Fontsets
 from mathtex.fonts import BakomaFonts, UnicodeFonts, StixFonts,\
-                          StixSansFonts
+                          StixSansFonts, get_fontset
 
 class Mathtex:
     fontset_mapping = {
@@ -25,29 +26,40 @@ class Mathtex:
         'stix'    : StixFonts,
         'stixsans': StixSansFonts
         }
+    parser_mapping = {
+        'pyparsing'   : MathtexParser,
+        'fast'        : FastMathtexParser,
+        'incremental' : IncrementalMathtexParser
+        }
     _cache = maxdict(50)
 
     def __init__(self, expr, fontset = 'bakoma', fontsize = 12, dpi = 100,
-                       default_style = 'it', cache=False):
+                       default_style = 'it', cache=False, parser='pyparsing'):
         # Hash the arguments
-        h = hash((expr, fontset, fontsize, dpi, default_style))
+        h = hash((expr, fontset, fontsize, dpi, default_style, parser))
 
         if is_string_like(fontset):
-            fontset = self.fontset_mapping[fontset](default_style)
+            # Shared, so that its metrics stay cached between calls
+            fontset = get_fontset(self.fontset_mapping[fontset],
+                                  default_style)
 
         # Check the cache first
         if cache and h in self._cache:
-            self.boxmodel = self._cache[h]
+            self.boxmodel, self.diagnostics = self._cache[h]
         # Parse the expression
         else:
-            self.boxmodel = MathtexParser().parse(expr, fontset, fontsize,
-                                                  dpi)
+            parser = get_parser(self.parser_mapping[parser])
+            self.boxmodel = parser.parse(expr, fontset, fontsize, dpi)
+            # The overfull and underfull lists met laying it out
+            self.diagnostics = parser.diagnostics
             if cache:
-                self._cache[h] = self.boxmodel
+                self._cache[h] = (self.boxmodel, self.diagnostics)
 
-        # Use ship to get a stream of glyphs and rectangles
-        bbox = ship(0, 0, self.boxmodel)[2]
-        self.rects, self.glyphs, bbox = ship(-bbox[0], 0, self.boxmodel)
+        # Ship the box to get a stream of glyphs and rectangles, with
+        # the left edge of their bounding box at zero
+        self._shipped = Ship(self.boxmodel)
+        self.rects, self.glyphs, bbox = \
+            self._shipped.output(-self._shipped.bbox[0], 0)
 
         # Calculate the exact width, height and depth
         self.width = bbox[2] - bbox[0]
@@ -58,6 +70,13 @@ class Mathtex:
         self.fontsize = fontsize
         self.dpi = dpi
 
+    def as_display_list(self):
+        """
+        Returns the glyphs and rectangles as a
+        :class:`~mathtex.boxmodel.DisplayList` of numpy arrays.
+        """
+        return self._shipped.display_list(-self._shipped.bbox[0], 0)
+
     def render_to_backend(self, backend):
         backend.set_canvas_size(self.width, self.height, self.depth, self.dpi)
         backend.render(self.glyphs, self.rects)
@@ -1,8 +1,20 @@
+import re
+import sys
+import threading
+import weakref
+
 from mathtex.pyparsing import Combine, Group, Optional, Forward, Literal, \
     OneOrMore, ZeroOrMore, ParseException, Empty, ParseResults, Suppress, \
-    oneOf, StringEnd, FollowedBy, Regex, ParserElement, ParseFatalException
-# Enable packrat parsing, this gives a ~2x speed-up
-ParserElement.enablePackrat()
+    oneOf, StringEnd, FollowedBy, Regex, ParserElement, ParseFatalException, \
+    Token, Or
+# Enable packrat parsing, this gives a ~2x speed-up.  The cache is
+# emptied at the start of each parse, so holds the results of a single
+# expression: at most 3262 for the test corpus, which a bound of 4096
+# would never reach, while one of 1024 costs 2% more misses and one of
+# 256 16% more.  Applications parsing very long expressions may bound
+# it with ParserElement.enablePackrat(size)
+PACKRAT_CACHE_SIZE = None
+ParserElement.enablePackrat(PACKRAT_CACHE_SIZE)
 
 from mathtex.boxmodel import *
 from mathtex.fonts import *
@@ -26,6 +38,158 @@ def Error(msg):
     empty.setParseAction(raise_error)
     return empty
 
+class Longest(Or):
+    """
+    Matches the longest of a list of alternatives, as ``Or`` does, but
+    only tries those which could match: each alternative is given as a
+    pair of the regular expression its match must start with, or None,
+    and the alternative itself.
+
+    When only one alternative could match it is not tried, but matched
+    straight away.  ``Or`` turns syntax errors in its trials into plain
+    mismatches, and only runs the parse actions, including those raising
+    :func:`Error`, of the alternative it picks, so in that case an error
+    other than a mismatch is only raised if the trial would have matched.
+    """
+    def __init__(self, alternatives):
+        Or.__init__(self, [expr for start, expr in alternatives])
+        self.starts = [start is not None and re.compile(start) or None
+                       for start, expr in alternatives]
+
+    def parseImpl(self, instring, loc, doActions=True):
+        # The alternatives skip whitespace themselves, and may be called
+        # without it having been skipped
+        first = self.preParse(instring, loc)
+        candidates = [expr for start, expr in zip(self.starts, self.exprs)
+                      if start is None or start.match(instring, first)]
+        if len(candidates) == 1:
+            expr = candidates[0]
+            try:
+                return expr._parse(instring, loc, doActions)
+            except ParseException:
+                raise
+            except Exception:
+                error = sys.exc_info()
+                expr.tryParse(instring, loc)
+                raise error[0], error[1], error[2]
+
+        end = -1
+        for expr in candidates:
+            try:
+                loc2 = expr.tryParse(instring, loc)
+            except (ParseException, IndexError):
+                continue
+            if loc2 > end:
+                end = loc2
+                best = expr
+        if end < 0:
+            raise ParseException(instring, loc, self.errmsg, self)
+        return best._parse(instring, loc, doActions)
+
+class Names(Token):
+    """
+    Matches the longest of *names*, as ``oneOf(names)`` does, by
+    walking a trie of the names instead of trying a regular expression
+    alternative for each of them.
+
+    If given, *prefix* must precede the name and is part of the match,
+    while the regular expression *follow* must match after it.
+    """
+    def __init__(self, names, prefix='', follow=None):
+        Token.__init__(self)
+        self.trie = {}
+        for name in names:
+            node = self.trie
+            for c in name:
+                node = node.setdefault(c, {})
+            # The empty string marks the end of a name
+            node[''] = True
+        self.prefix = prefix
+        self.follow = follow is not None and re.compile(follow) or None
+        self.name = 'Names(%s%s)' % (prefix, '|'.join(sorted(names)[:3] + ['...']))
+        self.errmsg = "Expected " + self.name
+        self.mayReturnEmpty = not prefix and '' in self.trie
+        self.mayIndexError = False
+
+    def match(self, s, loc):
+        """
+        Returns the end of the match at *loc* in *s*, or -1.
+        """
+        if not s.startswith(self.prefix, loc):
+            return -1
+        loc += len(self.prefix)
+        end = -1
+        n = len(s)
+        node = self.trie
+        while node is not None:
+            if '' in node:
+                end = loc
+            if loc >= n:
+                break
+            node = node.get(s[loc])
+            loc += 1
+        if end >= 0 and self.follow is not None and \
+                self.follow.match(s, end) is None:
+            return -1
+        return end
+
+    def parseImpl(self, instring, loc, doActions=True):
+        end = self.match(instring, loc)
+        if end < 0:
+            raise ParseException(instring, loc, self.errmsg, self)
+        return end, instring[loc:end]
+
+class SingleSymbol(Regex):
+    """
+    Matches a symbol of a single character: ASCII letters, digits and
+    punctuation, any non-ASCII character up to U+1FFFF, or one of the
+    escaped characters.
+    """
+    # Compiling a character class for U+0080 to U+1FFFF takes the re
+    # module tens of milliseconds, so all non-ASCII characters are
+    # matched, and those past U+1FFFF turned away afterwards
+    pattern = UR"([a-zA-Z0-9 +\-*/<>=:,.;!'@()\[\]|]|[^\x00-\x7f])|(\\[%${}\[\]_|])"
+    max_code = 0x1ffff
+
+    def __init__(self):
+        Regex.__init__(self, self.pattern)
+
+    def parseImpl(self, instring, loc, doActions=True):
+        result = Regex.parseImpl(self, instring, loc, doActions)
+        if result[0] == loc + 1 and ord(instring[loc]) > self.max_code:
+            raise ParseException(instring, loc, self.errmsg, self)
+        return result
+
+class RuleCounter(object):
+    """
+    Counts how many times each rule of the grammar is attempted, and
+    how many of those attempts match, showing where parsing does work
+    which is thrown away.  See :meth:`MathtexParser.count_rules`.
+    Attempts answered from the packrat cache are not counted.
+    """
+    def __init__(self):
+        self.attempts = {}
+        self.matches = {}
+
+    def attempt(self, s, loc, expr):
+        self.attempts[expr.name] = self.attempts.get(expr.name, 0) + 1
+
+    def match(self, s, start, end, expr, toks):
+        self.matches[expr.name] = self.matches.get(expr.name, 0) + 1
+
+    def mismatch(self, s, loc, expr, err):
+        pass
+
+class MathtexLimitError(ValueError):
+    """
+    Raised when an expression exceeds one of the limits of the parser,
+    named by *limit*, of at most *maximum*.
+    """
+    def __init__(self, msg, limit, maximum):
+        ValueError.__init__(self, "%s (more than %d)" % (msg, maximum))
+        self.limit = limit
+        self.maximum = maximum
+
 class MathtexParser(object):
     """
     This is the pyparsing-based parser for math expressions.  It
@@ -105,6 +269,38 @@ class MathtexParser(object):
 
     _rightDelim = set(r") ] } > \rfloor \rangle \rceil".split())
 
+    # Limits on the expressions accepted, so that no expression can
+    # take overly long to parse and lay out.  The depths also keep the
+    # recursion of the parser within Python's stack.  Any limit turns
+    # away some input which would otherwise render, so they are off
+    # (None) unless set on a parser or a subclass; untrusted_limits
+    # suit input from untrusted sources, as in
+    # ``parser.set_limits(**MathtexParser.untrusted_limits)``.
+    max_length = None           # Characters
+    max_nodes = None            # Symbols, commands, groups, ...
+    max_depth = None            # Nested groups, \left...\right and accents
+    max_script_depth = None     # Nested subscripts/superscripts
+
+    untrusted_limits = {
+        'max_length'       : 8000,
+        'max_nodes'        : 2000,
+        'max_depth'        : 16,
+        'max_script_depth' : 8
+        }
+
+    _limit_messages = {
+        'max_length'       : "Expression is too long",
+        'max_nodes'        : "Expression has too many nodes",
+        'max_depth'        : "Expression is nested too deeply",
+        'max_script_depth' : "Subscripts/superscripts are nested too deeply"
+        }
+
+    _limits_non_math_re = re.compile(r"(?:(?:\\[$])|[^$])*")
+    _limits_token_re = re.compile(r"\\(?:[a-zA-Z]+|.)|.", re.S)
+
+    # The Diagnostics of the last parse
+    diagnostics = None
+
     def __init__(self):
         # All forward declarations are here
         font = Forward().setParseAction(self.font).setName("font")
@@ -112,7 +308,7 @@ class MathtexParser(object):
         subsuper = Forward().setParseAction(self.subsuperscript).setName("subsuper")
         placeable = Forward().setName("placeable")
         simple = Forward().setName("simple")
-        autoDelim = Forward().setParseAction(self.auto_sized_delimiter)
+        autoDelim = Forward().setParseAction(self.auto_sized_delimiter).setName("autodelim")
         self._expression = Forward().setParseAction(self.finish).setName("finish")
 
         float        = Regex(r"[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)")
@@ -125,14 +321,16 @@ class MathtexParser(object):
         end_group.setParseAction(self.end_group)
 
         bslash       = Literal('\\')
+        left         = r"\\left"
+        delimOrSimple = Longest([(left, autoDelim), (None, simple)])
 
-        accent       = oneOf(self._accent_map.keys() +
+        accent       = Names(self._accent_map.keys() +
                              list(self._wide_accents))
 
-        function     = oneOf(list(self._function_names))
+        function     = Names(self._function_names)
 
-        fontname     = oneOf(list(self._fontnames))
-        latex2efont  = oneOf(['math' + x for x in self._fontnames])
+        fontname     = Names(self._fontnames)
+        latex2efont  = Names(['math' + x for x in self._fontnames])
 
         space        =(FollowedBy(bslash)
                      + oneOf([r'\ ',
@@ -151,17 +349,13 @@ class MathtexParser(object):
                        ) | Error(r"Expected \hspace{n}"))
                      ).setParseAction(self.customspace).setName('customspace')
 
-        unicode_range = u"\U00000080-\U0001ffff"
-        symbol       =(Regex(UR"([a-zA-Z0-9 +\-*/<>=:,.;!'@()\[\]|%s])|(\\[%%${}\[\]_|])" % unicode_range)
-                     | (Combine(
-                         bslash
-                       + oneOf(tex2uni.keys())
-                       ) + FollowedBy(Regex("[^a-zA-Z]")))
-                     ).setParseAction(self.symbol).leaveWhitespace()
+        symbol       =(SingleSymbol()
+                     | Names(tex2uni.keys(), prefix='\\', follow="[^a-zA-Z]")
+                     ).setParseAction(self.symbol).setName("symbol").leaveWhitespace()
 
         c_over_c     =(Suppress(bslash)
                      + oneOf(self._char_over_chars.keys())
-                     ).setParseAction(self.char_over_chars)
+                     ).setParseAction(self.char_over_chars).setName("c_over_c")
 
         accent       = Group(
                          Suppress(bslash)
@@ -175,9 +369,7 @@ class MathtexParser(object):
 
         group        = Group(
                          start_group
-                       + ZeroOrMore(
-                           autoDelim
-                         ^ simple)
+                       + ZeroOrMore(delimOrSimple)
                        - end_group
                      ).setParseAction(self.group).setName("group")
 
@@ -243,17 +435,24 @@ class MathtexParser(object):
                         | Error("Expected \operatorname{value}"))
                      ).setParseAction(self.operatorname).setName("operatorname")
 
-        placeable   <<(function
-                     ^ (c_over_c | symbol)
-                     ^ accent
-                     ^ group
-                     ^ frac
-                     ^ stackrel
-                     ^ binom
-                     ^ genfrac
-                     ^ sqrt
-                     ^ operatorname
-                     )
+        # Only the alternatives which start as the input does are tried
+        def command(names):
+            return r"\\\s*(?:%s)" % '|'.join(
+                [re.escape(x) for x in sorted(names, reverse=True)])
+
+        placeable   << Longest([
+                       (command(self._function_names), function),
+                       (r"\\|%s" % SingleSymbol.pattern, c_over_c | symbol),
+                       (command(self._accent_map.keys() +
+                                list(self._wide_accents)), accent),
+                       (r"\{|" + command(['math' + x for x in self._fontnames]),
+                        group),
+                       (r"\\frac", frac),
+                       (r"\\stackrel", stackrel),
+                       (r"\\binom", binom),
+                       (r"\\genfrac", genfrac),
+                       (r"\\sqrt", sqrt),
+                       (r"\\operatorname", operatorname)])
 
         simple      <<(space
                      | customspace
@@ -275,16 +474,14 @@ class MathtexParser(object):
 
         autoDelim   <<(Suppress(Literal(r"\left"))
                      + ((leftDelim | ambiDelim) | Error("Expected a delimiter"))
-                     + Group(
-                         autoDelim
-                       ^ OneOrMore(simple))
+                     + Group(Longest([
+                         (left, autoDelim),
+                         (None, OneOrMore(simple))]))
                      + Suppress(Literal(r"\right"))
                      + ((rightDelim | ambiDelim) | Error("Expected a delimiter"))
                      )
 
-        math         = OneOrMore(
-                       autoDelim
-                     ^ simple
+        math         = OneOrMore(delimOrSimple
                      ).setParseAction(self.math).setName("math")
 
         math_delim   = ~bslash + Literal('$')
@@ -303,6 +500,12 @@ class MathtexParser(object):
             )
           ) + StringEnd()
 
+        # The rules reported to a RuleCounter
+        self._rules = [font, subsuper, placeable, simple, autoDelim, space,
+                       customspace, symbol, c_over_c, accent, function,
+                       group, frac, stackrel, binom, genfrac, sqrt,
+                       operatorname, math, non_math]
+
         self.clear()
 
     def clear(self):
@@ -313,6 +516,19 @@ class MathtexParser(object):
         self._state_stack = None
         self._em_width_cache = {}
 
+    def count_rules(self, counter):
+        """
+        Reports each attempt at matching one of the rules of the
+        grammar, and whether it matched, to *counter*, a
+        :class:`RuleCounter`, or stops reporting them if it is None.
+        """
+        for rule in self._rules:
+            if counter is None:
+                rule.setDebug(False)
+            else:
+                rule.setDebugActions(counter.attempt, counter.match,
+                                     counter.mismatch)
+
     def parse(self, s, fonts_object, fontsize, dpi):
         """
         Parse expression *s* using the given *fonts_object* for
@@ -320,14 +536,145 @@ class MathtexParser(object):
 
         Returns the parse tree of :class:`Node` instances.
         """
+        # The parser may be reused (see :func:`get_parser`) so start
+        # from a clean slate; the em width cache is fontset specific
+        self.clear()
+        self.check_limits(s)
         self._default_style = fonts_object.default_style
         self._state_stack = [self.State(fonts_object, 'default', 'rm', fontsize, dpi)]
         try:
-            self._expression.parseString(s)
+            self._collect_diagnostics(self._parse_string, s)
         except (ParseException, ParseFatalException), err:
             raise ValueError(str(err))
 
-        return self._expr
+        expr = self._expr
+        # Do not hold on to the result or the fontset between parses
+        self.clear()
+        return expr
+
+    def _collect_diagnostics(self, func, *args):
+        """
+        Calls *func* with *args*, recording the overfull and underfull
+        lists to a new :class:`Diagnostics`, which is kept as
+        :attr:`diagnostics` until the next parse.
+        """
+        self.diagnostics = Diagnostics()
+        previous = set_diagnostics(self.diagnostics)
+        try:
+            return func(*args)
+        finally:
+            set_diagnostics(previous)
+
+    def _parse_string(self, s):
+        """
+        Runs the grammar over *s*, calling the parse actions as the
+        constructs are recognised.
+        """
+        self._expression.parseString(s)
+
+    def check_limits(self, s):
+        """
+        Check expression *s* against the limits of the parser, raising
+        :class:`MathtexLimitError` for the first one it exceeds, and
+        return the number of nodes in it.
+
+        As *s* is only tokenized, in time linear in its length, this
+        turns hostile input away before any parsing.  The depths are
+        worked out from the braces, ``\\left``/``\\right`` pairs,
+        accents, ``^`` and ``_`` alone, which is close enough for a
+        limit.
+        """
+        if self.max_length is not None and len(s) > self.max_length:
+            self._limit_exceeded('max_length')
+        max_depth = self.max_depth
+        if max_depth is None:
+            max_depth = sys.maxint
+        max_script_depth = self.max_script_depth
+        if max_script_depth is None:
+            max_script_depth = sys.maxint
+
+        nodes = 0
+        loc = 0
+        n = len(s)
+        while loc < n:
+            end = self._limits_non_math_re.match(s, loc).end()
+            nodes += end - loc
+            loc = end + 1
+            # For each enclosing group: the script depth, operand and
+            # accents outside of it
+            stack = []
+            depth = script_depth = accents = 0
+            # Whether a script is waiting for its operand: None, '^'
+            # straight after the ^ or _, and '\\' after a command
+            operand = None
+            for match in self._limits_token_re.finditer(s, loc):
+                tok = match.group()
+                if tok == '$':
+                    loc = match.end()
+                    break
+                if tok in ' \t\n\r':
+                    continue
+                nodes += 1
+                if tok == '{' or tok == r'\left':
+                    stack.append((script_depth, operand, accents))
+                    depth += 1
+                    if depth > max_depth:
+                        self._limit_exceeded('max_depth')
+                    if operand is not None:
+                        script_depth += 1
+                        if script_depth > max_script_depth:
+                            self._limit_exceeded('max_script_depth')
+                    operand = None
+                    accents = 0
+                elif tok == '}' or tok == r'\right':
+                    if stack:
+                        # The group is the operand of any accents before it
+                        depth -= 1 + accents
+                        script_depth, operand, accents = stack.pop()
+                        depth -= accents
+                        accents = 0
+                        if operand == '^':
+                            operand = None
+                elif tok == '^' or tok == '_':
+                    operand = '^'
+                elif tok[0] == '\\' and (tok[1:] in self._accent_map or
+                                         tok[1:] in self._wide_accents):
+                    accents += 1
+                    depth += 1
+                    if depth > max_depth:
+                        self._limit_exceeded('max_depth')
+                    if operand is not None:
+                        operand = '\\'
+                elif tok[0] == '\\' and tok[1:].isalpha():
+                    # A command, which may take groups as arguments
+                    depth -= accents
+                    accents = 0
+                    if operand is not None:
+                        operand = '\\'
+                else:
+                    depth -= accents
+                    accents = 0
+                    operand = None
+            else:
+                loc = n
+
+        if self.max_nodes is not None and nodes > self.max_nodes:
+            self._limit_exceeded('max_nodes')
+        return nodes
+
+    def set_limits(self, **limits):
+        """
+        Sets the limits named by the keyword arguments, such as those
+        of *untrusted_limits*, on this parser; None lifts a limit.
+        """
+        for limit, maximum in limits.items():
+            if limit not in self._limit_messages:
+                raise TypeError("Unknown limit '%s'" % limit)
+            setattr(self, limit, maximum)
+
+    def _limit_exceeded(self, limit):
+        raise MathtexLimitError(self._limit_messages[limit], limit,
+                                getattr(self, limit))
 
     # The state of the parser is maintained in a stack.  Upon
     # entering and leaving a group { } or math/non-math, the stack
@@ -335,33 +682,86 @@ class MathtexParser(object):
     # exists in the top element of the stack.
     class State(object):
         """
-        Stores the state of the parser.
+        Stores the state of the parser: the fonts object for output,
+        the font and font class, the font size and the dpi.
 
         States are pushed and popped from a stack as necessary, and
-        the "current" state is always at the top of the stack.
+        the "current" state is always at the top of the stack.  They
+        are immutable and interned, so that there is only one of each,
+        which the parser pushes without copying and each :class:`Char`
+        simply refers to.  :meth:`with_font` and :meth:`with_fontsize`
+        return the state which differs in the one field.
         """
-        def __init__(self, font_output, font, font_class, fontsize, dpi):
-            self.font_output = font_output
-            self._font = font
-            self.font_class = font_class
-            self.fontsize = fontsize
-            self.dpi = dpi
-
-        def copy(self):
-            return MathtexParser.State(
-                self.font_output,
-                self.font,
-                self.font_class,
-                self.fontsize,
-                self.dpi)
-
-        def _get_font(self):
-            return self._font
-        def _set_font(self, name):
+        __slots__ = ('font_output', 'font', 'font_class', 'fontsize', 'dpi',
+                     '_shrunk', '_grown', '__weakref__')
+
+        # The states in use, by the id of their fonts object and their
+        # other fields.  The ids are unique for as long as the states
+        # hold on to the fonts objects
+        _interned = weakref.WeakValueDictionary()
+
+        def __new__(cls, font_output, font, font_class, fontsize, dpi):
+            key = (id(font_output), font, font_class, fontsize, dpi)
+            state = cls._interned.get(key)
+            if state is None:
+                assert isinstance(font, (str, unicode, int))
+                state = object.__new__(cls)
+                init = object.__setattr__
+                init(state, 'font_output', font_output)
+                init(state, 'font',        font)
+                init(state, 'font_class',  font_class)
+                init(state, 'fontsize',    fontsize)
+                init(state, 'dpi',         dpi)
+                init(state, '_shrunk',     None)
+                init(state, '_grown',      None)
+                cls._interned[key] = state
+            return state
+
+        def __setattr__(self, name, value):
+            raise AttributeError("States can not be changed, use "
+                                 "with_font() or with_fontsize() instead")
+
+        def __repr__(self):
+            return 'State(%r, %r, %r, %r)' % (self.font, self.font_class,
+                                              self.fontsize, self.dpi)
+
+        def with_font(self, name):
+            """
+            Returns the state with the font *name*, which for 'rm', 'it'
+            and 'bf' is also the font class.
+            """
             if name in ('rm', 'it', 'bf'):
-                self.font_class = name
-            self._font = name
-        font = property(_get_font, _set_font)
+                font_class = name
+            else:
+                font_class = self.font_class
+            return MathtexParser.State(self.font_output, name, font_class,
+                                       self.fontsize, self.dpi)
+
+        def with_fontsize(self, fontsize):
+            """
+            Returns the state with the font size *fontsize*.
+            """
+            return MathtexParser.State(self.font_output, self.font,
+                                       self.font_class, fontsize, self.dpi)
+
+        def shrunk(self):
+            """
+            Returns the state with the font size one level smaller, as
+            :meth:`Char.shrink` needs it for every character.
+            """
+            if self._shrunk is None:
+                object.__setattr__(self, '_shrunk', self.with_fontsize(
+                    self.fontsize * SHRINK_FACTOR))
+            return self._shrunk
+
+        def grown(self):
+            """
+            Returns the state with the font size one level larger.
+            """
+            if self._grown is None:
+                object.__setattr__(self, '_grown', self.with_fontsize(
+                    self.fontsize * GROW_FACTOR))
+            return self._grown
 
     def get_state(self):
         """
@@ -369,18 +769,26 @@ class MathtexParser(object):
         """
         return self._state_stack[-1]
 
+    def set_state(self, state):
+        """
+        Replace the current :class:`State` of the parser with *state*.
+        """
+        self._state_stack[-1] = state
+
     def pop_state(self):
         """
         Pop a :class:`State` off of the stack.
         """
         self._state_stack.pop()
 
-    def push_state(self):
+    def push_state(self, state=None):
         """
-        Push a new :class:`State` onto the stack which is just a copy
-        of the current state.
+        Push *state*, by default the current :class:`State`, onto the
+        stack.
         """
-        self._state_stack.append(self.get_state().copy())
+        if state is None:
+            state = self._state_stack[-1]
+        self._state_stack.append(state)
 
     def finish(self, s, loc, toks):
         #~ print "finish", toks
@@ -399,8 +807,7 @@ class MathtexParser(object):
         symbols = [Char(c, self.get_state()) for c in s]
         hlist = Hlist(symbols)
         # We're going into math now, so set font to 'it'
-        self.push_state()
-        self.get_state().font =  self._default_style
+        self.push_state(self.get_state().with_font(self._default_style))
         return [hlist]
 
     def _make_space(self, percentage):
@@ -468,16 +875,18 @@ class MathtexParser(object):
         if under_desc is None:
             raise ParseFatalException("Error parsing symbol")
 
-        over_state = state.copy()
+        over_state = state
         if over_desc[0] is not None:
-            over_state.font = over_desc[0]
-        over_state.fontsize *= over_desc[2]
+            over_state = over_state.with_font(over_desc[0])
+        over_state = over_state.with_fontsize(
+            over_state.fontsize * over_desc[2])
         over = Accent(over_desc[1], over_state)
 
-        under_state = state.copy()
+        under_state = state
         if under_desc[0] is not None:
-            under_state.font = under_desc[0]
-        under_state.fontsize *= under_desc[2]
+            under_state = under_state.with_font(under_desc[0])
+        under_state = under_state.with_fontsize(
+            under_state.fontsize * under_desc[2])
         under = Char(under_desc[1], under_state)
 
         width = max(over.width, under.width)
@@ -539,9 +948,8 @@ class MathtexParser(object):
 
     def function(self, s, loc, toks):
         #~ print "function", toks
-        self.push_state()
-        state = self.get_state()
-        state.font = 'rm'
+        state = self.get_state().with_font('rm')
+        self.push_state(state)
         l = [self._make_space(0.2)]
         l += [Char(c, state) for c in toks[0]]
         l += [self._make_space(0.2)]
@@ -554,10 +962,11 @@ class MathtexParser(object):
         return self.function(s, loc, toks[0])
 
     def start_group(self, s, loc, toks):
-        self.push_state()
+        state = self.get_state()
         # Deal with LaTeX-style font tokens
         if len(toks):
-            self.get_state().font = toks[0][4:]
+            state = state.with_font(toks[0][4:])
+        self.push_state(state)
         return []
 
     def group(self, s, loc, toks):
@@ -571,7 +980,7 @@ class MathtexParser(object):
     def font(self, s, loc, toks):
         assert(len(toks)==1)
         name = toks[0]
-        self.get_state().font = name
+        self.set_state(self.get_state().with_font(name))
         return []
 
     def is_overunder(self, nucleus):
@@ -811,8 +1220,7 @@ class MathtexParser(object):
             root = Box(check.width * 0.5, 0., 0.)
         else:
             root = Hlist([Char(x, state) for x in root])
-            root.shrink()
-            root.shrink()
+            root.shrink(2)
 
         root_vlist = Vlist([Hlist([root])])
         root_vlist.shift_amount = -height * 0.6
@@ -843,3 +1251,21 @@ class MathtexParser(object):
         front, middle, back = toks
 
         return self._auto_sized_delimiter(front, middle.asList(), back)
+
+# Building the grammar is expensive -- often more so than parsing the
+# expression itself.  Parsers are therefore kept around and reused.  As
+# parsing is not reentrant each thread gets a parser of its own.
+_parsers = threading.local()
+
+def get_parser(parser_class=MathtexParser):
+    """
+    Returns a reusable instance of *parser_class* for the calling
+    thread, creating it on first use.
+    """
+    registry = getattr(_parsers, 'registry', None)
+    if registry is None:
+        registry = _parsers.registry = {}
+    parser = registry.get(parser_class)
+    if parser is None:
+        parser = registry[parser_class] = parser_class()
+    return parser
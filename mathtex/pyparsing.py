@@ -69,6 +69,7 @@ import sys
 import warnings
 import re
 import sre_constants
+import threading
 #~ sys.stderr.write( "testing pyparsing module, version %s, %s\n" % (__version__,__versionTime__ ) )
 
 __all__ = [
@@ -154,6 +155,19 @@ def _xml_escape(data):
 class _Constants(object):
     pass
 
+class _PackratCache(threading.local):
+    """The packrat cache of one thread; each thread parses with its own, so
+       that parsing in one thread can neither clear nor read the results
+       another is looking up."""
+    def __init__(self):
+        self._exprArgCache = {}
+        self._exprArgCacheOld = {}
+        # [hits, misses, most results held] since the last call to
+        # resetCacheStats()
+        self.packrat_cache_stats = [0, 0, 0]
+
+_missing = object()
+
 if not _PY3K:
     alphas     = string.lowercase + string.uppercase
 else:
@@ -991,31 +1005,67 @@ class ParserElement(object):
     # this method gets repeatedly called during backtracking with the same arguments -
     # we can cache these arguments and save ourselves the trouble of re-parsing the contained expression
     def _parseCache( self, instring, loc, doActions=True, callPreParse=True ):
+        packrat = ParserElement._packratCache
         lookup = (self,instring,loc,callPreParse,doActions)
-        if lookup in ParserElement._exprArgCache:
-            value = ParserElement._exprArgCache[ lookup ]
-            if isinstance(value,Exception):
-                raise value
-            return value
-        else:
+        value = packrat._exprArgCache.get( lookup, _missing )
+        if value is _missing:
+            value = packrat._exprArgCacheOld.pop( lookup, _missing )
+            if value is not _missing:
+                # still in use, so move it to the current generation
+                ParserElement._cacheValue( lookup, value )
+        if value is _missing:
+            packrat.packrat_cache_stats[1] += 1
             try:
                 value = self._parseNoCache( instring, loc, doActions, callPreParse )
-                ParserElement._exprArgCache[ lookup ] = (value[0],value[1].copy())
+                ParserElement._cacheValue( lookup, (value[0],value[1].copy()) )
                 return value
             except ParseBaseException, pe:
-                ParserElement._exprArgCache[ lookup ] = pe
+                ParserElement._cacheValue( lookup, pe )
                 raise
+        packrat.packrat_cache_stats[0] += 1
+        if isinstance(value,Exception):
+            raise value
+        return value
+
+    def _cacheValue( lookup, value ):
+        packrat = ParserElement._packratCache
+        packrat._exprArgCache[ lookup ] = value
+        size = len(packrat._exprArgCache) + len(packrat._exprArgCacheOld)
+        if size > packrat.packrat_cache_stats[2]:
+            packrat.packrat_cache_stats[2] = size
+        if ParserElement._cacheSizeLimit is not None and \
+                2 * len(packrat._exprArgCache) >= ParserElement._cacheSizeLimit:
+            # start a new generation, discarding the results not used
+            # during the previous one
+            packrat._exprArgCacheOld = packrat._exprArgCache
+            packrat._exprArgCache = {}
+    _cacheValue = staticmethod(_cacheValue)
 
     _parse = _parseNoCache
 
-    # argument cache for optimizing repeated calls when backtracking through recursive expressions
-    _exprArgCache = {}
+    # argument cache for optimizing repeated calls when backtracking through recursive expressions;
+    # when the size of the cache is limited, results are kept in two generations, which together
+    # hold at most _cacheSizeLimit results, and the least recently used are discarded first.
+    # Each thread has a cache of its own, and resetCache clears only the calling thread's.
+    _packratCache = _PackratCache()
+    _cacheSizeLimit = None
     def resetCache():
-        ParserElement._exprArgCache.clear()
+        ParserElement._packratCache._exprArgCache.clear()
+        ParserElement._packratCache._exprArgCacheOld.clear()
     resetCache = staticmethod(resetCache)
 
+    def cacheStats():
+        """Returns the packrat cache [hits, misses, most results held] of
+           the calling thread since its last call to resetCacheStats()."""
+        return ParserElement._packratCache.packrat_cache_stats
+    cacheStats = staticmethod(cacheStats)
+
+    def resetCacheStats():
+        ParserElement._packratCache.packrat_cache_stats[:] = [0, 0, 0]
+    resetCacheStats = staticmethod(resetCacheStats)
+
     _packratEnabled = False
-    def enablePackrat():
+    def enablePackrat(cache_size_limit=None):
         """Enables "packrat" parsing, which adds memoizing to the parsing logic.
            Repeated parse attempts at the same string location (which happens
            often in many complex grammars) can immediately return a cached value,
@@ -1030,7 +1080,19 @@ class ParserElement(object):
            enablePackrat before calling psyco.full().  If you do not do this,
            Python will crash.  For best results, call enablePackrat() immediately
            after importing pyparsing.
+
+           Parameters:
+            - cache_size_limit - (default=None) - the maximum number of results
+              to memoize; beyond it the least recently used results are discarded.
+              None places no limit on the size of the cache.  Calling
+              enablePackrat again changes the limit.
+
+           Each thread has a cache of its own; the hits, misses and most
+           results held of the calling thread's are given by
+           ParserElement.cacheStats().
         """
+        ParserElement._cacheSizeLimit = cache_size_limit
+        ParserElement.resetCache()
         if not ParserElement._packratEnabled:
             ParserElement._packratEnabled = True
             ParserElement._parse = ParserElement._parseCache
@@ -0,0 +1,306 @@
+import re
+import string
+
+from mathtex.parser import MathtexParser, get_parser
+from mathtex.fastparser import FastMathtexParser
+
+##############################################################################
+# TEMPLATES
+
+class _NoSplice(Exception):
+    """
+    Raised when the syntax trees of the values can not simply be put
+    in place of the placeholders, and the expression must be parsed in
+    full instead.
+    """
+
+class MathtexTemplate(object):
+    """
+    An expression with named placeholders, to be rendered for many
+    different values of them.  Placeholders follow Python's string
+    formatting, as in::
+
+        template = MathtexTemplate(r'$x_{%(i)d}^{2} + \\frac{%(name)s}{2}$')
+        box = template.parse({'i': 1, 'name': 'y'}, fonts_object, 12, 100)
+
+    which gives the box model that parsing ``template.template %
+    bindings`` would.
+
+    The template is parsed once, with a symbol standing in for each
+    placeholder.  For each set of bindings only the values are parsed
+    and their syntax trees put in place of those symbols; the tree is
+    then laid out in full, as the size of every box depends on those
+    it contains.  Values which do not stand on their own, such as the
+    ``12`` of ``x_%(i)d``, which would subscript only the ``1``, or
+    ``}`` are detected, and the expression is then parsed in full.
+
+    Templates do not hold on to a parser, so may be shared between
+    threads.
+    """
+    _placeholder_re = re.compile(
+        r"%(?:\((\w+)\))?[#0\- +]*[0-9]*(?:\.[0-9]+)?([diouxXeEfFgGcrs%]?)")
+    _whitespace = ' \t\n\r'
+    _letters = set(string.ascii_letters)
+    # Commands which take what follows them as an argument
+    _argument_commands = (set(MathtexParser._accent_map.keys()) |
+                          MathtexParser._wide_accents |
+                          set(['math' + x for x in MathtexParser._fontnames]) |
+                          set(r"""frac stackrel binom genfrac sqrt
+                                  operatorname hspace left right""".split()))
+
+    def __init__(self, template):
+        self.template = template
+        # The text around the placeholders, one more than there are
+        # placeholders, and the placeholders themselves
+        self._literals = []
+        self._placeholders = []
+        literal = []
+        loc = 0
+        for match in self._placeholder_re.finditer(template):
+            name, conversion = match.groups()
+            literal.append(template[loc:match.start()])
+            loc = match.end()
+            if conversion == '%':
+                literal.append('%')
+            elif not conversion:
+                raise ValueError("Incomplete placeholder at char %d of %r"
+                                 % (match.start(), template))
+            elif name is None:
+                raise ValueError("Unnamed placeholder at char %d of %r"
+                                 % (match.start(), template))
+            else:
+                self._literals.append(''.join(literal))
+                self._placeholders.append(match.group())
+                literal = []
+        literal.append(template[loc:])
+        self._literals.append(''.join(literal))
+
+        self._ast = self._parse_template()
+
+    def substitute(self, bindings):
+        """
+        Returns the expression for *bindings*, a mapping from the names
+        of the placeholders to their values.
+        """
+        return self._join([x % bindings for x in self._placeholders])
+
+    def parse(self, bindings, fonts_object, fontsize, dpi):
+        """
+        Lay out the expression for *bindings* using the given
+        *fonts_object* for output, at the given *fontsize* and *dpi*.
+
+        Returns the parse tree of :class:`Node` instances.
+        """
+        parser = get_parser(FastMathtexParser)
+        values = [x % bindings for x in self._placeholders]
+        s = self._join(values)
+        if self._ast is not None:
+            parser.check_limits(s)
+            try:
+                ast = self._splice(parser, s, values)
+            except _NoSplice:
+                pass
+            else:
+                return parser.layout(ast, fonts_object, fontsize, dpi)
+        return parser.parse(s, fonts_object, fontsize, dpi)
+
+    def _join(self, values):
+        parts = [self._literals[0]]
+        for value, literal in zip(values, self._literals[1:]):
+            parts.append(value)
+            parts.append(literal)
+        return ''.join(parts)
+
+    def _parse_template(self):
+        """
+        Parses the template with a symbol standing in for each
+        placeholder, returning its syntax tree, or None if values can
+        never be substituted into it.
+        """
+        if '\t' in self.template:
+            # Tabs are expanded to the next column, which then depends
+            # on the length of the values
+            return None
+        # Symbols which are otherwise unused
+        if isinstance(self.template, unicode):
+            candidates = [unichr(x) for x in xrange(0xe000, 0xf900)]
+        else:
+            candidates = [chr(x) for x in xrange(0x80, 0x100)]
+        symbols = [x for x in candidates if x not in self.template]
+        symbols = symbols[:len(self._placeholders)]
+        if len(symbols) < len(self._placeholders):
+            return None
+
+        try:
+            ast = get_parser(FastMathtexParser).parse_ast(self._join(symbols))
+        except ValueError:
+            return None
+
+        # Where the placeholders are, by index, and the ids of the
+        # nodes which contain them
+        self._index = dict([(x, i) for i, x in enumerate(symbols)])
+        self._in_math = [False] * len(symbols)
+        self._items = {}
+        self._holders = set()
+        found = []
+        try:
+            self._scan(ast, found)
+        except _NoSplice:
+            return None
+        if sorted(found) != range(len(symbols)):
+            # Some placeholder is not a whole item, e.g. it has scripts
+            return None
+        return ast
+
+    def _scan(self, node, found):
+        """
+        Adds the index of each placeholder in *node*, a node or a tuple
+        of them, to *found*.  Returns whether there were any.
+        """
+        if node and node[0] == 'error':
+            raise _NoSplice()
+        holds = False
+        if node and node[0] == 'non_math':
+            for c in node[1]:
+                if c in self._index:
+                    found.append(self._index[c])
+                    holds = True
+        else:
+            for child in node:
+                if not isinstance(child, tuple):
+                    continue
+                index = self._placeholder_item(child)
+                if index is not None:
+                    found.append(index)
+                    self._in_math[index] = True
+                    self._items[id(child)] = index
+                    holds = True
+                elif self._scan(child, found):
+                    holds = True
+        if holds:
+            self._holders.add(id(node))
+        return holds
+
+    def _placeholder_item(self, node):
+        """
+        Returns the index of the placeholder if *node* is an item made
+        of it alone, or None.
+        """
+        if node and node[0] == 'subsuper' and len(node[1]) == 1:
+            nucleus = node[1][0]
+            if nucleus[0] == 'symbol':
+                return self._index.get(nucleus[1])
+        return None
+
+    def _splice(self, parser, s, values):
+        """
+        Returns the syntax tree of *s*, the expression with *values*
+        substituted, from that of the template.
+        """
+        loc = len(self._literals[0])
+        substitutes = []
+        for i, value in enumerate(values):
+            end = loc + len(value)
+            if self._runs_on(s, loc) or self._runs_on(s, end):
+                raise _NoSplice()
+            if self._in_math[i]:
+                substitutes.append(self._parse_items(parser, value))
+            elif '$' in value:
+                raise _NoSplice()
+            else:
+                substitutes.append(value)
+            loc = end + len(self._literals[i + 1])
+        return ('expression', s, self._substitute(self._ast[2], substitutes))
+
+    def _runs_on(self, s, loc):
+        """
+        Returns whether the command before *loc* in *s* would take in
+        what follows, as an argument or as more letters of its name.
+        """
+        end = loc
+        while end > 0 and s[end - 1] in self._whitespace:
+            end -= 1
+        if end >= 2 and s[end - 2] == '\\' and \
+                s[end - 1] in self._argument_commands:
+            # An accent such as \'
+            return True
+        start = end
+        while start > 0 and s[start - 1] in self._letters:
+            start -= 1
+        if start == 0 or s[start - 1] != '\\':
+            return False
+        if s[start:end] in self._argument_commands:
+            return True
+        if end < loc:
+            return False
+        if start == end:
+            # A lone backslash escapes what follows
+            return loc < len(s)
+        return s[loc:loc + 1] in self._letters
+
+    def _parse_items(self, parser, value):
+        """
+        Returns the items of *value*, parsed on its own as math.
+        """
+        if not value.strip(self._whitespace):
+            return ()
+        parts = parser.parse_ast('$' + value + '$')[2]
+        if len(parts) != 3 or parts[0] != ('non_math', '') or \
+                parts[2] != ('non_math', ''):
+            raise _NoSplice()
+        items = parts[1][1]
+        if self._has_errors(items):
+            raise _NoSplice()
+        # Scripts with no nucleus would attach to the preceding item
+        first = items[0]
+        if first[0] == 'subsuper' and not isinstance(first[1][0], tuple):
+            raise _NoSplice()
+        return items
+
+    def _has_errors(self, node):
+        if node and node[0] == 'error':
+            return True
+        for child in node:
+            if isinstance(child, tuple) and self._has_errors(child):
+                return True
+        return False
+
+    def _substitute(self, node, substitutes):
+        """
+        Returns a copy of *node*, a node or a tuple of them, with the
+        placeholders replaced by *substitutes*, leaving the nodes which
+        have none as they are.
+        """
+        if node and node[0] == 'non_math':
+            text = []
+            for c in node[1]:
+                index = self._index.get(c)
+                if index is None:
+                    text.append(c)
+                else:
+                    text.append(substitutes[index])
+            return ('non_math', ''.join(text))
+
+        result = []
+        for child in node:
+            if isinstance(child, tuple):
+                index = self._items.get(id(child))
+                if index is not None:
+                    result.extend(substitutes[index])
+                    continue
+                if id(child) in self._holders:
+                    child = self._substitute(child, substitutes)
+            result.append(child)
+        result = tuple(result)
+
+        if node and node[0] == 'math' and not result[1]:
+            # Math with nothing in it is not parsed as math at all
+            raise _NoSplice()
+        if node and node[0] == 'autodelim':
+            middle = result[2]
+            # The middle is either a lone \left...\right or items which
+            # are not
+            if not middle or (len(middle) > 1 and
+                              [x for x in middle if x[0] == 'autodelim']):
+                raise _NoSplice()
+        return result
@@ -32,11 +32,23 @@ class maxdict(dict):
         self.maxsize = maxsize
         self._killkeys = []
     def __setitem__(self, k, v):
+        if k in self:
+            # Already due to be dropped in its turn
+            dict.__setitem__(self, k, v)
+            return
         if len(self)>=self.maxsize:
             del self[self._killkeys[0]]
             del self._killkeys[0]
         dict.__setitem__(self, k, v)
         self._killkeys.append(k)
+    def drop(self, keys):
+        """
+        Removes *keys*, all of which must be in the dictionary.
+        """
+        keys = set(keys)
+        for k in keys:
+            dict.__delitem__(self, k)
+        self._killkeys = [k for k in self._killkeys if k not in keys]
 
 def get_configdir():
     """
@@ -0,0 +1,1036 @@
+#! /usr/bin/env python
+# Mathtex benchmarks
+import sys, os
+import gc, pickle, re, shutil, subprocess, tempfile, threading, \
+    warnings
+from mathtex.mathtex_main import Mathtex
+from mathtex.boxmodel import Ship, ship, Char, Hlist, Vlist, Hrule, \
+    Diagnostics, set_diagnostics
+from mathtex.parser import MathtexParser, MathtexLimitError, Names, \
+    RuleCounter, get_parser, PACKRAT_CACHE_SIZE
+from mathtex.pyparsing import ParserElement, ParseException, Combine, \
+    Literal, FollowedBy, Regex, oneOf
+from mathtex.fonts import tex2uni, _faces, MetricsCache, set_metrics_cache
+from mathtex.fastparser import FastMathtexParser, IncrementalMathtexParser
+from mathtex.template import MathtexTemplate
+from mathtex.backends.backend_image import MathtexBackendImage, \
+    GlyphBitmapCache
+from optparse import OptionParser
+from time import time
+
+from corpus import tests, presets
+
+def timed(func, repeat):
+    """
+    Calls *func* *repeat* times and returns the best time, in seconds.
+    """
+    best = None
+    for i in range(repeat):
+        start = time()
+        func()
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(title, results):
+    """
+    Prints the (label, seconds, calls) triples in *results* as a table
+    of the per-call cost relative to the first entry.
+    """
+    print title
+    base = None
+    for label, elapsed, calls in results:
+        per_call = elapsed / calls
+        if base is None:
+            base = per_call
+        print '  %-24s %10.3f ms/call  %6.2fx' % (label, per_call * 1000.0,
+                                                  base / per_call)
+    print
+
+def in_child(func):
+    """
+    Calls *func* in a child process, so that it starts from the memory
+    use of this one, and returns its (picklable) result.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        os.write(write, pickle.dumps(func()))
+        os._exit(0)
+    os.close(write)
+    data = ''
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    return pickle.loads(data)
+
+def get_fontsets(actual_presets):
+    fontsets = {}
+    for fontsize, dpi, font in actual_presets:
+        if font not in fontsets:
+            fontsets[font] = Mathtex.fontset_mapping[font]()
+    return fontsets
+
+def bench_parser_reuse(exprs, actual_presets, repeat):
+    """
+    Cost of parsing the corpus with a new parser per call against a
+    reused, per-thread, parser.
+    """
+    fontsets = get_fontsets(actual_presets)
+    calls = len(exprs) * len(actual_presets)
+
+    def run(make_parser):
+        def inner():
+            for expr in exprs:
+                for fontsize, dpi, font in actual_presets:
+                    make_parser().parse(expr, fontsets[font], fontsize, dpi)
+        return inner
+
+    # Warm the glyph caches so only the parser is measured
+    run(get_parser)()
+
+    report('Parser construction (%d parses)' % calls,
+           [('new parser per call', timed(run(MathtexParser), repeat), calls),
+            ('get_parser()', timed(run(get_parser), repeat), calls)])
+
+def bench_parser_engine(exprs, actual_presets, repeat):
+    """
+    Cost of parsing the corpus with the pyparsing grammar against the
+    hand-written recursive descent parser.
+    """
+    fontsets = get_fontsets(actual_presets)
+    calls = len(exprs) * len(actual_presets)
+
+    def run(parser_class):
+        def inner():
+            parser = get_parser(parser_class)
+            for expr in exprs:
+                for fontsize, dpi, font in actual_presets:
+                    parser.parse(expr, fontsets[font], fontsize, dpi)
+        return inner
+
+    # Warm the glyph caches so only the parser is measured
+    run(MathtexParser)()
+
+    report('Parser engine (%d parses)' % calls,
+           [('MathtexParser', timed(run(MathtexParser), repeat), calls),
+            ('FastMathtexParser', timed(run(FastMathtexParser), repeat), calls)])
+
+def bench_ast_cache(exprs, actual_presets, repeat):
+    """
+    Cost of rendering the corpus at every preset when the syntax tree
+    of each expression is parsed afresh against when it is cached.
+    """
+    fontsets = get_fontsets(actual_presets)
+    calls = len(exprs) * len(actual_presets)
+
+    def run(make_parser):
+        def inner():
+            for expr in exprs:
+                for fontsize, dpi, font in actual_presets:
+                    make_parser().parse(expr, fontsets[font], fontsize, dpi)
+        return inner
+
+    def cached_parser():
+        return get_parser(FastMathtexParser)
+
+    # Warm the glyph caches so only the parser is measured
+    run(cached_parser)()
+
+    report('Syntax tree cache (%d layouts)' % calls,
+           [('parse per layout', timed(run(FastMathtexParser), repeat), calls),
+            ('parse once', timed(run(cached_parser), repeat), calls)])
+
+def bench_packrat_cache(exprs, actual_presets, repeat):
+    """
+    Throughput, cache hits/misses and the most results held at once by
+    the pyparsing engine at several packrat cache sizes.
+    """
+    fontsets = get_fontsets(actual_presets)
+    calls = len(exprs) * len(actual_presets)
+    parser = get_parser()
+
+    def parse():
+        for expr in exprs:
+            for fontsize, dpi, font in actual_presets:
+                parser.parse(expr, fontsets[font], fontsize, dpi)
+
+    def run(size):
+        def inner():
+            ParserElement.enablePackrat(size)
+            ParserElement.resetCacheStats()
+            elapsed = timed(parse, repeat)
+            hits, misses, held = ParserElement.cacheStats()
+            return elapsed, hits / repeat, misses / repeat, held
+        return inner
+
+    # Warm the glyph caches so only the parser is measured
+    parse()
+
+    print 'Packrat cache size (%d parses, default %s)' % (calls,
+                                                          PACKRAT_CACHE_SIZE)
+    print '  %-10s %10s %10s %10s %12s' % ('size', 'ms/call', 'hits',
+                                           'misses', 'most held')
+    for size in [None, 16384, 4096, 1024, 256]:
+        elapsed, hits, misses, held = in_child(run(size))
+        print '  %-10s %10.3f %10d %10d %12d' % (size, elapsed * 1000.0 / calls,
+                                                 hits, misses, held)
+    print
+
+def bench_name_lookup(exprs, actual_presets, repeat):
+    """
+    Cost of matching the backslash commands of the corpus against the
+    names in tex2uni with a oneOf alternation and with a Names trie.
+    """
+    commands = []
+    for expr in exprs:
+        commands.extend(re.findall(r'\\[a-zA-Z]+.', expr))
+
+    def run(element):
+        def inner():
+            for command in commands:
+                # Each command is matched once when parsing
+                ParserElement.resetCache()
+                try:
+                    element._parseNoCache(command, 0, False)
+                except ParseException:
+                    pass
+        return inner
+
+    old = Combine(Literal('\\') + oneOf(tex2uni.keys())) \
+        + FollowedBy(Regex("[^a-zA-Z]"))
+    new = Names(tex2uni.keys(), prefix='\\', follow="[^a-zA-Z]")
+    report('Command name lookup (%d commands)' % len(commands),
+           [('oneOf', timed(run(old.leaveWhitespace()), repeat), len(commands)),
+            ('Names', timed(run(new.leaveWhitespace()), repeat), len(commands))])
+
+def bench_validate(exprs, actual_presets, repeat):
+    """
+    Cost of validating the corpus, with and without cached syntax
+    trees, against parsing it.
+    """
+    fontsets = get_fontsets(actual_presets)
+    fontsize, dpi, font = actual_presets[0]
+    parser = get_parser(FastMathtexParser)
+
+    def parse():
+        for expr in exprs:
+            parser.parse(expr, fontsets[font], fontsize, dpi)
+
+    def validate(make_parser):
+        def inner():
+            for expr in exprs:
+                try:
+                    make_parser().validate(expr)
+                except ValueError:
+                    pass
+        return inner
+
+    # Warm the glyph caches so only the parser is measured
+    parse()
+
+    report('Validation (%d expressions)' % len(exprs),
+           [('parse, cached', timed(parse, repeat), len(exprs)),
+            ('validate', timed(validate(FastMathtexParser), repeat), len(exprs)),
+            ('validate, cached', timed(validate(lambda: parser), repeat),
+             len(exprs))])
+
+def bench_incremental(exprs, actual_presets, repeat):
+    """
+    Cost of re-parsing a document made of the whole corpus after each
+    keystroke, typing either text or math at its end.
+    """
+    fontsets = get_fontsets(actual_presets)
+    fontsize, dpi, font = actual_presets[0]
+    document = ' and '.join(exprs)
+    typed = r'so $\alpha^2 + \beta_1$ holds'
+
+    def run(parser_class, edits):
+        best = None
+        for i in range(repeat):
+            parser = parser_class()
+            parser.parse(document, fontsets[font], fontsize, dpi)
+            start = time()
+            for edit in edits:
+                parser.parse(edit, fontsets[font], fontsize, dpi)
+            elapsed = time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    # Only the typed text which leaves a valid expression
+    edits = [document + ' ' + typed[:i] for i in range(len(typed) + 1)
+             if typed[:i].count('$') % 2 == 0]
+
+    report('Incremental parsing (%d edits of %d characters)'
+           % (len(edits), len(document)),
+           [('FastMathtexParser', run(FastMathtexParser, edits), len(edits)),
+            ('IncrementalMathtexParser', run(IncrementalMathtexParser, edits),
+             len(edits))])
+
+def bench_limits(exprs, actual_presets, repeat):
+    """
+    Latency of hostile expressions as deep or as long as the limits
+    for untrusted input allow, and four times more so, with each parser
+    held to those limits.
+    """
+    fontsets = get_fontsets(actual_presets)
+    fontsize, dpi, font = actual_presets[0]
+    limits = MathtexParser.untrusted_limits
+    cases = [
+        ('sqrt tower', limits['max_depth'],
+         lambda n: '$' + r'\sqrt{' * n + 'x' + '}' * n + '$'),
+        ('frac chain', limits['max_depth'],
+         lambda n: '$' + r'\frac{1}{' * n + 'x' + '}' * n + '$'),
+        ('script stack', limits['max_script_depth'],
+         lambda n: '$' + 'x^{' * n + 'x' + '}' * n + '$'),
+        # Each x_1^2 is five nodes
+        ('long sequence', limits['max_nodes'],
+         lambda n: '$' + 'x_1^2' * (n // 5) + '$')]
+    engines = ['pyparsing', 'fast', 'incremental']
+
+    def run(parser, expr):
+        def inner():
+            try:
+                parser.parse(expr, fontsets[font], fontsize, dpi)
+            except MathtexLimitError:
+                pass
+        return inner
+
+    checker = FastMathtexParser()
+    checker.set_limits(**limits)
+    print 'Limits (ms/call)'
+    print '  %-16s %6s %-8s' % ('', 'size', 'result'),
+    print ' '.join(['%12s' % x for x in engines])
+    for name, limit, make in cases:
+        for size in [limit, limit * 4]:
+            expr = make(size)
+            try:
+                checker.check_limits(expr)
+                result = 'accepted'
+            except MathtexLimitError:
+                result = 'rejected'
+            print '  %-16s %6d %-8s' % (name, size, result),
+            for engine in engines:
+                # Not reused, so the syntax tree caches are of no help
+                parser = Mathtex.parser_mapping[engine]()
+                parser.set_limits(**limits)
+                elapsed = timed(run(parser, expr), 1)
+                print '%12.3f' % (elapsed * 1000.0),
+            print
+    print
+
+def bench_template(exprs, actual_presets, repeat):
+    """
+    Cost of rendering a formula for many values of its numbers and
+    identifiers, parsing each instance against filling in a template.
+    """
+    fontsets = get_fontsets(actual_presets)
+    fontsize, dpi, font = actual_presets[0]
+    template = MathtexTemplate(
+        r'$x_{%(i)d}^{2} + \frac{%(name)s}{2} \leq \sqrt{%(i)d + %(name)s}$')
+    names = ['a_{%d}', 'b^{%d}', r'\alpha_%d', r'\beta_{%d}', r'\hat{y}_{%d}']
+    bindings = [{'i': i, 'name': names[i % len(names)] % i}
+                for i in range(200)]
+
+    def run(parser_class):
+        def inner():
+            # Not reused, so the syntax tree cache is of no help
+            parser = parser_class()
+            for binding in bindings:
+                parser.parse(template.substitute(binding), fontsets[font],
+                             fontsize, dpi)
+        return inner
+
+    def fill():
+        for binding in bindings:
+            template.parse(binding, fontsets[font], fontsize, dpi)
+
+    # Warm the glyph caches so only the parser is measured
+    run(FastMathtexParser)()
+
+    report('Templates (%d instances)' % len(bindings),
+           [('MathtexParser', timed(run(MathtexParser), repeat), len(bindings)),
+            ('FastMathtexParser', timed(run(FastMathtexParser), repeat),
+             len(bindings)),
+            ('MathtexTemplate', timed(fill, repeat), len(bindings))])
+
+def bench_startup(exprs, actual_presets, repeat):
+    """
+    Wall clock time of a new interpreter importing mathtex, and of it
+    also rendering the first test expression with each parser.
+    """
+    fontsize, dpi, font = actual_presets[0]
+
+    def run(code):
+        def inner():
+            subprocess.check_call([sys.executable, '-c', code])
+        return inner
+
+    runs = [('python', 'pass'), ('import', 'import mathtex.mathtex_main')]
+    for engine in ['pyparsing', 'fast']:
+        runs.append(('import + render (%s)' % engine,
+                     'from mathtex.mathtex_main import Mathtex\n'
+                     'Mathtex(%r, %r, %r, %r, parser=%r)'
+                     % (exprs[0], font, fontsize, dpi, engine)))
+
+    print 'Startup (best of %d)' % repeat
+    for label, code in runs:
+        print '  %-28s %10.3f ms' % (label, timed(run(code), repeat) * 1000.0)
+    print
+
+def bench_grammar(exprs, actual_presets, repeat):
+    """
+    How many times each rule of the pyparsing grammar is attempted and
+    matched when parsing the corpus, and the cost of a parse.
+    """
+    fontsets = get_fontsets(actual_presets)
+    calls = len(exprs) * len(actual_presets)
+    parser = MathtexParser()
+
+    def run():
+        for expr in exprs:
+            for fontsize, dpi, font in actual_presets:
+                parser.parse(expr, fontsets[font], fontsize, dpi)
+
+    # Warm the glyph caches so only the parser is measured
+    run()
+    elapsed = timed(run, repeat)
+
+    counter = RuleCounter()
+    parser.count_rules(counter)
+    try:
+        run()
+    finally:
+        parser.count_rules(None)
+
+    print 'Grammar rules (%d parses, %.3f ms/parse)' % (calls,
+                                                      elapsed / calls * 1000.0)
+    print '  %-16s %10s %10s %8s' % ('rule', 'attempts', 'matches', 'matched')
+    attempts = counter.attempts
+    for name in sorted(attempts, key=lambda x: -attempts[x]):
+        matches = counter.matches.get(name, 0)
+        print '  %-16s %10d %10d %7.1f%%' % (name, attempts[name], matches,
+                                             100.0 * matches / attempts[name])
+    print
+
+def bench_node_memory(exprs, actual_presets, repeat):
+    """
+    Memory held by the box models of the corpus: the bytes of each kind
+    of node, and the objects the garbage collector tracks per cached
+    box model.
+    """
+    fontsets = get_fontsets(actual_presets)
+    calls = len(exprs) * len(actual_presets)
+    parser = get_parser(FastMathtexParser)
+
+    def parse():
+        return [parser.parse(expr, fontsets[font], fontsize, dpi)
+                for expr in exprs
+                for fontsize, dpi, font in actual_presets]
+
+    def footprint(obj):
+        # The object with its attributes dict, but not the values in it
+        size = sys.getsizeof(obj)
+        if hasattr(obj, '__dict__'):
+            size += sys.getsizeof(obj.__dict__)
+        return size
+
+    sizes = {}
+    seen = set()
+    def walk(node):
+        name = node.__class__.__name__
+        size = footprint(node)
+        children = getattr(node, 'children', None)
+        if children is not None:
+            size += sys.getsizeof(children)
+            for child in children:
+                walk(child)
+        glue_spec = getattr(node, 'glue_spec', None)
+        if glue_spec is not None and id(glue_spec) not in seen:
+            # Glue specs are mostly shared, so counted once
+            seen.add(id(glue_spec))
+            size += footprint(glue_spec)
+        count, total = sizes.get(name, (0, 0))
+        sizes[name] = (count + 1, total + size)
+
+    boxes = parse()
+    for box in boxes:
+        walk(box)
+
+    def run():
+        parse()
+        gc.collect()
+        start = len(gc.get_objects())
+        cached = [parse() for i in range(repeat * 10)]
+        gc.collect()
+        return (len(gc.get_objects()) - start) / float(len(cached) * calls)
+
+    nodes = sum([x[0] for x in sizes.values()])
+    total = sum([x[1] for x in sizes.values()])
+    print 'Box model memory (%d box models, %d nodes)' % (calls, nodes)
+    print '  %-16s %10s %12s' % ('node', 'count', 'bytes/node')
+    for name in sorted(sizes, key=lambda x: -sizes[x][1]):
+        count, size = sizes[name]
+        print '  %-16s %10d %12.1f' % (name, count, size / float(count))
+    print '  %-16s %10d %12.1f' % ('all', nodes, total / float(nodes))
+    print '  %-27s %12.1f' % ('bytes/box model (nodes)', total / float(calls))
+    print '  %-27s %12.1f' % ('objects/box model (gc)', in_child(run))
+    print
+
+def bench_nested_layout(exprs, actual_presets, repeat):
+    """
+    Cost of laying out ever more deeply nested scripts and fractions,
+    per node of the box model, which should not grow with the depth.
+    """
+    fontsets = get_fontsets(actual_presets)
+    fontsize, dpi, font = actual_presets[0]
+    parser = FastMathtexParser()
+    limits = MathtexParser.untrusted_limits
+    cases = [
+        ('script stack', limits['max_script_depth'],
+         lambda n: '$' + 'abc^{' * n + 'x' + '}' * n + '$'),
+        ('frac chain', limits['max_depth'],
+         lambda n: '$' + r'\frac{abc}{' * n + 'x' + '}' * n + '$'),
+        ('sqrt tower', limits['max_depth'],
+         lambda n: '$' + r'\sqrt[3]{abc' * n + 'x' + '}' * n + '$')]
+
+    def count(node):
+        return 1 + sum([count(x) for x in getattr(node, 'children', [])])
+
+    def run(ast):
+        def inner():
+            for i in range(10):
+                parser.layout(ast, fontsets[font], fontsize, dpi)
+        return inner
+
+    print 'Nested layout (us/node)'
+    for name, limit, make in cases:
+        depths = [1, limit // 4, limit // 2, limit]
+        print '  %-16s' % name,
+        print ' '.join(['%10s' % ('depth %d' % x) for x in depths])
+        print '  %-16s' % '',
+        for depth in depths:
+            ast = parser.parse_ast(make(depth))
+            nodes = count(parser.layout(ast, fontsets[font], fontsize, dpi))
+            elapsed = timed(run(ast), repeat)
+            print '%10.2f' % (elapsed * 1e6 / (10 * nodes)),
+        print
+    print
+
+def bench_ship(exprs, actual_presets, repeat):
+    """
+    Cost of shipping the box models of the corpus with the left edge of
+    their bounding box at zero, by shipping twice as was done before,
+    against once, and whether shipping from several threads at once
+    gives the same output.
+    """
+    fontsets = get_fontsets(actual_presets)
+    calls = len(exprs) * len(actual_presets)
+    parser = get_parser(FastMathtexParser)
+    boxes = [parser.parse(expr, fontsets[font], fontsize, dpi)
+             for expr in exprs
+             for fontsize, dpi, font in actual_presets]
+
+    def twice():
+        for box in boxes:
+            bbox = ship(0, 0, box)[2]
+            ship(-bbox[0], 0, box)
+
+    def once(boxes=boxes):
+        results = []
+        for box in boxes:
+            shipped = Ship(box)
+            results.append(shipped.output(-shipped.bbox[0], 0))
+        return results
+
+    report('Shipping (%d box models)' % calls,
+           [('ship() twice', timed(twice, repeat), calls),
+            ('Ship() once', timed(once, repeat), calls)])
+
+    expected = once()
+    results = [None] * 8
+    def worker(i):
+        results[i] = once()
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print '  %d threads, %d differing outputs' % (
+        len(threads), len([x for x in results if x != expected]))
+    print
+
+def bench_deep_ship(exprs, actual_presets, repeat):
+    """
+    Cost of shipping and growing box models nested far deeper than the
+    parser allows, which used to exceed Python's recursion limit.
+    """
+    fontsets = get_fontsets(actual_presets)
+    fontsize, dpi, font = actual_presets[0]
+    state = MathtexParser.State(fontsets[font], 'it', 'rm', fontsize, dpi)
+
+    def make(depth):
+        # Like a tower of square roots: a glyph, and a rule over the
+        # rest of the tower
+        box = Hlist([Char('x', state)])
+        for i in range(depth):
+            box = Hlist([Char('x', state),
+                         Vlist([Hrule(state), Hlist([box])])])
+        return box
+
+    print 'Deeply nested box models (us/level)'
+    print '  %-8s %12s %12s' % ('depth', 'Ship()', 'grow()')
+    for depth in [100, 1000, 10000]:
+        box = make(depth)
+        print '  %-8d' % depth,
+        for func in [lambda: Ship(box), box.grow]:
+            try:
+                elapsed = timed(func, repeat)
+                print '%12.2f' % (elapsed * 1e6 / depth),
+            except RuntimeError:
+                print '%12s' % 'failed',
+        print
+    print
+
+def bench_display_list(exprs, actual_presets, repeat):
+    """
+    Cost of getting the output of shipping the corpus as lists of tuples
+    against display lists of arrays, and the memory each takes.
+    """
+    fontsets = get_fontsets(actual_presets)
+    calls = len(exprs) * len(actual_presets)
+    parser = get_parser(FastMathtexParser)
+    shipped = [Ship(parser.parse(expr, fontsets[font], fontsize, dpi))
+               for expr in exprs
+               for fontsize, dpi, font in actual_presets]
+
+    def run(method):
+        def inner():
+            return [method(x)(-x.bbox[0], 0) for x in shipped]
+        return inner
+
+    # Import numpy up front so that it is not timed
+    run(lambda x: x.display_list)()
+    report('Display lists (%d box models)' % calls,
+           [('Ship.output()', timed(run(lambda x: x.output), repeat), calls),
+            ('Ship.display_list()',
+             timed(run(lambda x: x.display_list), repeat), calls)])
+
+    def tuples_size(output):
+        # The lists and tuples, but not the glyph infos they share
+        rects, glyphs, bbox = output
+        size = sys.getsizeof(rects) + sys.getsizeof(glyphs)
+        for item in rects + glyphs:
+            size += sys.getsizeof(item)
+            size += sum([sys.getsizeof(x) for x in item
+                         if isinstance(x, float)])
+        return size
+
+    def arrays_size(display_list):
+        return (display_list.glyphs.nbytes + display_list.rects.nbytes +
+                sum([sys.getsizeof(x) for x in display_list.fonts]))
+
+    outputs = run(lambda x: x.output)()
+    display_lists = run(lambda x: x.display_list)()
+    print 'Display list memory'
+    print '  %-27s %12.1f' % ('bytes/box model (tuples)',
+        sum([tuples_size(x) for x in outputs]) / float(calls))
+    print '  %-27s %12.1f' % ('bytes/box model (arrays)',
+        sum([arrays_size(x) for x in display_lists]) / float(calls))
+    print '  %-27s %12.1f' % ('bytes/box model (pickled)',
+        sum([len(pickle.dumps(x, 2)) for x in display_lists]) / float(calls))
+    print
+
+def bench_kerning(exprs, actual_presets, repeat):
+    """
+    Cost of laying out long runs of text outside of math, where every
+    pair of adjacent characters is kerned, per character.
+    """
+    fontsets = get_fontsets(actual_presets)
+    parser = FastMathtexParser()
+    text = 'The quick brown fox jumps over the lazy dog, AVAST ye Ty. '
+
+    def run(ast, fontset, fontsize, dpi, count):
+        def inner():
+            for i in range(count):
+                parser.layout(ast, fontset, fontsize, dpi)
+        return inner
+
+    print 'Kerning of text runs (us/char)'
+    lengths = [100, 500, 1500]
+    print '  %-24s' % '',
+    print ' '.join(['%10s' % ('%d chars' % x) for x in lengths])
+    for fontsize, dpi, font in actual_presets:
+        print '  %-24s' % ('%s %s %d' % (font, fontsize, dpi)),
+        for length in lengths:
+            expr = (text * (length // len(text) + 1))[:length]
+            ast = parser.parse_ast(expr)
+            # Some 20000 characters a time
+            count = 20000 // length
+            elapsed = timed(run(ast, fontsets[font], fontsize, dpi, count),
+                            repeat)
+            print '%10.2f' % (elapsed * 1e6 / (count * length)),
+        print
+    print
+
+def bench_subtree_cache(exprs, actual_presets, repeat):
+    """
+    Cost of laying out the corpus, and formulas made of a few recurring
+    pieces, with the subtree cache of the fast parser off and on, and
+    the share of the subtrees found in it.
+    """
+    fontsets = get_fontsets(actual_presets)
+    pieces = [r'\frac{1}{2}', 'x^2', r'\sum_{i=1}^{n}', r'\sqrt{2}',
+              r'\alpha_{i}', r'\hat{y}', r'e^{-x^2}',
+              r'\frac{\partial f}{\partial x}', r'\left(a+b\right)']
+    letters = 'abcdefgh'
+    recurring = ['$' + ' + '.join(['%s %s' % (pieces[(i * 7 + j) % len(pieces)],
+                                              letters[(i + j * 3) % len(letters)])
+                                   for j in range(5)]) + '$'
+                 for i in range(200)]
+
+    def run(size, asts, parsers):
+        def inner():
+            # A new parser each time, so only the reuse within the
+            # workload is measured
+            parser = FastMathtexParser()
+            parser.subtree_cache_size = size
+            for ast in asts:
+                for fontsize, dpi, font in actual_presets:
+                    parser.layout(ast, fontsets[font], fontsize, dpi)
+            parsers.append(parser)
+        return inner
+
+    for title, workload in [('corpus', exprs), ('recurring pieces', recurring)]:
+        calls = len(workload) * len(actual_presets)
+        asts = [get_parser(FastMathtexParser).parse_ast(expr)
+                for expr in workload]
+        parsers = []
+        # Warm the glyph caches so only the layout is measured
+        run(None, asts, parsers)()
+        report('Subtree cache, %s (%d layouts)' % (title, calls),
+               [('subtree_cache_size=%s' % size,
+                 timed(run(size, asts, parsers), repeat), calls)
+                for size in [None, 1000]])
+        parser = parsers[-1]
+        lookups = parser.subtree_hits + parser.subtree_misses
+        print '  %d subtrees looked up, %.1f%% found' % (
+            lookups, 100.0 * parser.subtree_hits / max(lookups, 1))
+        print
+
+def bench_diagnostics(exprs, actual_presets, repeat):
+    """
+    Cost of packing nested lists to a width they do not fit, with the
+    warnings about them ignored, against recorded to a Diagnostics.
+    """
+    fontsets = get_fontsets(actual_presets)
+    fontsize, dpi, font = actual_presets[0]
+    state = MathtexParser.State(fontsets[font], 'it', 'rm', fontsize, dpi)
+
+    def run(depth, diagnostics):
+        def inner():
+            previous = set_diagnostics(diagnostics)
+            try:
+                box = Hlist([Char('x', state)])
+                for i in range(depth):
+                    box = Hlist([Char('x', state), box, Char('y', state)])
+                    # Overfull, as there is no glue to stretch
+                    box.hpack(box.width + 10., 'exactly')
+            finally:
+                set_diagnostics(previous)
+        return inner
+
+    print 'Overfull lists (us/list)'
+    print '  %-8s %12s %12s' % ('depth', 'warnings', 'Diagnostics')
+    filters = warnings.filters[:]
+    warnings.simplefilter('ignore')
+    try:
+        for depth in [10, 30, 100]:
+            print '  %-8d' % depth,
+            for diagnostics in [None, Diagnostics()]:
+                elapsed = timed(run(depth, diagnostics), repeat)
+                print '%12.2f' % (elapsed * 1e6 / depth),
+            print
+    finally:
+        warnings.filters[:] = filters
+    print
+
+def bench_text(exprs, actual_presets, repeat):
+    """
+    Parse throughput on text heavy expressions, which make a character
+    for every letter, and the bytes of each character.
+    """
+    fontsets = get_fontsets(actual_presets)
+    parser = get_parser(FastMathtexParser)
+    words = 'the quick brown fox jumps over the lazy dog'.split()
+    texts = [
+        ('text', lambda n: ' '.join((words * n)[:n])),
+        ('mathrm', lambda n: r'$\mathrm{%s}$' % r'\ '.join((words * n)[:n])),
+        ('groups', lambda n: '$%s$' % ' '.join(
+            [r'{\rm %s}_{%s}' % (x, x[0]) for x in (words * n)[:n]])),
+        ]
+
+    print 'Text heavy expressions (us/char)'
+    print '  %-8s %8s %8s %8s' % ('kind', 10, 50, 150)
+    for name, make in texts:
+        print '  %-8s' % name,
+        for n in [10, 50, 150]:
+            expr = make(n)
+            def run():
+                for fontsize, dpi, font in actual_presets:
+                    parser.parse(expr, fontsets[font], fontsize, dpi)
+            elapsed = timed(run, repeat)
+            print '%8.2f' % (elapsed * 1e6 / (len(expr) * len(actual_presets))),
+        print
+    fontsize, dpi, font = actual_presets[0]
+    char = parser.parse('x', fontsets[font], fontsize, dpi)
+    while not isinstance(char, Char):
+        char = char.children[0]
+    print '  %-27s %8d' % ('bytes/Char', sys.getsizeof(char))
+    print
+
+def bench_fontsets(exprs, actual_presets, repeat):
+    """
+    Repeated renders through Mathtex, building a new fontset for each
+    as it used to, against the shared fontsets of get_fontset.
+    """
+    calls = len(exprs) * len(actual_presets)
+
+    def fresh():
+        for expr in exprs:
+            for fontsize, dpi, font in actual_presets:
+                fontset = Mathtex.fontset_mapping[font]('it')
+                Mathtex(expr, fontset, fontsize, dpi, parser='fast')
+
+    def shared():
+        for expr in exprs:
+            for fontsize, dpi, font in actual_presets:
+                Mathtex(expr, font, fontsize, dpi, parser='fast')
+
+    shared()
+    report('Repeated renders (%d)' % calls, [
+        ('new fontset per render', timed(fresh, repeat), calls),
+        ('get_fontset', timed(shared, repeat), calls),
+        ])
+
+def bench_faces(exprs, actual_presets, repeat):
+    """
+    FreeType faces opened by a worker using every fontset, which share
+    those of the font files they have in common.
+    """
+    names = sorted(Mathtex.fontset_mapping)
+    names.remove('unicode')
+
+    def run():
+        fontsets = [Mathtex.fontset_mapping[name]('it') for name in names]
+        for fontset in fontsets:
+            for expr in exprs:
+                Mathtex(expr, fontset, 12, 100, parser='fast')
+        uses = sum([count for face, count in _faces.values()])
+        return len(_faces), uses
+
+    faces, uses = in_child(run)
+    print 'Fontsets %s' % ', '.join(names)
+    print '  %-24s %10d' % ('faces open', faces)
+    print '  %-24s %10d' % ('faces used by fontsets', uses)
+    print
+
+def bench_metrics_cache(exprs, actual_presets, repeat):
+    """
+    Laying out the corpus in a new worker, with new fontsets, without a
+    metrics cache, with an empty one and with one a worker before has
+    saved.
+    """
+    calls = len(exprs) * len(actual_presets)
+    directory = tempfile.mkdtemp()
+    parser = get_parser(FastMathtexParser)
+
+    def start(make_cache):
+        def run():
+            metrics_cache = make_cache()
+            previous = set_metrics_cache(metrics_cache)
+            try:
+                fontsets = dict([(font, Mathtex.fontset_mapping[font]('it'))
+                                 for fontsize, dpi, font in actual_presets])
+                begin = time()
+                for expr in exprs:
+                    for fontsize, dpi, font in actual_presets:
+                        parser.parse(expr, fontsets[font], fontsize, dpi)
+                elapsed = time() - begin
+                if metrics_cache is not None:
+                    metrics_cache.save()
+                return elapsed
+            finally:
+                set_metrics_cache(previous)
+        return min([in_child(run) for i in range(repeat)])
+
+    def empty():
+        # A directory of its own, so that each start is a cold one
+        return MetricsCache(tempfile.mkdtemp(dir=directory))
+
+    try:
+        none = start(lambda: None)
+        cold = start(empty)
+        # Filling the cache first
+        start(lambda: MetricsCache(directory))
+        warm = start(lambda: MetricsCache(directory))
+    finally:
+        shutil.rmtree(directory)
+    report('New worker (%d layouts)' % calls, [
+        ('no metrics cache', none, calls),
+        ('cold metrics cache', cold, calls),
+        ('warm metrics cache', warm, calls),
+        ])
+
+def bench_unscaled_metrics(exprs, actual_presets, repeat):
+    """
+    Laying out the corpus at many sizes with new fontsets, loading the
+    metrics of glyphs for each size, against working them out from
+    unscaled ones.
+    """
+    sizes = [8 + 0.5 * i for i in range(25)]
+    fonts = sorted(set([font for fontsize, dpi, font in actual_presets]))
+    calls = len(exprs) * len(sizes) * len(fonts)
+    parser = get_parser(FastMathtexParser)
+
+    def start(unscaled):
+        def run():
+            fontsets = []
+            for font in fonts:
+                fontset = Mathtex.fontset_mapping[font]('it')
+                fontset.unscaled_metrics = unscaled
+                fontsets.append(fontset)
+            begin = time()
+            for expr in exprs:
+                for fontsize in sizes:
+                    for fontset in fontsets:
+                        parser.parse(expr, fontset, fontsize, 100)
+            elapsed = time() - begin
+            if unscaled:
+                loads = sum([len(face.unscaled)
+                             for face, count in _faces.values()])
+            else:
+                loads = sum([len(fontset.glyphd) for fontset in fontsets])
+            return elapsed, loads
+        return min([in_child(run) for i in range(repeat)])
+
+    scaled, scaled_loads = start(False)
+    unscaled, unscaled_loads = start(True)
+    report('Layouts at %d sizes (%d)' % (len(sizes), calls), [
+        ('glyphs loaded per size', scaled, calls),
+        ('unscaled metrics', unscaled, calls),
+        ])
+    print '  %-24s %10d' % ('glyphs loaded per size', scaled_loads)
+    print '  %-24s %10d' % ('unscaled glyphs loaded', unscaled_loads)
+    print
+
+def bench_glyph_bitmaps(exprs, actual_presets, repeat):
+    """
+    Rendering the laid out corpus to images, drawing each glyph with
+    FreeType against copying it from the glyph bitmap cache, at exact
+    positions and at a quarter of a pixel, the first time and again.
+    """
+    calls = len(exprs) * len(actual_presets)
+    boxes = [Mathtex(expr, font, fontsize, dpi, parser='fast')
+             for expr in exprs for fontsize, dpi, font in actual_presets]
+
+    def run():
+        for box in boxes:
+            box.as_mask()
+
+    def start(make_cache):
+        # A new cache for each timing of the first pass
+        caches = []
+        previous = MathtexBackendImage.glyph_cache
+        def first():
+            caches.append(make_cache())
+            MathtexBackendImage.glyph_cache = caches[-1]
+            run()
+        try:
+            once = timed(first, repeat)
+            again = timed(run, repeat)
+        finally:
+            MathtexBackendImage.glyph_cache = previous
+        return once, again, caches[0]
+
+    results = [('drawn by FreeType', start(lambda: None))]
+    for subpixels in [64, 4]:
+        results.append(('cache, subpixels=%d' % subpixels,
+                        start(lambda: GlyphBitmapCache(subpixels=subpixels))))
+    report('Renders to images, first pass (%d)' % calls,
+           [(title, once, calls) for title, (once, again, cache) in results])
+    report('Renders to images, again (%d)' % calls,
+           [(title, again, calls) for title, (once, again, cache) in results])
+    print '  %-24s %10s %10s' % ('first pass', 'hit ratio', 'cached')
+    for title, (once, again, cache) in results[1:]:
+        print '  %-24s %10.3f %10d' % (title, cache.hit_ratio(),
+                                       len(cache._keys))
+    print
+
+benchmarks = {
+    'parser_reuse'  : bench_parser_reuse,
+    'parser_engine' : bench_parser_engine,
+    'ast_cache'     : bench_ast_cache,
+    'packrat_cache' : bench_packrat_cache,
+    'name_lookup'   : bench_name_lookup,
+    'validate'      : bench_validate,
+    'incremental'   : bench_incremental,
+    'limits'        : bench_limits,
+    'template'      : bench_template,
+    'startup'       : bench_startup,
+    'grammar'       : bench_grammar,
+    'node_memory'   : bench_node_memory,
+    'nested_layout' : bench_nested_layout,
+    'ship'          : bench_ship,
+    'deep_ship'     : bench_deep_ship,
+    'display_list'  : bench_display_list,
+    'kerning'       : bench_kerning,
+    'subtree_cache' : bench_subtree_cache,
+    'diagnostics'   : bench_diagnostics,
+    'text'          : bench_text,
+    'fontsets'      : bench_fontsets,
+    'faces'         : bench_faces,
+    'metrics_cache' : bench_metrics_cache,
+    'unscaled'      : bench_unscaled_metrics,
+    'glyph_bitmaps' : bench_glyph_bitmaps,
+}
+
+# Command line options
+arg_parser = OptionParser()
+
+arg_parser.add_option('-l', '--list-benchmarks', dest='list_benchmarks',
+                      default=False, action='store_true',
+                      help='list available benchmarks')
+arg_parser.add_option('-b', '--run-benchmarks', dest='benchmarks',
+                      default=','.join(sorted(benchmarks.keys())),
+                      help='list of comma separated benchmarks to run')
+arg_parser.add_option('-t', '--run-tests', dest='tests',
+                      default=','.join(sorted(tests.keys())),
+                      help='list of comma separated test names to use')
+arg_parser.add_option('-T', '--run-presets', dest='presets',
+                      default='0,2,4',
+                      help='list of preset indexes to use')
+arg_parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=3, help='number of times to repeat each timing')
+
+(options, args) = arg_parser.parse_args()
+
+if options.list_benchmarks:
+    print 'Available benchmarks:'
+    for name in sorted(benchmarks.keys()):
+        print '  %-20s %s' % (name, ' '.join(benchmarks[name].__doc__.split()))
+    sys.exit()
+
+exprs = [tests[name] for name in options.tests.split(',')]
+actual_presets = [presets[int(i)] for i in options.presets.split(',')]
+
+for name in options.benchmarks.split(','):
+    benchmarks[name](exprs, actual_presets, options.repeat)
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+# Mathtex backend tests; run with
+#   python -m unittest discover -s tests -p 'test_*.py'
+import unittest
+
+from mathtex.mathtex_main import Mathtex
+from mathtex.backends.backend_image import MathtexBackendImage, \
+    GlyphBitmapCache, _subpixel
+
+from corpus import tests
+
+class GlyphBitmapCacheTest(unittest.TestCase):
+    """
+    Glyphs copied from the cache at exact positions give the images
+    drawing them with FreeType does, and the cache counts what it finds
+    and keeps to its budget.
+    """
+    presets = [(12, 100, 'bakoma'), (9, 72, 'stix'), (17.3, 150, 'stixsans')]
+
+    def setUp(self):
+        self.glyph_cache = MathtexBackendImage.glyph_cache
+        self.mathtexs = [Mathtex(expr, font, fontsize, dpi, parser='fast')
+                         for name, expr in sorted(tests.items())[::4]
+                         for fontsize, dpi, font in self.presets]
+
+    def tearDown(self):
+        MathtexBackendImage.glyph_cache = self.glyph_cache
+
+    def masks(self, glyph_cache):
+        MathtexBackendImage.glyph_cache = glyph_cache
+        return [mathtex.as_mask().tostring() for mathtex in self.mathtexs]
+
+    def test_off_by_default(self):
+        self.assertTrue(MathtexBackendImage.glyph_cache is None)
+        self.assertEqual(GlyphBitmapCache().subpixels, 64)
+
+    def test_exact(self):
+        expected = self.masks(None)
+        cache = GlyphBitmapCache()
+        self.assertEqual(self.masks(cache), expected)
+        misses = cache.misses
+        self.assertEqual(len(cache._keys), misses)
+        self.assertEqual(self.masks(cache), expected)
+        self.assertEqual(cache.misses, misses)
+        self.assertEqual(cache.hit_ratio(),
+                         cache.hits / float(cache.hits + cache.misses))
+        self.assertTrue(cache.hit_ratio() > 0.5)
+
+    def test_max_bytes(self):
+        expected = self.masks(None)
+        cache = GlyphBitmapCache(max_bytes=2000)
+        self.assertEqual(self.masks(cache), expected)
+        self.assertTrue(0 < cache._bytes <= 2000)
+        self.assertEqual(cache._bytes, sum([cache._bitmaps[key][0].nbytes
+                                            for key in cache._keys]))
+        self.assertTrue(len(cache._keys) < cache.misses)
+
+    def test_subpixels(self):
+        self.assertEqual(_subpixel(3.7, 64), (3, 44))
+        self.assertEqual(_subpixel(3.7, 4), (3, 32))
+        self.assertEqual(_subpixel(3.2, 4), (3, 0))
+        cache = GlyphBitmapCache(subpixels=4)
+        self.masks(cache)
+        for key in cache._keys:
+            self.assertEqual(key[4] % 16, 0)
+            self.assertEqual(key[5] % 16, 0)
+
+if __name__ == '__main__':
+    unittest.main()
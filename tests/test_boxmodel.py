@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+# Mathtex box model tests; run with
+#   python -m unittest discover -s tests -p 'test_*.py'
+import pickle
+import threading
+import warnings
+import unittest
+
+from mathtex.boxmodel import Box, Hlist, Vlist, Kern, Glue, GlueSpec, \
+    Char, Rule, Ship, ship, Diagnostics, set_diagnostics
+from mathtex.parser import MathtexParser
+from mathtex.fastparser import FastMathtexParser
+from mathtex.fonts import BakomaFonts
+from mathtex.mathtex_main import Mathtex
+
+from corpus import tests
+
+def find(box, cls):
+    """
+    Returns the first node of class *cls*, and not of a subclass, in
+    *box*, depth first.
+    """
+    stack = [box]
+    while stack:
+        node = stack.pop()
+        if node.__class__ is cls:
+            return node
+        stack.extend(reversed(getattr(node, 'children', [])))
+
+class NodeTest(unittest.TestCase):
+    """
+    Nodes keep their attributes in slots.
+    """
+    def test_no_dict(self):
+        box = FastMathtexParser().parse(r'$\sin(x) + \frac{1}{2}$',
+                                        BakomaFonts(), 12, 100)
+        nodes = [box, find(box, Char), Kern(1.), Glue('fil'),
+                 GlueSpec(), Box(1., 2., 3.), Vlist([])]
+        for node in nodes:
+            self.assertFalse(hasattr(node, '__dict__'), node)
+            self.assertRaises(AttributeError, setattr, node, 'foo', 1)
+
+    def test_function_name(self):
+        box = FastMathtexParser().parse(r'$\sin x$', BakomaFonts(), 12, 100)
+        lists = [box]
+        names = []
+        while lists:
+            node = lists.pop()
+            if isinstance(node, Hlist):
+                if hasattr(node, 'function_name'):
+                    names.append(node.function_name)
+                lists.extend(node.children)
+        self.assertEqual(names, ['sin'])
+        self.assertFalse(hasattr(Hlist([]), 'function_name'))
+
+def dimensions(node):
+    """
+    Returns the dimensions of *node* and of all the nodes in it.
+    """
+    dims = [(node.__class__.__name__, getattr(node, 'width', None),
+             getattr(node, 'height', None), getattr(node, 'depth', None),
+             getattr(node, 'shift_amount', None))]
+    for child in getattr(node, 'children', []):
+        dims.extend(dimensions(child))
+    return dims
+
+class ShrinkTest(unittest.TestCase):
+    """
+    Shrinking nested lists, which only passes the levels on to the
+    children when they are next asked for, sizes every node as
+    shrinking them one level at a time straight away would.
+    """
+    def nested(self, depth):
+        box = Hlist([Box(10., 8., 2.), Kern(3.)])
+        for i in range(depth):
+            box = Hlist([Box(5., 4., 1.), box, Kern(1.)])
+            box.shift_amount = 2.
+        return box
+
+    def test_levels_at_once(self):
+        for levels in range(1, 9):
+            lazy, eager = self.nested(5), self.nested(5)
+            lazy.shrink(levels)
+            for i in range(levels):
+                eager.shrink()
+            self.assertEqual(dimensions(lazy), dimensions(eager), levels)
+
+    def test_nested_shrinks(self):
+        lazy = self.nested(4)
+        inner = lazy.children[1]
+        inner.shrink()
+        lazy.shrink(2)
+        inner.children[1].shrink()
+        box = Box(10., 8., 2.)
+        for i in range(4):
+            box.shrink()
+        node = find(lazy.children[1].children[1].children[1].children[1], Box)
+        self.assertEqual((node.width, node.height, node.depth),
+                         (box.width, box.height, box.depth))
+
+    def test_smallest_size(self):
+        box = self.nested(2)
+        box.shrink(20)
+        inner = find(box.children[1].children[1], Box)
+        self.assertEqual(inner.size, 20)
+        self.assertAlmostEqual(inner.width, 10. * 0.7 ** 5)
+
+def output(box, ox=0, oy=0):
+    """
+    Returns the output of shipping *box* at (*ox*, *oy*), with the
+    glyphs as tuples.
+    """
+    rects, glyphs, bbox = Ship(box).output(ox, oy)
+    glyphs = [(info.font.fname, info.fontsize, info.num, x, y)
+              for x, y, info in glyphs]
+    return rects, glyphs, bbox
+
+class ShipTest(unittest.TestCase):
+    """
+    Each box is shipped by its own :class:`Ship`, whose output at any
+    offset is that of shipping the box there, so boxes may be shipped
+    from several threads at once.
+    """
+    def boxes(self):
+        parser = FastMathtexParser()
+        fonts_object = BakomaFonts()
+        return [parser.parse(expr, fonts_object, 12, 100)
+                for name, expr in sorted(tests.items())]
+
+    def assertMoved(self, moved, shipped, ox, oy):
+        # The bounding boxes take in the origin, so do not move with
+        # the output
+        rects, glyphs, bbox = shipped
+        rects2, glyphs2, bbox2 = moved
+        self.assertEqual(len(rects), len(rects2))
+        for r, r2 in zip(rects, rects2):
+            for a, b, offset in zip(r, r2, [ox, oy, ox, oy]):
+                self.assertAlmostEqual(a + offset, b)
+        self.assertEqual(len(glyphs), len(glyphs2))
+        for g, g2 in zip(glyphs, glyphs2):
+            self.assertEqual(g[:3], g2[:3])
+            self.assertAlmostEqual(g[3] + ox, g2[3])
+            self.assertAlmostEqual(g[4] + oy, g2[4])
+
+    def test_offsets(self):
+        for box in self.boxes():
+            shipped = output(box)
+            for ox, oy in [(-Ship(box).bbox[0], 0), (3.5, -2.25)]:
+                self.assertMoved(output(box, ox, oy), shipped, ox, oy)
+                rects, glyphs, bbox = ship(ox, oy, box)
+                glyphs = [(info.font.fname, info.fontsize, info.num, x, y)
+                          for x, y, info in glyphs]
+                self.assertMoved((rects, glyphs, bbox), shipped, ox, oy)
+                self.assertEqual(bbox, output(box, ox, oy)[2])
+
+    def test_threads(self):
+        boxes = self.boxes()
+        expected = [output(box) for box in boxes]
+        results = {}
+
+        def run(i):
+            results[i] = [[output(box) for box in boxes] for j in range(5)]
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            for outputs in results[i]:
+                self.assertEqual(outputs, expected)
+
+class DisplayListTest(unittest.TestCase):
+    """
+    Display lists hold the output of shipping, and survive pickling.
+    """
+    def test_output(self):
+        for box in ShipTest('run').boxes():
+            shipped = Ship(box)
+            ox, oy = -shipped.bbox[0], 0
+            rects, glyphs, bbox = shipped.output(ox, oy)
+            display_list = shipped.display_list(ox, oy)
+            self.assertEqual(len(display_list.glyphs), len(glyphs))
+            for record, (x, y, info) in zip(display_list.glyphs, glyphs):
+                fname, postscript_name = display_list.fonts[record['font']]
+                self.assertEqual(
+                    (record['num'], fname, postscript_name, record['size'],
+                     record['x'], record['y'], record['offset'],
+                     record['iceberg']),
+                    (info.num, info.font.fname, info.postscript_name,
+                     info.fontsize, x, y, info.offset, info.metrics.iceberg))
+            self.assertEqual(display_list.rects.shape, (len(rects), 4))
+            self.assertEqual([tuple(r) for r in display_list.rects],
+                             [tuple(r) for r in rects])
+            self.assertEqual(display_list.bbox, bbox)
+
+    def test_mathtex(self):
+        mathtex = Mathtex(r'$\sqrt{x} + \frac{1}{2}$', parser='fast')
+        display_list = pickle.loads(pickle.dumps(mathtex.as_display_list(),
+                                                 pickle.HIGHEST_PROTOCOL))
+        self.assertEqual([(display_list.fonts[r['font']][0], r['num'],
+                           r['x'], r['y']) for r in display_list.glyphs],
+                         [(info.font.fname, info.num, x, y)
+                          for x, y, info in mathtex.glyphs])
+        self.assertEqual([tuple(r) for r in display_list.rects],
+                         [tuple(r) for r in mathtex.rects])
+        self.assertEqual(display_list.dpi, mathtex.dpi)
+
+class DiagnosticsTest(unittest.TestCase):
+    """
+    Overfull and underfull lists are recorded to the diagnostics set
+    for the thread, with the messages they would have been warned
+    with, and warned about without them.
+    """
+    def pack(self):
+        Hlist([Box(5., 1., 0.)]).hpack(10., 'exactly')
+        Vlist([Box(5., 4., 0.)]).vpack(1., 'exactly')
+
+    def warned(self, func):
+        caught = warnings.catch_warnings(record=True)
+        messages = caught.__enter__()
+        try:
+            warnings.simplefilter('always')
+            func()
+        finally:
+            caught.__exit__()
+        return [str(message.message) for message in messages]
+
+    def test_record(self):
+        expected = self.warned(self.pack)
+        self.assertEqual(len(expected), 2)
+        diagnostics = Diagnostics()
+        previous = set_diagnostics(diagnostics)
+        try:
+            self.assertEqual(self.warned(self.pack), [])
+            # Other threads still warn
+            thread = threading.Thread(
+                target=lambda: expected.extend(self.warned(self.pack)))
+            thread.start()
+            thread.join()
+        finally:
+            set_diagnostics(previous)
+        self.assertEqual(len(diagnostics), 2)
+        self.assertEqual(diagnostics.messages(), expected[:2])
+        self.assertEqual(expected[2:], expected[:2])
+        self.assertEqual(len(self.warned(self.pack)), 2)
+
+    def test_parse(self):
+        for parser in [FastMathtexParser(), MathtexParser()]:
+            parser.parse(r'$\frac{1}{2}$', BakomaFonts(), 12, 100)
+            self.assertEqual(parser.diagnostics.messages(), [])
+            # Which is no longer set once parsed
+            self.assertEqual(len(self.warned(self.pack)), 2)
+        mathtex = Mathtex(r'$x$', parser='fast')
+        self.assertEqual(len(mathtex.diagnostics), 0)
+
+class DeepNestingTest(unittest.TestCase):
+    """
+    Lists nested far beyond the recursion limit are shipped and grown
+    without recursing.
+    """
+    depth = 5000
+
+    def nested(self):
+        box = Hlist([Rule(1., 1., 0., None)])
+        for i in range(self.depth):
+            if i % 2:
+                box = Hlist([Kern(1.), box])
+            else:
+                box = Vlist([Kern(1.), box])
+        return box
+
+    def test_ship(self):
+        shipped = Ship(self.nested())
+        self.assertEqual(len(shipped.rects), 1)
+        h, v, p, width, height = shipped.rects[0]
+        self.assertEqual(h, self.depth / 2)
+        self.assertEqual(width, 1.)
+
+    def test_grow(self):
+        box = self.nested()
+        box.grow()
+        inner = box
+        while len(getattr(inner, 'children', [])) == 2:
+            inner = inner.children[1]
+        self.assertEqual(inner.__class__, Hlist)
+        self.assertAlmostEqual(inner.children[0].width, 1. / 0.7)
+
+if __name__ == '__main__':
+    unittest.main()
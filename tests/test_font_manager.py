@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+# Mathtex font manager and startup tests; run with
+#   python -m unittest discover -s tests -p 'test_*.py'
+import subprocess
+import sys
+import unittest
+
+from mathtex.font_manager import FontconfigPatternParser
+
+class FontconfigPatternTest(unittest.TestCase):
+    """
+    Patterns which are only a family name, which are not parsed, give
+    what parsing them would, and the memoised properties are not
+    changed by their users.
+    """
+    patterns = ['DejaVu Sans', 'cmr10', 'STIXGeneral', 'Bitstream Vera Serif',
+                'sans\\-serif', 'Foo:weight=bold', 'Foo,Bar:size=12',
+                'Foo-10:slant=italic']
+
+    def parsed(self, pattern):
+        # Through the grammar, as all patterns were parsed before
+        parser = FontconfigPatternParser()
+        props = parser._properties = {}
+        parser._parser.parseString(pattern)
+        return props
+
+    def test_patterns(self):
+        parser = FontconfigPatternParser()
+        for pattern in self.patterns:
+            for i in range(2):
+                self.assertEqual(parser.parse(pattern), self.parsed(pattern),
+                                 pattern)
+
+    def test_memoised_copies(self):
+        parser = FontconfigPatternParser()
+        props = parser.parse('Foo:weight=bold')
+        props['family'].append('Bar')
+        del props['weight']
+        self.assertEqual(parser.parse('Foo:weight=bold'),
+                         {'family': ['Foo'], 'weight': ['bold']})
+
+    def test_invalid_pattern(self):
+        self.assertRaises(ValueError, FontconfigPatternParser().parse,
+                          'Foo:=bold')
+
+class StartupTest(unittest.TestCase):
+    def test_no_matplotlib(self):
+        # In an interpreter of its own, as the tests may import it
+        code = ('import sys, mathtex.mathtex_main; '
+                'print [x for x in sys.modules if x.startswith("matplotlib")]')
+        output = subprocess.Popen([sys.executable, '-c', code],
+                                  stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(output.strip(), '[]')
+
+if __name__ == '__main__':
+    unittest.main()
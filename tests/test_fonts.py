@@ -0,0 +1,268 @@
+#! /usr/bin/env python
+# Mathtex fontset tests; run with
+#   python -m unittest discover -s tests -p 'test_*.py'
+import gc
+import shutil
+import tempfile
+import unittest
+
+from mathtex import fonts
+from mathtex.fonts import get_fontset, BakomaFonts, StixFonts, UnicodeFonts, \
+    MetricsCache, set_metrics_cache, KERNING_DEFAULT, LOAD_NO_HINTING
+from mathtex.fastparser import FastMathtexParser
+from mathtex.mathtex_main import Mathtex
+
+from test_parsers import shipped
+
+def vera():
+    return UnicodeFonts(rm='Bitstream Vera Sans', it='Bitstream Vera Sans')
+
+class KernTest(unittest.TestCase):
+    """
+    The kerning of each pair, kept once looked up, is that of the font
+    at the size and dpi asked for.
+    """
+    text = 'AVATAR To {x}[y] y.W, f(r) Lo'
+    sizes = [(12, 100), (24, 100), (12, 300), (8.4, 72)]
+
+    def kerning(self, fonts_object, a, b, fontsize, dpi):
+        # As the font gives it, without the cache
+        info1 = fonts_object._get_info('rm', 'rm', a, fontsize, dpi)
+        info2 = fonts_object._get_info('rm', 'rm', b, fontsize, dpi)
+        info1.font.set_size(fontsize, dpi)
+        return info1.font.get_kerning(info1.num, info2.num,
+                                      KERNING_DEFAULT) / 64.0
+
+    def test_pairs(self):
+        fonts_object = vera()
+        kerned = 0
+        for i in range(2):
+            for fontsize, dpi in self.sizes:
+                for a, b in zip(self.text, self.text[1:]):
+                    kern = fonts_object.get_kern('rm', 'rm', a, fontsize,
+                                                 'rm', 'rm', b, fontsize, dpi)
+                    self.assertEqual(
+                        kern, self.kerning(vera(), a, b, fontsize, dpi),
+                        '%r at (%s, %s)' % (a + b, fontsize, dpi))
+                    kerned += kern != 0
+        self.assertTrue(kerned)
+
+    def test_fonts_or_sizes_which_differ(self):
+        fonts_object = vera()
+        self.assertEqual(fonts_object.get_kern('rm', 'rm', 'x', 12,
+                                               'it', 'it', 'y', 12, 100), 0)
+        self.assertEqual(fonts_object.get_kern('rm', 'rm', 'x', 12,
+                                               'rm', 'rm', 'y', 10, 100), 0)
+
+class GlyphCacheTest(unittest.TestCase):
+    """
+    The glyph infos and kerning pairs a fontset keeps are bounded, and
+    it keeps no FreeType glyphs.
+    """
+    def test_bounded(self):
+        class SmallFonts(BakomaFonts):
+            _glyph_cache_size = 50
+            _kern_cache_size = 20
+        fonts_object = SmallFonts()
+        parser = FastMathtexParser()
+        for i in range(20):
+            fontsize = 8 + i * 0.5
+            self.assertEqual(
+                shipped(parser, r'$\sin x + \frac{ab}{cd}$ text',
+                        fonts_object, fontsize),
+                shipped(parser, r'$\sin x + \frac{ab}{cd}$ text',
+                        BakomaFonts(), fontsize))
+            self.assertTrue(len(fonts_object.glyphd) <= 50)
+            self.assertTrue(len(fonts_object.kernd) <= 20)
+
+    def test_no_glyphs(self):
+        info = BakomaFonts()._get_info('rm', 'rm', 'x', 12, 100)
+        self.assertFalse(hasattr(info, 'glyph'))
+
+class RegistryTest(unittest.TestCase):
+    """
+    The registry hands out one fontset for each class and set of font
+    arguments, and a new one in place of any destroyed.
+    """
+    def test_shared(self):
+        self.assertTrue(get_fontset(BakomaFonts) is get_fontset(BakomaFonts))
+        self.assertFalse(get_fontset(BakomaFonts) is get_fontset(StixFonts))
+        self.assertFalse(get_fontset(BakomaFonts, 'rm')
+                         is get_fontset(BakomaFonts))
+
+    def test_destroyed(self):
+        expected = shipped(FastMathtexParser(), r'$x$', BakomaFonts())
+        fontset = get_fontset(BakomaFonts)
+        fontset.destroy()
+        self.assertFalse(get_fontset(BakomaFonts) is fontset)
+        self.assertFalse(get_fontset(BakomaFonts).destroyed)
+        self.assertEqual(shipped(FastMathtexParser(), r'$x$',
+                                 get_fontset(BakomaFonts)), expected)
+        Mathtex(r'$x$').as_mask()
+
+def face_uses():
+    return dict([(filename, entry[1])
+                 for filename, entry in fonts._faces.items()])
+
+class FaceTest(unittest.TestCase):
+    """
+    Fontsets share the FreeType face of each font file, which is let go
+    of once no fontset uses it, whether destroyed or collected.
+    """
+    def test_shared(self):
+        first, second = BakomaFonts(), BakomaFonts()
+        info = first._get_info('rm', 'rm', 'x', 12, 100)
+        self.assertTrue(second._get_info('rm', 'rm', 'x', 12, 100).font
+                        is info.font)
+
+    def test_destroyed_or_collected(self):
+        expr = r'$\sqrt{x} + \int \alpha$'
+        parser = FastMathtexParser()
+        before = face_uses()
+        kept = BakomaFonts()
+        parser.parse(expr, kept, 12, 100)
+        uses = face_uses()
+        self.assertNotEqual(uses, before)
+        for i in range(3):
+            fonts_object = BakomaFonts()
+            parser.parse(expr, fonts_object, 12, 100)
+            if i == 1:
+                fonts_object.destroy()
+            del fonts_object
+            gc.collect()
+            self.assertEqual(face_uses(), uses)
+        kept.destroy()
+        self.assertEqual(face_uses(), before)
+
+class MetricsCacheTest(unittest.TestCase):
+    """
+    Metrics saved to the cache are read back as they were written and
+    lay out as loaded ones, files written by anything else are ignored,
+    and no more than the entries allowed are kept.
+    """
+    exprs = [r'$\sqrt{x} + \int_0^1 \alpha\, dx$', r'$\frac{a}{b}$ text']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def layouts(self, metrics_cache):
+        previous = set_metrics_cache(metrics_cache)
+        try:
+            parser = FastMathtexParser()
+            fonts_object = BakomaFonts()
+            return [shipped(parser, expr, fonts_object, fontsize, dpi)
+                    for expr in self.exprs
+                    for fontsize, dpi in [(12, 100), (8.4, 300)]]
+        finally:
+            set_metrics_cache(previous)
+
+    def test_round_trip(self):
+        expected = self.layouts(None)
+        metrics_cache = MetricsCache(self.directory)
+        self.assertEqual(self.layouts(metrics_cache), expected)
+        self.assertEqual(metrics_cache.hits, 0)
+        metrics_cache.save()
+
+        loaded = MetricsCache(self.directory)
+        self.assertEqual(self.layouts(loaded), expected)
+        self.assertEqual(loaded.misses, 0)
+        self.assertEqual(loaded.hits, metrics_cache.misses)
+        for digest, table in metrics_cache._metrics.items():
+            self.assertEqual(loaded._load(digest), table)
+
+    def test_other_files(self):
+        metrics_cache = MetricsCache(self.directory)
+        self.layouts(metrics_cache)
+        metrics_cache.save()
+        digest, table = metrics_cache._metrics.items()[0]
+        path = metrics_cache._path(digest)
+        lines = open(path).readlines()
+        contents = [
+            # Something to unpickle, which is not
+            "cos\nsystem\n(S'exit 1'\ntR.",
+            lines[0] + 'cos\nsystem\n',
+            ''.join(lines[:-1]) + lines[-1].rsplit(' ', 1)[0] + '\n',
+            ''.join(lines) + '1 12 100 nan 0 0 0 0 0 0 0\n',
+            ''.join(lines) + '1.5 12 100 0 0 0 0 0 0 0 0\n',
+            ''.join(lines) + '1 12 100 inf 0 0 0 0 0 0 0\n',
+            'mathtex glyph metrics 0\n' + ''.join(lines[1:])]
+        for content in contents:
+            fh = open(path, 'w')
+            fh.write(content)
+            fh.close()
+            self.assertEqual(MetricsCache(self.directory)._load(digest), {},
+                             repr(content))
+        # And started over
+        metrics_cache = MetricsCache(self.directory)
+        self.layouts(metrics_cache)
+        metrics_cache.save()
+        self.assertEqual(MetricsCache(self.directory)._load(digest), table)
+
+    def test_max_entries(self):
+        # The order in which metrics are looked up, by font file
+        unbounded = MetricsCache(tempfile.mkdtemp(dir=self.directory))
+        self.layouts(unbounded)
+        metrics_cache = MetricsCache(self.directory, max_entries=10)
+        self.layouts(metrics_cache)
+        metrics_cache.save()
+        sizes = []
+        for digest, table in metrics_cache._metrics.items():
+            lines = open(metrics_cache._path(digest)).readlines()
+            self.assertEqual(len(lines), len(table) + 1)
+            loaded = MetricsCache(self.directory)._load(digest)
+            self.assertEqual(loaded, table)
+            # The newest, oldest first
+            self.assertEqual(loaded._killkeys,
+                             unbounded._metrics[digest]._killkeys[-10:])
+            sizes.append(len(table))
+        self.assertEqual(max(sizes), 10)
+
+class UnscaledMetricsTest(unittest.TestCase):
+    """
+    Metrics worked out from unscaled ones are those of the glyph loaded
+    unhinted at the size and dpi, to within the rounding of FreeType's
+    26.6 pixels, and near the hinted ones.
+    """
+    symbols = ['x', 'A', 'g', '1', '(', r'\int', r'\sum', r'\alpha']
+    sizes = [(12, 100), (8.4, 300), (30, 72)]
+
+    def metrics(self, info):
+        metrics = info.metrics
+        return [metrics.advance, metrics.height, metrics.width,
+                metrics.iceberg, metrics.xmin, metrics.ymin, metrics.xmax,
+                metrics.ymax]
+
+    def unhinted(self, info, fontsize, dpi):
+        font = info.font
+        font.set_size(fontsize, dpi)
+        glyph = font.load_char(info.num, flags=LOAD_NO_HINTING)
+        font.clear()
+        offset = info.offset
+        xmin, ymin, xmax, ymax = [value / 64.0 for value in glyph.bbox]
+        return [glyph.linearHoriAdvance / 65536.0, glyph.height / 64.0,
+                glyph.width / 64.0, glyph.horiBearingY / 64.0 + offset,
+                xmin, ymin + offset, xmax, ymax + offset]
+
+    def test_metrics(self):
+        for fonts_class in [BakomaFonts, StixFonts]:
+            unscaled = fonts_class()
+            unscaled.unscaled_metrics = True
+            hinted = fonts_class()
+            for sym in self.symbols:
+                for fontsize, dpi in self.sizes:
+                    info = unscaled._get_info('rm', 'rm', sym, fontsize, dpi)
+                    metrics = self.metrics(info)
+                    for a, b in zip(metrics,
+                                    self.unhinted(info, fontsize, dpi)):
+                        self.assertTrue(abs(a - b) < 0.1,
+                                        (sym, fontsize, dpi, a, b))
+                    for a, b in zip(metrics, self.metrics(hinted._get_info(
+                            'rm', 'rm', sym, fontsize, dpi))):
+                        self.assertTrue(abs(a - b) <= 2,
+                                        (sym, fontsize, dpi, a, b))
+
+if __name__ == '__main__':
+    unittest.main()
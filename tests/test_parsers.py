@@ -0,0 +1,486 @@
+#! /usr/bin/env python
+# Mathtex parser tests; run with
+#   python -m unittest discover -s tests -p 'test_*.py'
+import gc
+import pickle
+import random
+import threading
+import unittest
+import weakref
+
+from mathtex.mathtex_main import Mathtex
+from mathtex.parser import MathtexParser, MathtexLimitError, RuleCounter, \
+    Names, get_parser
+from mathtex.fastparser import FastMathtexParser, IncrementalMathtexParser, \
+    MathtexSyntaxError
+from mathtex.fonts import get_fontset, BakomaFonts, UnicodeFonts
+from mathtex.boxmodel import Char, Ship
+from mathtex.pyparsing import Combine, FollowedBy, Literal, Regex, \
+    ParseException, oneOf
+
+from corpus import tests, presets
+
+def shipped(parser, expr, fonts_object, fontsize=12, dpi=100):
+    """
+    Returns the rects and glyphs of *expr* laid out by *parser*, with
+    the glyphs as tuples, or the type and arguments of the error raised.
+    """
+    try:
+        box = parser.parse(expr, fonts_object, fontsize, dpi)
+    except Exception, e:
+        return type(e).__name__, e.args
+    rects, glyphs, bbox = Ship(box).output(0, 0)
+    glyphs = [(info.font.fname, info.fontsize, info.num, ox, oy)
+              for ox, oy, info in glyphs]
+    return [tuple(r) for r in rects], glyphs, bbox
+
+class EngineEquivalenceTest(unittest.TestCase):
+    """
+    The fast parser lays out the corpus exactly as pyparsing does.
+    """
+    def test_corpus(self):
+        pyparsing, fast = MathtexParser(), FastMathtexParser()
+        fontsets = {}
+        for name, expr in sorted(tests.items()):
+            for fontsize, dpi, font in presets:
+                if font not in fontsets:
+                    fontsets[font] = get_fontset(Mathtex.fontset_mapping[font])
+                fonts_object = fontsets[font]
+                self.assertEqual(
+                    shipped(pyparsing, expr, fonts_object, fontsize, dpi),
+                    shipped(fast, expr, fonts_object, fontsize, dpi),
+                    '%s at (%s, %s, %s)' % (name, fontsize, dpi, font))
+
+    def test_code_points(self):
+        # Symbols outside the Basic Multilingual Plane, and beyond the
+        # planes the grammar accepts
+        pyparsing, fast = MathtexParser(), FastMathtexParser()
+        fonts_object = get_fontset(Mathtex.fontset_mapping['stix'])
+        for expr in [u'$\u00e9\u2211$', u'$x\U0001d400$', u'$x\U00020000$']:
+            self.assertEqual(shipped(pyparsing, expr, fonts_object),
+                             shipped(fast, expr, fonts_object), repr(expr))
+
+class ParserRegistryTest(unittest.TestCase):
+    """
+    Each thread is given a parser of its own, which it reuses, and
+    threads may parse with theirs at once.
+    """
+    def test_per_thread(self):
+        parsers = {}
+
+        def run(i):
+            parsers[i] = [get_parser(), get_parser(),
+                          get_parser(FastMathtexParser)]
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(2):
+            first, second, fast = parsers[i]
+            self.assertTrue(first is second)
+            self.assertTrue(isinstance(first, MathtexParser))
+            self.assertTrue(isinstance(fast, FastMathtexParser))
+        self.assertFalse(parsers[0][0] is parsers[1][0])
+
+    def test_threads(self):
+        fonts_object = get_fontset(BakomaFonts)
+        exprs = [expr for name, expr in sorted(tests.items())]
+        expected = [shipped(MathtexParser(), expr, fonts_object)
+                    for expr in exprs]
+        results = {}
+
+        def run(i):
+            parser = get_parser(MathtexParser)
+            results[i] = [[shipped(parser, expr, fonts_object)
+                           for expr in exprs] for j in range(2)]
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            for outputs in results[i]:
+                self.assertEqual(outputs, expected)
+
+class RandomisedComparisonTest(unittest.TestCase):
+    """
+    The fast parser agrees with pyparsing on random expressions, made
+    of pieces of the grammar, down to the message of each error.
+    """
+    pieces = ['$', '$', '$', ' ', 'x', 'y', '1', '{', '}', '{', '}', '_',
+              '^', r'\frac', r'\sqrt', '[3]', '[', ']', r'\left(',
+              r'\right)', r'\left', r'\right', '(', ')', '|', r'\hat',
+              r'\sin', r'\alpha', r'\leftarrow', r'\dots', r'\doteq', r'\,',
+              r'\quad', r'\hspace{', '2', r'\rm', r'\mathrm', r'\mathbf{',
+              r'\AA', r'\operatorname{', 'ab', r'\genfrac{', r'\binom',
+              r'\stackrel', r'\widehat', '\\', r'\$', r'\{', r'\}', '\t', '.',
+              r'\int', r'\sum', r'\frak', r'\degree', r'\bogus', r'\ ']
+    count = 200
+    max_pieces = 30
+
+    def expressions(self, seed):
+        rand = random.Random(seed)
+        for i in range(self.count):
+            expr = ''.join([rand.choice(self.pieces)
+                            for j in range(rand.randint(1, self.max_pieces))])
+            if rand.random() < 0.7:
+                expr = '$' + expr + '$'
+            yield expr
+
+    def test_random_expressions(self):
+        pyparsing, fast = MathtexParser(), FastMathtexParser()
+        fonts_object = BakomaFonts()
+        for expr in self.expressions(7):
+            self.assertEqual(shipped(pyparsing, expr, fonts_object),
+                             shipped(fast, expr, fonts_object), repr(expr))
+
+class SyntaxTreeTest(unittest.TestCase):
+    """
+    Syntax trees depend on the expression alone, are cached by it, and
+    survive pickling.
+    """
+    exprs = [expr for name, expr in sorted(tests.items())[::3]]
+
+    def test_pickle(self):
+        parser = FastMathtexParser()
+        fonts_object = BakomaFonts()
+        for expr in self.exprs:
+            ast = parser.parse_ast(expr)
+            for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+                loaded = pickle.loads(pickle.dumps(ast, protocol))
+                self.assertEqual(loaded, ast, expr)
+                self.assertEqual(
+                    shipped(LoadedTree(parser, loaded), expr, fonts_object),
+                    shipped(parser, expr, fonts_object), expr)
+
+    def test_cache(self):
+        parser = FastMathtexParser()
+        asts = [parser.parse_ast(expr) for expr in self.exprs]
+        fontsets = {}
+        for expr, ast in zip(self.exprs, asts):
+            for fontsize, dpi, font in presets:
+                if font not in fontsets:
+                    fontsets[font] = get_fontset(Mathtex.fontset_mapping[font])
+                parser.parse(expr, fontsets[font], fontsize, dpi)
+                self.assertTrue(parser.parse_ast(expr) is ast, expr)
+        self.assertEqual(sorted(parser._ast_cache.keys()),
+                         sorted(self.exprs))
+        fresh = FastMathtexParser()
+        for expr, ast in zip(self.exprs, asts):
+            self.assertEqual(fresh.parse_ast(expr), ast, expr)
+
+class LoadedTree(object):
+    """
+    Lays out a syntax tree given in place of the expression.
+    """
+    def __init__(self, parser, ast):
+        self.parser = parser
+        self.ast = ast
+
+    def parse(self, s, fonts_object, fontsize, dpi):
+        return self.parser.layout(self.ast, fonts_object, fontsize, dpi)
+
+class NamesTest(unittest.TestCase):
+    """
+    Names matches what the oneOf alternation of the names, with any
+    prefix and following expression, does.
+    """
+    names = ['i', 'in', 'int', 'infty', 'sin']
+    strings = ['i', 'in', 'int', 'inf', 'infty', 'intx', 'int{', 'inf}',
+               'infty}', 'infinity', 'x', 'sint', '', '\\', '\\i', '\\in',
+               '\\int', '\\in{', '\\int{', '\\intx', '\\inf}', '\\infty}',
+               '\\infty1', 'a\\int}', '\\\\int}', '\\sin(x)', '\\sinx']
+
+    def one_of(self, prefix, follow):
+        element = oneOf(self.names)
+        if prefix:
+            element = Combine(Literal(prefix) + element)
+        if follow is not None:
+            element = element + FollowedBy(Regex(follow))
+        return element.leaveWhitespace()
+
+    def end(self, element, s, loc):
+        try:
+            return element._parseNoCache(s, loc, False, False)[0]
+        except ParseException:
+            return -1
+
+    def test_match(self):
+        matched = {}
+        for prefix, follow in [('', None), ('\\', None),
+                               ('', '[^a-zA-Z]'), ('\\', '[^a-zA-Z]')]:
+            names = Names(self.names, prefix=prefix, follow=follow)
+            element = self.one_of(prefix, follow)
+            for s in self.strings:
+                for loc in range(len(s) + 1):
+                    end = names.match(s, loc)
+                    self.assertEqual(end, self.end(element, s, loc),
+                                     (prefix, follow, s, loc))
+                    matched[prefix, follow, s[loc:]] = end - loc
+        # The longest name, even where what follows turns it away
+        self.assertEqual(matched['', None, 'infty}'], 5)
+        self.assertEqual(matched['', None, 'inf}'], 2)
+        self.assertEqual(matched['\\', '[^a-zA-Z]', '\\int{'], 4)
+        self.assertEqual(matched['\\', '[^a-zA-Z]', '\\in{'], 3)
+        self.assertTrue(matched['\\', '[^a-zA-Z]', '\\intx'] < 0)
+        self.assertTrue(matched['\\', '[^a-zA-Z]', '\\inf}'] < 0)
+        # Up to the end of the input, which what follows cannot match
+        self.assertEqual(matched['\\', None, '\\int'], 4)
+        self.assertTrue(matched['\\', '[^a-zA-Z]', '\\int'] < 0)
+        self.assertTrue(matched['\\', None, ''] < 0)
+        self.assertTrue(matched['\\', None, '\\'] < 0)
+
+class RuleCounterTest(unittest.TestCase):
+    """
+    Only the alternatives which can start where the grammar stands
+    are tried, and counting stops when asked to.
+    """
+    def test_counts(self):
+        parser = MathtexParser()
+        counter = RuleCounter()
+        parser.count_rules(counter)
+        try:
+            parser.parse(r'$\frac{1}{2} + \sqrt{x}$', BakomaFonts(), 12, 100)
+        finally:
+            parser.count_rules(None)
+        self.assertEqual(counter.attempts['math'], 1)
+        for rule in ['frac', 'sqrt']:
+            self.assertEqual(counter.attempts[rule], counter.matches[rule],
+                             rule)
+        for rule in ['genfrac', 'binom', 'stackrel', 'accent']:
+            self.assertFalse(rule in counter.attempts, rule)
+
+        attempts = dict(counter.attempts)
+        parser.parse(r'$\frac{1}{2}$', BakomaFonts(), 12, 100)
+        self.assertEqual(counter.attempts, attempts)
+
+class ValidateTest(unittest.TestCase):
+    """
+    :meth:`FastMathtexParser.validate` reports the errors parsing would,
+    if not where pyparsing does, without laying anything out.
+    """
+    def test_corpus_is_valid(self):
+        parser = FastMathtexParser()
+        for name, expr in sorted(tests.items()):
+            parser.validate(expr)
+
+    def test_error(self):
+        parser = FastMathtexParser()
+        try:
+            parser.validate(r'$x^{2$')
+        except MathtexSyntaxError, e:
+            self.assertEqual(e.msg, "Expected end of math '$'")
+        else:
+            self.fail('no error raised')
+
+    def test_random_expressions(self):
+        pyparsing, fast = MathtexParser(), FastMathtexParser()
+        fonts_object = BakomaFonts()
+        for expr in RandomisedComparisonTest('run').expressions(1007):
+            try:
+                pyparsing.parse(expr, fonts_object, 12, 100)
+            except ValueError, e:
+                expected = str(e).split('\n')[0]
+            except Exception:
+                # Errors of the fonts, which are not looked at
+                expected = None
+            else:
+                expected = None
+            try:
+                fast.validate(expr)
+            except MathtexSyntaxError, e:
+                found = e.msg
+            else:
+                found = None
+            self.assertEqual(expected, found, repr(expr))
+
+class LimitsTest(unittest.TestCase):
+    """
+    Limits are off by default, and once set turn expressions exceeding
+    them away with :class:`MathtexLimitError`, with each parser.
+    """
+    engines = [MathtexParser, FastMathtexParser, IncrementalMathtexParser]
+
+    def test_off_by_default(self):
+        text = 'plain text ' * 1000
+        rects, glyphs, bbox = shipped(FastMathtexParser(), text,
+                                      BakomaFonts())
+        self.assertEqual(len(glyphs), len(text))
+
+    def test_untrusted_limits(self):
+        cases = [('max_depth', '$' + r'\sqrt{' * 17 + 'x' + '}' * 17 + '$'),
+                 ('max_depth',
+                  '$' + r'\left(' * 17 + 'x' + r'\right)' * 17 + '$'),
+                 ('max_script_depth', '$' + 'x^{' * 9 + 'x' + '}' * 9 + '$'),
+                 ('max_nodes', '$' + 'x+' * 1000 + 'x$'),
+                 ('max_length', 'x' * 8001)]
+        for engine in self.engines:
+            parser = engine()
+            parser.set_limits(**MathtexParser.untrusted_limits)
+            for limit, expr in cases:
+                try:
+                    parser.parse(expr, BakomaFonts(), 12, 100)
+                except MathtexLimitError, e:
+                    self.assertEqual(e.limit, limit)
+                    self.assertEqual(e.maximum,
+                                     MathtexParser.untrusted_limits[limit])
+                else:
+                    self.fail('%s accepted %s' % (engine.__name__, limit))
+            # Just within them
+            parser.parse('$' + r'\sqrt{' * 16 + 'x' + '}' * 16 + '$',
+                         BakomaFonts(), 12, 100)
+
+    def test_unknown_limit(self):
+        self.assertRaises(TypeError, FastMathtexParser().set_limits,
+                          max_width=10)
+
+class StateTest(unittest.TestCase):
+    """
+    Parser states are immutable and there is one of each, shared by the
+    characters laid out in it, which does not keep its fonts object
+    alive.
+    """
+    def test_interned(self):
+        State = MathtexParser.State
+        fonts_object = BakomaFonts()
+        state = State(fonts_object, 'rm', 'rm', 12, 100)
+        self.assertTrue(State(fonts_object, 'rm', 'rm', 12, 100) is state)
+        self.assertFalse(State(BakomaFonts(), 'rm', 'rm', 12, 100) is state)
+        self.assertRaises(AttributeError, setattr, state, 'fontsize', 10)
+
+        self.assertTrue(state.with_font('it') is
+                        State(fonts_object, 'it', 'it', 12, 100))
+        self.assertTrue(state.with_font('cal') is
+                        State(fonts_object, 'cal', 'rm', 12, 100))
+        self.assertTrue(state.with_fontsize(10) is
+                        State(fonts_object, 'rm', 'rm', 10, 100))
+        self.assertTrue(state.shrunk() is state.shrunk())
+        self.assertTrue(state.shrunk() is
+                        State(fonts_object, 'rm', 'rm', 12 * 0.7, 100))
+        self.assertTrue(state.grown() is
+                        State(fonts_object, 'rm', 'rm', 12 / 0.7, 100))
+
+    def test_chars(self):
+        box = FastMathtexParser().parse(r'$x^{yz} + \mathrm{abc}$',
+                                        BakomaFonts(), 12, 100)
+        chars = []
+        lists = [box]
+        while lists:
+            node = lists.pop()
+            if isinstance(node, Char):
+                chars.append(node)
+            lists.extend(getattr(node, 'children', []))
+        states = set([char.state for char in chars])
+        self.assertEqual(len(chars), 7)
+        self.assertEqual(len(states), 3)
+        for char in chars:
+            state = char.state
+            self.assertEqual(
+                (char.font_output, char.font, char.font_class,
+                 char.fontsize, char.dpi),
+                (state.font_output, state.font, state.font_class,
+                 state.fontsize, state.dpi))
+
+    def test_fonts_object_released(self):
+        parser = FastMathtexParser()
+        fonts_object = BakomaFonts()
+        released = weakref.ref(fonts_object)
+        box = parser.parse(r'$x^{2} + \sqrt{y}$', fonts_object, 12, 100)
+        del box, fonts_object
+        gc.collect()
+        self.assertTrue(released() is None)
+
+def fonts_used(parser, expr, fonts_object):
+    """
+    Returns the names of the font files *expr* is drawn with.
+    """
+    rects, glyphs, bbox = shipped(parser, expr, fonts_object)
+    return set([fname for fname, fontsize, num, ox, oy in glyphs])
+
+class SubtreeCacheTest(unittest.TestCase):
+    """
+    Laying out through the subtree cache gives the boxes of laying out
+    without it, and keeps the boxes of each fonts object apart.
+    """
+    def cached_parser(self):
+        parser = FastMathtexParser()
+        parser.subtree_cache_size = 100
+        return parser
+
+    def test_corpus(self):
+        cached, fast = self.cached_parser(), FastMathtexParser()
+        fonts_object = BakomaFonts()
+        for i in range(2):
+            for name, expr in sorted(tests.items()):
+                self.assertEqual(shipped(cached, expr, fonts_object),
+                                 shipped(fast, expr, fonts_object), name)
+        self.assertTrue(cached.subtree_hits)
+
+    def test_fonts_objects_of_a_class(self):
+        parser = self.cached_parser()
+        expr = r'$\frac{a}{b} + \frac{a}{b}$'
+        serif = UnicodeFonts(rm='Bitstream Vera Serif',
+                             it='Bitstream Vera Serif')
+        sans = UnicodeFonts(rm='Bitstream Vera Sans',
+                            it='Bitstream Vera Sans')
+        used = fonts_used(parser, expr, serif)
+        self.assertEqual(fonts_used(parser, expr, sans),
+                         fonts_used(FastMathtexParser(), expr, sans))
+        self.assertNotEqual(fonts_used(parser, expr, sans), used)
+
+    def test_destroyed_fonts_object(self):
+        parser = self.cached_parser()
+        expr = r'$\frac{a}{b} + \frac{a}{b}$'
+        fonts_object = BakomaFonts()
+        expected = shipped(parser, expr, fonts_object)
+        fonts_object.destroy()
+        self.assertEqual(shipped(parser, expr, BakomaFonts()), expected)
+        for cache in [parser._subtree_cache, parser._subtrees_seen]:
+            self.assertFalse([key for key in cache
+                              if key[1] is fonts_object])
+
+class IncrementalParserTest(unittest.TestCase):
+    """
+    The incremental parser lays out text as the fast parser does,
+    however it was edited, and keeps the boxes of each fonts object
+    apart.
+    """
+    edits = [r'The sum $x$ is', r'The sum $x + y$ is',
+             r'The sum $x + y$ is $\frac{1}{2}$', r'The sum $x + y$ is ',
+             r'The sum $x + y$ is $$ here', r'The $\alpha_i$ sum $x + y$',
+             r'$x + y$']
+
+    def test_edits(self):
+        incremental, fast = IncrementalMathtexParser(), FastMathtexParser()
+        fonts_object = BakomaFonts()
+        for expr in self.edits + self.edits[::-1]:
+            self.assertEqual(shipped(incremental, expr, fonts_object),
+                             shipped(fast, expr, fonts_object), repr(expr))
+
+    def test_fonts_objects_of_a_class(self):
+        parser = IncrementalMathtexParser()
+        expr = r'$\frac{a}{b}$ x'
+        serif = UnicodeFonts(rm='Bitstream Vera Serif',
+                             it='Bitstream Vera Serif')
+        sans = UnicodeFonts(rm='Bitstream Vera Sans',
+                            it='Bitstream Vera Sans')
+        used = fonts_used(parser, expr, serif)
+        self.assertEqual(fonts_used(parser, expr, sans),
+                         fonts_used(FastMathtexParser(), expr, sans))
+        self.assertNotEqual(fonts_used(parser, expr, sans), used)
+
+    def test_destroyed_fonts_object(self):
+        parser = IncrementalMathtexParser()
+        expr = r'a $\frac{a}{b}$ c'
+        fonts_object = BakomaFonts()
+        expected = shipped(parser, expr, fonts_object)
+        fonts_object.destroy()
+        self.assertEqual(shipped(parser, expr, BakomaFonts()), expected)
+        self.assertFalse([key for key in parser._segment_cache
+                          if key[0] is fonts_object])
+
+if __name__ == '__main__':
+    unittest.main()
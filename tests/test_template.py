@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# Mathtex template tests; run with
+#   python -m unittest discover -s tests -p 'test_*.py'
+import random
+import unittest
+
+from mathtex.template import MathtexTemplate
+from mathtex.fastparser import FastMathtexParser
+from mathtex.fonts import BakomaFonts, StixFonts
+from mathtex.boxmodel import Ship
+
+def shipped(parse):
+    """
+    Returns the rects, glyphs and dimensions of the box *parse*
+    returns, or the type and message of the error it raises.
+    """
+    try:
+        box = parse()
+    except Exception, e:
+        return type(e).__name__, str(e)
+    rects, glyphs, bbox = Ship(box).output(0, 0)
+    glyphs = [(info.font.fname, info.fontsize, info.num, ox, oy)
+              for ox, oy, info in glyphs]
+    return ([tuple(r) for r in rects], glyphs, bbox,
+            box.width, box.height, box.depth)
+
+class TemplateTest(unittest.TestCase):
+    """
+    Filling in a template lays out what parsing the substituted
+    expression does.
+    """
+    fonts_objects = [BakomaFonts(), StixFonts()]
+
+    def assertLaidOutAsParsed(self, template, bindings):
+        parser = FastMathtexParser()
+        expr = template.substitute(bindings)
+        for fonts_object in self.fonts_objects:
+            self.assertEqual(
+                shipped(lambda: template.parse(bindings, fonts_object,
+                                               12, 100)),
+                shipped(lambda: parser.parse(expr, fonts_object, 12, 100)),
+                '%r with %r' % (template.template, bindings))
+
+    def test_substitute(self):
+        template = MathtexTemplate(
+            r'$x_{%(i)d}^{2} + \frac{%(name)s}{2}$ 100%%')
+        self.assertEqual(template.substitute({'i': 1, 'name': 'y'}),
+                         r'$x_{1}^{2} + \frac{y}{2}$ 100%')
+
+    def test_placeholders(self):
+        template = MathtexTemplate(r'$x_{%(i)d}^{2} + \frac{%(name)s}{2}$')
+        for i in [1, 12, -3]:
+            for name in ['y', r'\alpha', r'\frac{1}{2}', 'a b', '']:
+                self.assertLaidOutAsParsed(template, {'i': i, 'name': name})
+
+    def test_values_which_do_not_stand_alone(self):
+        # Scripts of only the first character of the value, values
+        # which close groups or math, and commands run on by the values
+        cases = [(r'$x_%(i)s$', '12'),
+                 (r'$x_%(i)s$', 'ab'),
+                 (r'${%(i)s}$', '}'),
+                 (r'$x %(i)s y$', '$'),
+                 (r'$\alpha%(i)s$', 'b'),
+                 (r'$\hat %(i)s$', 'xy'),
+                 (r'$%(i)s$', '^2'),
+                 (r'$%(i)s 2$', '\\'),
+                 (r'a %(i)s b', '$x$'),
+                 ('$x\t%(i)s$', 'y')]
+        for template, value in cases:
+            self.assertLaidOutAsParsed(MathtexTemplate(template), {'i': value})
+
+    def test_invalid_placeholders(self):
+        self.assertRaises(ValueError, MathtexTemplate, r'$x_%d$')
+        self.assertRaises(ValueError, MathtexTemplate, r'$x_%(i)$')
+
+    def test_random_templates(self):
+        pieces = [r'\mathrm', '{x}', "\\'", r'\hat ', r'\frac{1}', '{2}',
+                  r'\sqrt', '[3]', ' ', 'x', 'y', '_', '^', '{', '}',
+                  r'\frac', r'\alpha', r'\sin', r'\left(', r'\right)',
+                  r'\rm', '2', '+', '$', '\\', r'\,', r'\mathrm{', 'a b',
+                  r'\left[', r'\right]', r'\left.', r'\right|', '[', ']']
+        values = [r'\mathrm', '{x}', "\\'", r'\frac', '{1}{2}', r'\sqrt',
+                  '[3]{x}', r'\left(', r'\right)', r'\rm ', u'\u03b1', '1',
+                  '12', 'x', 'ab', r'\alpha', '', ' ', '^2', '_1', 'x^2',
+                  '}', '{', '$', '\\', 'a$b', r'\frac{1}{2}', r'\rm x',
+                  r'\left(x\right)', r'\sin', '3.5', r'\$', 'x_1^2', '{}',
+                  r'\hat', "'", 'z ', r' \alpha', r'\left[y\right]']
+        names = ['a', 'b', 'c']
+        rand = random.Random(3)
+        for i in range(100):
+            parts = []
+            for j in range(rand.randint(1, 8)):
+                if rand.random() < 0.3:
+                    parts.append('%%(%s)s' % rand.choice(names))
+                else:
+                    parts.append(rand.choice(pieces))
+            template = ''.join(parts)
+            if rand.random() < 0.8:
+                template = '$' + template + '$'
+            if rand.random() < 0.3:
+                template = 'text ' + template + ' more'
+            if rand.random() < 0.2:
+                template = unicode(template)
+            template = MathtexTemplate(template)
+            for j in range(3):
+                bindings = dict([(x, rand.choice(values)) for x in names])
+                self.assertLaidOutAsParsed(template, bindings)
+
+if __name__ == '__main__':
+    unittest.main()